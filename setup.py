@@ -3,7 +3,7 @@ setup(
     name="snapper_systemd_boot",
     description="Generate systemd-boot entries from snapper btrfs snapshots.",
     version="0.1.0-prealpha1",
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests"]),
     install_requires=[
         "reprutils",
         "argh",
@@ -11,6 +11,7 @@ setup(
     ],
     extras_require={
         "dev": ["pytest"],
+        "async": ["dbus-next"],
     },
     entry_points={
         "console_scripts": [
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Create and delete btrfs subvolumes.
+
+Spawning `btrfs` for every subvolume is slow, each call forks a process and
+runs its own transaction, so by default the ioctls are called directly. The
+`btrfs` command is kept as a fallback, and a plain directory backend makes it
+possible to test without btrfs.
+
+`sh` is only imported when the `btrfs` command is used.
+"""
+from pathlib import Path
+import fcntl
+import logging
+import os
+import shutil
+import struct
+
+from reprutils import GetattrRepr
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+SUBVOLUME_BACKENDS = ("ioctl", "sh")
+
+# From linux/btrfs.h. These assume the generic ioctl number layout used by
+# x86 and arm.
+_IOC_NONE = 0
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+BTRFS_IOCTL_MAGIC = 0x94
+
+
+def _ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (BTRFS_IOCTL_MAGIC << 8) | nr
+
+
+BTRFS_PATH_NAME_MAX = 4087
+BTRFS_SUBVOL_NAME_MAX = 4039
+BTRFS_INO_LOOKUP_PATH_MAX = 4080
+
+# Inode number of the root directory of every subvolume.
+BTRFS_FIRST_FREE_OBJECTID = 256
+
+# struct btrfs_ioctl_vol_args
+VOL_ARGS = struct.Struct("=q{}s".format(BTRFS_PATH_NAME_MAX + 1))
+# struct btrfs_ioctl_vol_args_v2; fd, transid, flags, unused, name
+VOL_ARGS_V2 = struct.Struct("=qQQ32s{}s".format(BTRFS_SUBVOL_NAME_MAX + 1))
+# struct btrfs_ioctl_ino_lookup_args; treeid, objectid, name
+INO_LOOKUP_ARGS = struct.Struct("=QQ{}s".format(BTRFS_INO_LOOKUP_PATH_MAX))
+
+BTRFS_IOC_SYNC = _ioc(_IOC_NONE, 8, 0)
+BTRFS_IOC_SNAP_DESTROY = _ioc(_IOC_WRITE, 15, VOL_ARGS.size)
+BTRFS_IOC_SNAP_CREATE_V2 = _ioc(_IOC_WRITE, 23, VOL_ARGS_V2.size)
+BTRFS_IOC_INO_LOOKUP = _ioc(
+    _IOC_READ | _IOC_WRITE, 18, INO_LOOKUP_ARGS.size)
+
+
+class SubvolumeBackend:
+    """
+    Base for ways of creating and deleting subvolumes.
+
+    Updates create snapshots with `workers` threads and, if `commit` is true,
+    wait for the btrfs transaction to commit once they've created them all.
+    """
+    def __init__(self, workers=1, commit=False):
+        self.workers = workers
+        self.commit = commit
+
+    def snapshot(self, source, destination):
+        """
+        Create writable snapshot of subvolume `source` at `destination`.
+        """
+        raise NotImplementedError()
+
+    def delete(self, path):
+        """
+        Delete subvolume at `path`.
+        """
+        raise NotImplementedError()
+
+    def sync(self, path):
+        """
+        Commit the transaction of the filesystem containing `path`.
+        """
+
+    def get_subvolume_id(self, path):
+        """
+        Get the id of the subvolume at `path`, or `None` if not known.
+
+        Ids change if a subvolume is deleted and created again, so tell us if
+        it's been replaced behind our back.
+        """
+        return None
+
+    __repr__ = GetattrRepr(
+        workers="workers",
+        commit="commit",
+    )
+
+
+class ShSubvolumeBackend(SubvolumeBackend):
+    """
+    Use the `btrfs` command.
+    """
+    def snapshot(self, source, destination):
+        import sh
+        DEV_LOGGER.info("Snapshot: %s -> %s", source, destination)
+        sh.btrfs.subvolume.snapshot(source, destination)
+
+    def delete(self, path):
+        import sh
+        DEV_LOGGER.info("Delete subvolume: %s", path)
+        sh.btrfs.subvolume.delete(path)
+
+    def sync(self, path):
+        import sh
+        sh.btrfs.filesystem.sync(path)
+
+    def get_subvolume_id(self, path):
+        import sh
+        return int(str(sh.btrfs("inspect-internal", "rootid", path)))
+
+
+class IoctlSubvolumeBackend(SubvolumeBackend):
+    """
+    Call the btrfs ioctls directly.
+    """
+    @staticmethod
+    def _open_dir(path):
+        return os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+
+    @staticmethod
+    def _encode_name(path, max_length):
+        name = os.fsencode(Path(path).name)
+        if len(name) > max_length:
+            raise ValueError("Subvolume name too long: {}".format(path))
+        return name
+
+    def snapshot(self, source, destination):
+        DEV_LOGGER.info("Snapshot: %s -> %s", source, destination)
+        name = self._encode_name(destination, BTRFS_SUBVOL_NAME_MAX)
+        source_fd = self._open_dir(source)
+        try:
+            parent_fd = self._open_dir(Path(destination).parent)
+            try:
+                args = bytearray(VOL_ARGS_V2.pack(source_fd, 0, 0, b"", name))
+                fcntl.ioctl(parent_fd, BTRFS_IOC_SNAP_CREATE_V2, args)
+            finally:
+                os.close(parent_fd)
+        finally:
+            os.close(source_fd)
+
+    def delete(self, path):
+        DEV_LOGGER.info("Delete subvolume: %s", path)
+        name = self._encode_name(path, BTRFS_PATH_NAME_MAX)
+        parent_fd = self._open_dir(Path(path).parent)
+        try:
+            args = bytearray(VOL_ARGS.pack(0, name))
+            fcntl.ioctl(parent_fd, BTRFS_IOC_SNAP_DESTROY, args)
+        finally:
+            os.close(parent_fd)
+
+    def sync(self, path):
+        DEV_LOGGER.info("Sync filesystem: %s", path)
+        fd = self._open_dir(path)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_SYNC)
+        finally:
+            os.close(fd)
+
+    def get_subvolume_id(self, path):
+        fd = self._open_dir(path)
+        try:
+            args = bytearray(
+                INO_LOOKUP_ARGS.pack(0, BTRFS_FIRST_FREE_OBJECTID, b""))
+            fcntl.ioctl(fd, BTRFS_IOC_INO_LOOKUP, args)
+        finally:
+            os.close(fd)
+        treeid, _, _ = INO_LOOKUP_ARGS.unpack(args)
+        return treeid
+
+
+class DirectorySubvolumeBackend(SubvolumeBackend):
+    """
+    Pretend plain directories are subvolumes.
+
+    Lets us test without btrfs, or root.
+    """
+    def snapshot(self, source, destination):
+        shutil.copytree(str(source), str(destination), symlinks=True)
+
+    def delete(self, path):
+        shutil.rmtree(str(path))
+
+    def get_subvolume_id(self, path):
+        return os.stat(str(path)).st_ino
+
+
+def get_subvolume_backend(config):
+    """
+    Get the subvolume backend selected by config.
+    """
+    cls = {
+        "ioctl": IoctlSubvolumeBackend,
+        "sh": ShSubvolumeBackend,
+    }[config.subvolume_backend]
+    return cls(
+        workers=config.subvolume_workers,
+        commit=config.subvolume_commit,
+    )
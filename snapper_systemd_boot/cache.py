@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of snapper configs, snapshots and mount points.
+
+Asking snapper for every snapshot, and then every mount point, over DBUS is
+the slowest part of most commands. Snapshots rarely change between runs so
+they're remembered on disk and only fetched again when the snapshots directory
+has changed.
+"""
+from collections import deque
+from pathlib import Path
+import json
+import logging
+
+
+from snapper_systemd_boot.snapper import SnapperConfig, Snapshot
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path("/var/cache/snapper_systemd_boot")
+SNAPPER_CONFIGS_DIR = Path("/etc/snapper/configs")
+
+
+def get_fingerprint(path):
+    """
+    Cheap summary of a directory that changes when any child changes.
+
+    Returns `None` if the directory can't be read.
+
+    The modification time of the directory changes when children are created
+    or removed, and the modification time of each child changes when snapper
+    rewrites its `info.xml`.
+    """
+    try:
+        fingerprint = [path.stat().st_mtime_ns]
+        for child in sorted(path.iterdir()):
+            fingerprint.append([child.name, child.stat().st_mtime_ns])
+    except OSError as error:
+        DEV_LOGGER.debug("Unable to fingerprint %s: %s", path, error)
+        return None
+    return fingerprint
+
+
+class CachingSnapper:
+    """
+    Wraps a `Snapper`, or `AsyncSnapper`, remembering what it returns on disk.
+
+    `get_snapper` is only called, connecting to DBUS, when the cache can't
+    answer. If `refresh` is true the cache is ignored, though it's still
+    updated.
+    """
+    CACHE_NAME = "snapshots.json"
+
+    def __init__(
+            self,
+            get_snapper,
+            cache_dir=DEFAULT_CACHE_DIR,
+            refresh=False,
+            snapper_configs_dir=SNAPPER_CONFIGS_DIR,
+            ):
+        self._get_snapper = get_snapper
+        self.cache_path = Path(cache_dir) / self.CACHE_NAME
+        self.refresh = refresh
+        self.snapper_configs_dir = Path(snapper_configs_dir)
+        self._cache = None
+
+    @property
+    def snapper(self):
+        return self._get_snapper()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = {"configs": None, "snapshots": {}}
+            if not self.refresh:
+                try:
+                    with self.cache_path.open("r") as cache_file:
+                        self._cache.update(json.load(cache_file))
+                except (OSError, ValueError) as error:
+                    DEV_LOGGER.debug("Not using cache: %s", error)
+        return self._cache
+
+    def save(self):
+        """
+        Write the cache to disk.
+
+        Failing to, for example when not running as root, isn't fatal.
+        """
+        tmp_path = self.cache_path.with_name(self.CACHE_NAME + ".tmp")
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp_path.open("w") as cache_file:
+                json.dump(self.cache, cache_file)
+            tmp_path.replace(self.cache_path)
+        except OSError as error:
+            DEV_LOGGER.warning("Unable to write cache: %s", error)
+
+    def get_configs_iter(self):
+        """
+        Get all snapper configs wrapped in helper class.
+        """
+        fingerprint = get_fingerprint(self.snapper_configs_dir)
+        cached = self.cache["configs"]
+        if (
+                fingerprint is None or
+                cached is None or
+                cached["fingerprint"] != fingerprint):
+            DEV_LOGGER.info("Fetching snapper configs.")
+            configs = [
+                [config.name, str(config.path), config.config]
+                for config in self.snapper.get_configs_iter()
+            ]
+            cached = self.cache["configs"] = {
+                "fingerprint": fingerprint,
+                "configs": configs,
+            }
+            if fingerprint is not None:
+                self.save()
+
+        for config in cached["configs"]:
+            yield SnapperConfig(*config)
+
+    def _get_snapshots_path(self, config_name):
+        for config in self.get_configs_iter():
+            if config.name == config_name:
+                return config.path / ".snapshots"
+        raise KeyError(config_name)
+
+    def list_snapshots(self, config_name):
+        """
+        Get all existing snapshots for config.
+
+        Mount points are included where they're already known.
+        """
+        fingerprint = get_fingerprint(self._get_snapshots_path(config_name))
+        cached = self.cache["snapshots"].get(config_name)
+        if (
+                fingerprint is None or
+                cached is None or
+                cached["fingerprint"] != fingerprint):
+            DEV_LOGGER.info("Fetching snapshots for: %s", config_name)
+            mount_points = {} if cached is None else cached["mount_points"]
+            snapshots = [
+                snapshot.to_raw()
+                for snapshot in self.snapper.list_snapshots(config_name)
+            ]
+            nums = {str(snapshot[0]) for snapshot in snapshots}
+            cached = self.cache["snapshots"][config_name] = {
+                "fingerprint": fingerprint,
+                "snapshots": snapshots,
+                "mount_points": {
+                    num: mount_point
+                    for num, mount_point in mount_points.items()
+                    if num in nums
+                },
+            }
+            if fingerprint is not None:
+                self.save()
+
+        for raw in cached["snapshots"]:
+            snapshot = Snapshot(*raw)
+            mount_point = cached["mount_points"].get(str(snapshot.num))
+            if mount_point is not None:
+                snapshot.mount_point = Path(mount_point)
+            yield snapshot
+
+    def get_snapshot(self, config_name, num):
+        """
+        Get a single snapshot, without its mount point.
+
+        Always asks snapper, as this is used when we know the snapshot has
+        just changed.
+        """
+        return self.snapper.get_snapshot(config_name, num)
+
+    def resolve_mount_points(self, config_name, snapshots):
+        """
+        Discover the mountpoint on filesystem for each snapshot that doesn't
+        already have one.
+
+        Snapshots are yielded in the order given, each as soon as it and
+        every snapshot before it has a mount point, so callers can start on
+        the first while the others are looked up.
+        """
+        waiting = deque(snapshots)
+        unresolved = [
+            snapshot for snapshot in waiting if not snapshot.has_mount_point]
+        while waiting and waiting[0].has_mount_point:
+            yield waiting.popleft()
+        if not unresolved:
+            return
+
+        DEV_LOGGER.info("Fetching %d mount points.", len(unresolved))
+        cached = self.cache["snapshots"].get(config_name)
+        try:
+            for snapshot in self.snapper.resolve_mount_points(
+                    config_name, unresolved):
+                if cached is not None:
+                    cached["mount_points"][str(snapshot.num)] = str(
+                        snapshot.mount_point)
+                # Those before it already had mount points, or were resolved
+                # before it.
+                while waiting[0] is not snapshot:
+                    yield waiting.popleft()
+                yield waiting.popleft()
+            yield from waiting
+        finally:
+            if cached is not None and cached["fingerprint"] is not None:
+                self.save()
+
+    def get_snapshots_iter(self, config_name):
+        """
+        Get all existing snapshots for config.
+
+        Also discover the mountpoint for each snapshot on filesystem.
+        """
+        return self.resolve_mount_points(
+            config_name, self.list_snapshots(config_name))
@@ -2,38 +2,238 @@
 """
 CLI for snapper_systemd_boot
 """
+from datetime import datetime
+from functools import partial
 import json
 import logging
+import sys
 import textwrap
 
 import argh
 
-from snapper_systemd_boot import context
-from snapper_systemd_boot.manager import SnapperSystemDBootManager
+from snapper_systemd_boot import context, profiling
+from snapper_systemd_boot.gc import (
+    DEFAULT_BUDGET,
+    DEFAULT_PAUSE,
+    GarbageCollector,
+    set_idle_io_priority,
+)
+from snapper_systemd_boot.retention import SnapshotFilter
+from snapper_systemd_boot.snapper import SnapshotType
 
 DEV_LOGGER = logging.getLogger(__name__)
 
+OUTPUT_FORMATS = ("text", "jsonl")
+
+# ISO formats `--since` accepts, `datetime.fromisoformat` being newer than
+# Python 3.6.
+SINCE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+
+def check_failures(failures):
+    """
+    Raise `argh.CommandError` describing each `Failure` to write an entry, if
+    there were any.
+    """
+    if failures:
+        raise argh.CommandError("\n".join(
+            [
+                "{:04}: {} failed: {}".format(
+                    failure.item.snapshot.num, failure.stage, failure.error)
+                for failure in failures
+            ] +
+            ["{} entries failed to update.".format(len(failures))]))
+
+
+def run_locked(func, **kwargs):
+    """
+    Call `func` holding the run lock, as `RunLock.run` with `kwargs`.
+
+    Metrics are written for the run, if `METRICS_PATH` is set, unless it was
+    left to a run already in progress.
+    """
+    run = partial(context.get_lock().run, func, **kwargs)
+    metrics = context.get_metrics()
+    if metrics is None:
+        return run()
+    return metrics.run(run)
+
 
 def update():
     """
     Update systemd-boot entries based on snapper snapshots.
+
+    If an update is already running it's left to update again once it's done.
+    Entries that fail are reported once the rest are written.
     """
     DEV_LOGGER.info("Update entries.")
     inst = context.get_manager()
-    inst.remove_boot_configs()
-    inst.write_boot_entries()
+    failures = []
+    run_locked(lambda: failures.extend(inst.update()))
+    check_failures(failures)
+
 
+@argh.arg("--num", type=int, required=True, help="Snapshot number.")
+def add(num=None):
+    """
+    Write, or bring up to date, the entry for a single snapshot.
 
-def remove():
+    Only that snapshot is fetched from snapper, unless there's a retention
+    policy, so it's quick however many snapshots there are. Run by the
+    snapper plugin when a snapshot is created or modified.
+    """
+    DEV_LOGGER.info("Add entry for snapshot %d.", num)
+    inst = context.get_manager()
+    failures = []
+    run_locked(
+        lambda: failures.extend(inst.sync_snapshots([num])),
+        rerun=lambda: failures.extend(inst.update()))
+    check_failures(failures)
+
+
+@argh.arg("--num", type=int, required=True, help="Snapshot number.")
+def drop(num=None):
+    """
+    Remove the entry for a single snapshot, without asking snapper anything.
+
+    As with `update` its writable snapshot and images are left for `gc`. Run
+    by the snapper plugin when a snapshot is deleted.
+    """
+    DEV_LOGGER.info("Drop entry for snapshot %d.", num)
+    inst = context.get_manager()
+    failures = []
+    run_locked(
+        lambda: inst.remove_boot_entry(num),
+        rerun=lambda: failures.extend(inst.update()))
+    check_failures(failures)
+
+
+def plan():
+    """
+    Show the changes `update` would make without making them.
+    """
+    DEV_LOGGER.info("Plan update.")
+    inst = context.get_manager()
+    update_plan = inst.plan_update()
+
+    for entry in update_plan.add:
+        yield "+ {s.num:04}: {s.description}".format(s=entry.snapshot)
+    for entry in update_plan.update:
+        yield "~ {s.num:04}: {s.description}".format(s=entry.snapshot)
+    for num in update_plan.remove:
+        yield "- {:04}".format(num)
+    for failure in update_plan.failed:
+        yield "! {:04}: {}".format(
+            failure.item.snapshot.num, failure.error)
+
+    yield (
+        "{} to add, {} to update, {} unchanged, {} to remove, {} failed."
+    ).format(
+        len(update_plan.add),
+        len(update_plan.update),
+        len(update_plan.unchanged),
+        len(update_plan.remove),
+        len(update_plan.failed))
+
+
+@argh.arg(
+    "--defer-gc",
+    help="Leave writable snapshots and images for a later gc to delete.")
+def remove(defer_gc=False):
     """
     Remove all systemd-boot entries generated from snapper snapshots.
+
+    Waits for any update already running to finish first. Updates asked
+    for meanwhile aren't run afterwards, which would write the entries again.
     """
     DEV_LOGGER.info("Remove existing entries.")
     inst = context.get_manager()
-    snapper = context.get_snapper()
-    config = context.get_config()
-    inst = SnapperSystemDBootManager(snapper, config)
-    inst.remove_boot_configs()
+
+    def run():
+        inst.remove_boot_configs()
+        if not defer_gc:
+            GarbageCollector(inst, budget=None, pause=0).collect()
+
+    run_locked(run, wait=True)
+
+
+@argh.arg(
+    "--budget",
+    type=int,
+    help="Most snapshots and images to delete, or 0 for no limit.")
+@argh.arg(
+    "--pause",
+    type=float,
+    help="Seconds to wait between deleting snapshots.")
+def gc(budget=DEFAULT_BUDGET, pause=DEFAULT_PAUSE):
+    """
+    Delete writable snapshots and images no entry uses any more.
+
+    Runs at idle I/O priority, deleting at most `--budget` things, so it can
+    be run regularly from a timer without slowing anything else down.
+    """
+    DEV_LOGGER.info("Collect garbage.")
+    set_idle_io_priority()
+    inst = context.get_manager()
+    collector = GarbageCollector(inst, budget=budget or None, pause=pause)
+    result = []
+    context.get_lock().run(
+        lambda: result.append(collector.collect()),
+        rerun=inst.update,
+        wait=True)
+    deleted, remaining = result[0]
+    yield "{} deleted, {} left.".format(deleted, remaining)
+
+
+@argh.arg(
+    "--delay",
+    type=float,
+    help="Seconds to wait after a signal for more signals.")
+@argh.arg(
+    "--max-delay",
+    type=float,
+    help="Most seconds to wait after a signal before updating entries.")
+def daemon(delay=2.0, max_delay=30.0):
+    """
+    Keep systemd-boot entries up to date by listening for snapper signals.
+    """
+    from snapper_systemd_boot.daemon import SnapperSignalDaemon
+
+    DEV_LOGGER.info("Starting daemon.")
+    inst = SnapperSignalDaemon(
+        context.get_manager(),
+        delay=delay,
+        max_delay=max_delay,
+        lock=context.get_lock(),
+        metrics=context.get_metrics())
+    inst.run(context.get_bus())
+
+
+def check():
+    """
+    Compare the record of what was generated with what's on disk.
+
+    Exits non-zero if they differ.
+    """
+    DEV_LOGGER.info("Check for drift.")
+    inst = context.get_manager()
+    if not inst.manifest.is_found():
+        yield "No manifest, run update to create one."
+        return
+
+    drift = list(inst.check())
+    for line in drift:
+        yield line
+    if drift:
+        raise argh.CommandError(
+            "{} differences between manifest and disk.".format(len(drift)))
+    yield "No drift."
 
 
 def view_config():
@@ -81,19 +281,113 @@ class SnapshotListWrapper:
         """.format(s=self))
 
 
-def list_snapshots():
+def snapshot_record(snapshot):
+    """
+    Snapshot as a JSON friendly dict.
+    """
+    return {
+        "num": snapshot.num,
+        "type": snapshot.type.name.lower(),
+        "pre_num": snapshot.pre_num,
+        "timestamp": snapshot.iso_timestamp,
+        "uid": snapshot.uid,
+        "description": snapshot.description,
+        "cleanup": snapshot.cleanup,
+        "userdata": snapshot.userdata,
+        "mount_point": (
+            None if snapshot.mount_point is None
+            else str(snapshot.mount_point)),
+    }
+
+
+def parse_since(value):
+    """
+    Parse an ISO date or time given to `--since`.
+    """
+    for since_format in SINCE_FORMATS:
+        try:
+            return datetime.strptime(value, since_format)
+        except ValueError:
+            pass
+    raise ValueError("Not an ISO date or time: {}".format(value))
+
+
+def filter_args(func):
+    """
+    Add the arguments used to build a `SnapshotFilter` to a command.
+    """
+    for decorator in reversed([
+            argh.arg(
+                "--format",
+                dest="output_format",
+                choices=OUTPUT_FORMATS,
+                help="Output format. jsonl writes one JSON object per line."),
+            argh.arg(
+                "--since",
+                type=parse_since,
+                help="Only snapshots created since this ISO date or time."),
+            argh.arg(
+                "--type",
+                dest="snapshot_types",
+                nargs="+",
+                choices=[t.name.lower() for t in SnapshotType],
+                help="Only snapshots of these types."),
+            argh.arg(
+                "--num",
+                nargs="+",
+                type=int,
+                help="Only snapshots with these numbers."),
+            argh.arg(
+                "--limit",
+                type=int,
+                help="At most this many snapshots, newest first."),
+            ]):
+        func = decorator(func)
+    return func
+
+
+def get_snapshot_filter(since, snapshot_types, num, limit):
+    """
+    Build a `SnapshotFilter` from command line arguments, or `None` if there
+    aren't any.
+    """
+    if since is None and snapshot_types is None and num is None and (
+            limit is None):
+        return None
+    return SnapshotFilter(
+        since=since,
+        types=(
+            None if snapshot_types is None
+            else [SnapshotType[name.upper()] for name in snapshot_types]),
+        nums=num,
+        limit=limit,
+    )
+
+
+@filter_args
+def list_snapshots(
+        output_format="text",
+        since=None,
+        snapshot_types=None,
+        num=None,
+        limit=None,
+        ):
     """
     List snapshots that will be converted into entries.
     """
     DEV_LOGGER.info("List applicable snapshots")
     inst = context.get_manager()
-    snapper = context.get_snapper()
-    config = context.get_config()
-    inst = SnapperSystemDBootManager(snapper, config)
+    snapshots = inst.get_snapshots_iter(
+        get_snapshot_filter(since, snapshot_types, num, limit))
+
+    if output_format == "jsonl":
+        for snapshot in snapshots:
+            yield json.dumps(snapshot_record(snapshot))
+        return
 
     yield "Snapshots to make entries:"
 
-    for snapshot in map(SnapshotListWrapper, inst.get_snapshots_iter()):
+    for snapshot in map(SnapshotListWrapper, snapshots):
         yield textwrap.indent(str(snapshot), "  ")
 
 
@@ -103,23 +397,36 @@ def list_generated():
     """
     DEV_LOGGER.info("List generated snapshots")
     inst = context.get_manager()
-    snapper = context.get_snapper()
-    config = context.get_config()
-    inst = SnapperSystemDBootManager(snapper, config)
     for p in inst.get_existing_entries():
         yield str(p)
 
 
-def list_entries():
+@filter_args
+def list_entries(
+        output_format="text",
+        since=None,
+        snapshot_types=None,
+        num=None,
+        limit=None,
+        ):
     """
     List entries that will be written.
     """
     DEV_LOGGER.info("List generated entries.")
     inst = context.get_manager()
-    snapper = context.get_snapper()
-    config = context.get_config()
-    inst = SnapperSystemDBootManager(snapper, config)
-    for entry in inst.get_boot_entries():
+    entries = inst.get_boot_entries(
+        get_snapshot_filter(since, snapshot_types, num, limit))
+
+    if output_format == "jsonl":
+        for entry in entries:
+            yield json.dumps({
+                "num": entry.snapshot.num,
+                "path": str(entry.get_entry_path()),
+                "contents": entry.get_contents(),
+            })
+        return
+
+    for entry in entries:
         yield "Will write to path:"
         yield textwrap.indent(str(entry.get_entry_path()), "  ")
         yield "\nWill write:"
@@ -132,7 +439,13 @@ def main():
     parser = argh.ArghParser()
     parser.add_commands([
         update,
+        add,
+        drop,
+        plan,
         remove,
+        gc,
+        daemon,
+        check,
         view_config,
         list_generated,
         list_snapshots,
@@ -144,12 +457,44 @@ def main():
         default="WARNING",
         help="Set the log level for the process.",
     )
+    parser.add_argument(
+        "--config",
+        action="store",
+        default=context.CONFIG_PATH,
+        help="Path to config file.",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Ignore cached snapshots and ask snapper again.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print how long each phase took to stderr.",
+    )
+    parser.add_argument(
+        "--profile-json",
+        action="store",
+        default=None,
+        help="Also write the profile as JSON to this path.",
+    )
     parser.set_default_command(update)
 
     ns = parser.parse_args()
     logging.basicConfig(level=getattr(logging, ns.log_level))
+    context.CONFIG_PATH = ns.config
+    context.REFRESH_CACHE = ns.refresh_cache
+    profiling.PROFILER.enabled = ns.profile or ns.profile_json is not None
 
-    parser.dispatch()
+    try:
+        with profiling.span("total"):
+            parser.dispatch()
+    finally:
+        if ns.profile:
+            print(profiling.PROFILER.format_report(), file=sys.stderr)
+        if ns.profile_json is not None:
+            profiling.PROFILER.write_json(ns.profile_json)
 
 
 if __name__ == "__main__":
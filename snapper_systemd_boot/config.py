@@ -12,25 +12,38 @@ from pathlib import Path
 import configparser
 
 from reprutils import GetattrRepr
-import pytest
 
+from snapper_systemd_boot.btrfs import SUBVOLUME_BACKENDS
+from snapper_systemd_boot.snapper import SnapshotType
+from snapper_systemd_boot.template import EntryTemplate
+from snapper_systemd_boot.uki import UKI_BUILDERS
 
-@pytest.mark.real_config
-def test_load_example_config():
+DBUS_BACKENDS = ("dbus-python", "asyncio")
+
+# "writable" creates writable snapshots on update, "on-demand" leaves it to
+# the initramfs hook to create them when an entry is booted, and "overlay"
+# boots the read only snapshot with a tmpfs overlay set up by the hook.
+BOOT_MODES = ("writable", "on-demand", "overlay")
+
+# "entry" writes a boot entry file per snapshot booting a kernel and initramfs,
+# "uki" one booting a Unified Kernel Image shared by snapshots with the same
+# kernel and initramfs.
+OUTPUT_MODES = ("entry", "uki")
+
+
+def strtobool(value):
     """
-    Test loading the example config.
-
-    TODO: Add some assertions.
-    TODO: While loading the example config is a useful validation that the
-          makes sense, the validation following the load checks real file
-          locations hence the `real_config` test marker.
-          I could make the example config less "real" and use temporary
-          directories that could be pregenerated but that makes the example
-          less useful.
+    Convert a string representation of truth to `True` or `False`.
+
+    Accepts the same values as the `distutils` function of the same name,
+    which is slow to import and deprecated.
     """
-    config = SnapperSystemDBootConfig.from_filename(
-        "snapper_systemd_boot.conf.example")
-    print(config)
+    value = value.lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError("Invalid truth value: {!r}".format(value))
 
 
 class SnapperSystemDBootConfig:
@@ -50,6 +63,25 @@ class SnapperSystemDBootConfig:
             images_snapshot_dir,
             boot_path,
             root_subvolume,
+            dbus_backend="dbus-python",
+            dbus_concurrency=16,
+            cache_dir="/var/cache/snapper_systemd_boot",
+            subvolume_backend="ioctl",
+            subvolume_workers=1,
+            subvolume_commit="false",
+            retention_newest="",
+            retention_types="",
+            retention_daily_after_days="",
+            lock_dir="/run/snapper_systemd_boot",
+            boot_mode="writable",
+            output_mode="entry",
+            uki_builder="ukify",
+            uki_stub="/usr/lib/systemd/boot/efi/linuxx64.efi.stub",
+            uki_cache_dir="/var/cache/snapper_systemd_boot/uki",
+            uki_cache_size_mb="2048",
+            image_workers="1",
+            pipeline_queue_size="16",
+            metrics_path="",
             ):
         assert not ignore
 
@@ -67,6 +99,7 @@ class SnapperSystemDBootConfig:
 
         self.entry_prefix = entry_prefix
         self.entry_template = entry_template
+        self.compiled_entry_template = EntryTemplate(entry_template)
         self.images_snapshot_dir = Path(images_snapshot_dir)
 
         self.images_snapshot_dir_full = (
@@ -75,6 +108,64 @@ class SnapperSystemDBootConfig:
 
         self.root_subvolume = Path(root_subvolume)
 
+        self.dbus_backend = dbus_backend
+        assert self.dbus_backend in DBUS_BACKENDS
+
+        self.dbus_concurrency = int(dbus_concurrency)
+        assert self.dbus_concurrency > 0
+
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+
+        self.subvolume_backend = subvolume_backend
+        assert self.subvolume_backend in SUBVOLUME_BACKENDS
+
+        self.subvolume_workers = int(subvolume_workers)
+        assert self.subvolume_workers > 0
+
+        self.subvolume_commit = strtobool(str(subvolume_commit))
+
+        self.retention_newest = (
+            int(retention_newest) if retention_newest else None)
+        assert self.retention_newest is None or self.retention_newest >= 0
+
+        self.retention_types = (
+            [
+                SnapshotType[name.strip().upper()]
+                for name in retention_types.split(",")
+            ]
+            if retention_types else None
+        )
+
+        self.retention_daily_after_days = (
+            int(retention_daily_after_days)
+            if retention_daily_after_days else None)
+
+        self.lock_dir = Path(lock_dir)
+
+        self.boot_mode = boot_mode
+        assert self.boot_mode in BOOT_MODES
+
+        self.output_mode = output_mode
+        assert self.output_mode in OUTPUT_MODES
+
+        self.uki_builder = uki_builder
+        assert self.uki_builder in UKI_BUILDERS
+
+        self.uki_stub = Path(uki_stub)
+        self.uki_cache_dir = Path(uki_cache_dir)
+
+        self.uki_cache_size_mb = int(uki_cache_size_mb)
+        assert self.uki_cache_size_mb > 0
+
+        self.image_workers = int(image_workers)
+        assert self.image_workers > 0
+
+        self.pipeline_queue_size = int(pipeline_queue_size)
+        assert self.pipeline_queue_size > 0
+
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        assert self.metrics_path is None or self.metrics_path.suffix == ".prom"
+
     @classmethod
     def from_filename(cls, filename):
         """
@@ -94,4 +185,23 @@ class SnapperSystemDBootConfig:
         images_snapshot_dir="images_snapshot_dir",
         boot_path="boot_path",
         root_subvolume="root_subvolume",
+        dbus_backend="dbus_backend",
+        dbus_concurrency="dbus_concurrency",
+        cache_dir="cache_dir",
+        subvolume_backend="subvolume_backend",
+        subvolume_workers="subvolume_workers",
+        subvolume_commit="subvolume_commit",
+        retention_newest="retention_newest",
+        retention_types="retention_types",
+        retention_daily_after_days="retention_daily_after_days",
+        lock_dir="lock_dir",
+        boot_mode="boot_mode",
+        output_mode="output_mode",
+        uki_builder="uki_builder",
+        uki_stub="uki_stub",
+        uki_cache_dir="uki_cache_dir",
+        uki_cache_size_mb="uki_cache_size_mb",
+        image_workers="image_workers",
+        pipeline_queue_size="pipeline_queue_size",
+        metrics_path="metrics_path",
     )
@@ -1,38 +1,72 @@
 # -*- coding: utf-8 -*-
 """
 Process context
+
+DBUS is only imported, and connected to, when first needed so commands that
+don't talk to snapper start quickly.
 """
-from dbus.mainloop.glib import DBusGMainLoop
-import dbus
 from functools import lru_cache
 
-import gi
-
+from snapper_systemd_boot.cache import CachingSnapper
 from snapper_systemd_boot.config import SnapperSystemDBootConfig
+from snapper_systemd_boot.lock import RunLock
 from snapper_systemd_boot.manager import SnapperSystemDBootManager
+from snapper_systemd_boot.metrics import MetricsExporter
 from snapper_systemd_boot.snapper import Snapper
 
-gi.require_version("Gtk", "3.0")
-gi.require_version("GtkSource", "3.0")
+# Set from the command line.
+CONFIG_PATH = "/etc/snapper_systemd_boot.conf"
+# Ignore any cached snapshots.
+REFRESH_CACHE = False
 
 
 @lru_cache()
 def get_bus():
+    from dbus.mainloop.glib import DBusGMainLoop
+    import dbus
     return dbus.SystemBus(mainloop=DBusGMainLoop())
 
 
 @lru_cache()
 def get_config():
-    return SnapperSystemDBootConfig.from_filename(
-        "/etc/snapper_systemd_boot.conf")
+    return SnapperSystemDBootConfig.from_filename(CONFIG_PATH)
 
 
 @lru_cache()
-def get_snapper():
+def get_dbus_snapper():
+    config = get_config()
+    if config.dbus_backend == "asyncio":
+        from snapper_systemd_boot.snapper_async import AsyncSnapper
+        return AsyncSnapper(concurrency=config.dbus_concurrency)
     return Snapper(get_bus())
 
 
+@lru_cache()
+def get_snapper():
+    config = get_config()
+    if config.cache_dir is None:
+        return get_dbus_snapper()
+    return CachingSnapper(
+        get_dbus_snapper, config.cache_dir, refresh=REFRESH_CACHE)
+
+
+@lru_cache()
+def get_lock():
+    return RunLock(get_config().lock_dir)
+
+
 @lru_cache()
 def get_manager():
     return SnapperSystemDBootManager(
         get_snapper(), get_config())
+
+
+@lru_cache()
+def get_metrics():
+    """
+    Get the `MetricsExporter`, or `None` if metrics aren't exported.
+    """
+    manager = get_manager()
+    if manager.config.metrics_path is None:
+        return None
+    return MetricsExporter(manager.config.metrics_path, manager)
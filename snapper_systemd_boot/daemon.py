@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Keep boot entries in sync by listening for snapper DBUS signals.
+
+Snapper emits a signal whenever a snapshot is created, modified or deleted.
+Signals often arrive in bursts, timeline cleanup can delete dozens of snapshots
+at once, so rather than reacting to each signal they're collected and handled
+together once things go quiet.
+"""
+from functools import partial
+import logging
+import time
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot.snapper import BUS_NAME, INTERFACE, OBJECT_PATH
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_DELAY = 2.0
+DEFAULT_MAX_DELAY = 30.0
+
+
+class GLibTimer:
+    """
+    Schedule callbacks on the GLib main loop.
+    """
+    def add(self, delay, callback):
+        from gi.repository import GLib
+
+        def once():
+            callback()
+            return False
+
+        return GLib.timeout_add(int(delay * 1000), once)
+
+    def remove(self, handle):
+        from gi.repository import GLib
+        GLib.source_remove(handle)
+
+
+class SnapperSignalDaemon:
+    """
+    Sync boot entries for snapshots named in snapper signals.
+
+    Changes are handled `delay` seconds after the last signal, but never more
+    than `max_delay` seconds after the first unhandled one.
+
+    If given a `RunLock`, changes are made holding it, and any update
+    requested meanwhile done afterwards. If given a `MetricsExporter`, metrics
+    are written after each change.
+    """
+    def __init__(
+            self,
+            manager,
+            delay=DEFAULT_DELAY,
+            max_delay=DEFAULT_MAX_DELAY,
+            timer=None,
+            lock=None,
+            metrics=None,
+            ):
+        self.manager = manager
+        self.lock = lock
+        self.metrics = metrics
+        self.delay = delay
+        self.max_delay = max_delay
+        self.timer = GLibTimer() if timer is None else timer
+        self.config_name = manager.get_root_config().name
+
+        self.pending = set()
+        self._first_pending = None
+        self._timer_handle = None
+
+    def subscribe(self, bus):
+        """
+        Listen for snapper signals on `bus`.
+        """
+        for signal_name, handler in [
+                ("SnapshotCreated", self.on_snapshot_created),
+                ("SnapshotModified", self.on_snapshot_modified),
+                ("SnapshotsDeleted", self.on_snapshots_deleted),
+                ]:
+            bus.add_signal_receiver(
+                handler,
+                signal_name=signal_name,
+                dbus_interface=INTERFACE,
+                bus_name=BUS_NAME,
+                path=OBJECT_PATH,
+            )
+
+    def run(self, bus):
+        """
+        Bring entries up to date, then keep them up to date until killed.
+        """
+        from gi.repository import GLib
+
+        self.subscribe(bus)
+        DEV_LOGGER.info("Initial update.")
+        self._locked(self.manager.update)
+        DEV_LOGGER.info("Waiting for snapper signals.")
+        GLib.MainLoop().run()
+
+    def on_snapshot_created(self, config_name, num):
+        self._add_pending(config_name, [num])
+
+    def on_snapshot_modified(self, config_name, num):
+        self._add_pending(config_name, [num])
+
+    def on_snapshots_deleted(self, config_name, nums):
+        self._add_pending(config_name, nums)
+
+    def _add_pending(self, config_name, nums):
+        if str(config_name) != self.config_name:
+            return
+        DEV_LOGGER.debug("Snapshots changed: %s", list(nums))
+        self.pending.update(int(num) for num in nums)
+
+        now = time.monotonic()
+        if self._first_pending is None:
+            self._first_pending = now
+        if self._timer_handle is not None:
+            self.timer.remove(self._timer_handle)
+        delay = min(self.delay, self._first_pending + self.max_delay - now)
+        self._timer_handle = self.timer.add(max(delay, 0), self.flush)
+
+    def flush(self):
+        """
+        Sync every snapshot we've had a signal for.
+        """
+        nums = self.pending
+        self.pending = set()
+        self._first_pending = None
+        self._timer_handle = None
+
+        DEV_LOGGER.info("Syncing snapshots: %s", sorted(nums))
+        try:
+            self._locked(lambda: self.manager.sync_snapshots(nums))
+        except Exception:
+            DEV_LOGGER.exception("Failed to sync snapshots: %s", sorted(nums))
+
+    def _locked(self, func):
+        """
+        Call `func` as a run, holding the lock if there is one.
+
+        The manager lives as long as the daemon, while the snapper plugin and
+        package hooks change entries too, so it reloads what's on disk once
+        the lock is held.
+        """
+        def run():
+            self.manager.reload()
+            func()
+
+        if self.lock is not None:
+            run = partial(
+                self.lock.run, run, rerun=self.manager.update, wait=True)
+        if self.metrics is None:
+            run()
+        else:
+            self.metrics.run(run)
+
+    __repr__ = GetattrRepr(
+        "manager",
+        delay="delay",
+        max_delay="max_delay",
+    )
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Write files to the EFI system partition (ESP).
+
+The ESP is usually vfat, often on cheap flash, so writing files in place risks
+truncated entries if we crash or lose power, and syncing each file separately
+is slow. Instead files are staged under temporary names and moved into place
+together, syncing the whole filesystem once before and once after.
+
+Flash also wears with every write, so files already on the ESP with the same
+contents aren't written again.
+
+Images are tens of megabytes, so they're copied with `copy_file_range`, or
+`sendfile`, keeping the data in the kernel, and then checked against the
+digest they're expected to have so a bad copy never gets booted.
+"""
+from contextlib import contextmanager
+from pathlib import Path
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot import profiling
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+# vfat only stores modification times to the nearest 2 seconds.
+MTIME_TOLERANCE_NS = 2 * 10 ** 9
+
+CHUNK_SIZE = 1024 * 1024
+
+# Most to ask the kernel to copy at once.
+MAX_COPY_SIZE = 1024 ** 3
+
+# Errors meaning a zero copy method isn't supported for these files.
+UNSUPPORTED_ERRNOS = frozenset([
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+])
+
+
+def syncfs(path):
+    """
+    Flush the filesystem containing `path` to disk.
+
+    Falls back to syncing every filesystem if `syncfs` isn't available.
+    """
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        if getattr(libc, "syncfs", None) is None or libc.syncfs(fd) != 0:
+            DEV_LOGGER.debug("syncfs failed, falling back to sync.")
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+def file_digest(path):
+    """
+    Get the sha256 hex digest of the contents of `path`.
+    """
+    sha256 = hashlib.sha256()
+    with open(str(path), "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_json(path):
+    """
+    Load the JSON file at `path`, returning it and the sha256 hex digest of
+    the file, or `(None, None)` if there's no file.
+
+    Pass the digest to `check_unchanged` before writing the file back.
+    """
+    try:
+        data = Path(path).read_bytes()
+    except FileNotFoundError:
+        return None, None
+    return json.loads(data.decode()), hashlib.sha256(data).hexdigest()
+
+
+def check_unchanged(path, digest):
+    """
+    Raise `RuntimeError` unless the file at `path` still has the sha256 hex
+    `digest` it was loaded with, or still doesn't exist if `digest` is `None`.
+
+    A file loaded once and written back later would otherwise overwrite
+    whatever another run wrote meanwhile.
+    """
+    try:
+        current = file_digest(path)
+    except FileNotFoundError:
+        current = None
+    if current != digest:
+        raise RuntimeError(
+            "Changed by another run since it was loaded: {}".format(path))
+
+
+def _copy_range(source_fd, destination_fd, offset, count, method):
+    if method == "copy_file_range":
+        return os.copy_file_range(source_fd, destination_fd, count)
+    return os.sendfile(destination_fd, source_fd, offset, count)
+
+
+def copy_file(source, destination):
+    """
+    Copy `source` to `destination` without the data leaving the kernel.
+
+    Tries `copy_file_range`, then `sendfile`, falling back to an ordinary copy
+    if neither is supported. Either may copy less than asked, so they're
+    called until everything is copied.
+
+    Returns the number of bytes copied.
+    """
+    methods = [
+        name for name in ("copy_file_range", "sendfile") if hasattr(os, name)]
+
+    with open(str(source), "rb") as source_file, \
+            open(str(destination), "wb") as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        size = os.fstat(source_fd).st_size
+
+        offset = 0
+        while offset < size and methods:
+            try:
+                copied = _copy_range(
+                    source_fd, destination_fd, offset,
+                    min(size - offset, MAX_COPY_SIZE), methods[0])
+            except OSError as error:
+                if error.errno not in UNSUPPORTED_ERRNOS or offset:
+                    raise
+                DEV_LOGGER.debug(
+                    "%s not supported, %s -> %s",
+                    methods.pop(0), source, destination)
+                continue
+            if copied == 0:
+                break
+            offset += copied
+
+        if not methods:
+            shutil.copyfileobj(source_file, destination_file, CHUNK_SIZE)
+            offset = destination_file.tell()
+
+    if offset != size:
+        raise ValueError("Short copy, {} of {} bytes: {} -> {}".format(
+            offset, size, source, destination))
+    return offset
+
+
+def _same_contents(path_a, path_b):
+    """
+    Do two files of the same size have the same contents?
+    """
+    with open(str(path_a), "rb") as file_a, open(str(path_b), "rb") as file_b:
+        while True:
+            chunk_a = file_a.read(CHUNK_SIZE)
+            if chunk_a != file_b.read(CHUNK_SIZE):
+                return False
+            if not chunk_a:
+                return True
+
+
+def is_unchanged_text(path, data):
+    """
+    Does the file at `path` already contain `data`, as bytes?
+    """
+    try:
+        if path.stat().st_size != len(data):
+            return False
+        return path.read_bytes() == data
+    except FileNotFoundError:
+        return False
+
+
+def is_unchanged_copy(source, path):
+    """
+    Is the file at `path` already a copy of `source`?
+
+    Files of a different size differ, files the same size and modified at
+    the same time, which copies are, are taken to be the same. Only if the
+    sizes match but the times don't are the contents compared.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    source_stat = os.stat(str(source))
+    if stat.st_size != source_stat.st_size:
+        return False
+    if abs(stat.st_mtime_ns - source_stat.st_mtime_ns) < MTIME_TOLERANCE_NS:
+        return True
+    return _same_contents(source, path)
+
+
+class EspWriter:
+    """
+    Stage files to write to the ESP and then move them into place together.
+
+    Use as a context manager to commit the staged files on success, and
+    discard them on error.
+
+    Files can be staged from several threads at once.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._staged = {}
+        self.written = 0
+        self.skipped = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def _get_tmp_path(path):
+        return path.with_name(".{}.tmp".format(path.name))
+
+    def _skip(self, path, size):
+        DEV_LOGGER.debug("Unchanged, not writing: %s", path)
+        with self._lock:
+            self.skipped += 1
+            self.bytes_saved += size
+        profiling.count("esp.files_skipped")
+        profiling.count("esp.bytes_saved", size)
+
+    def is_staged(self, path):
+        """
+        Has a file already been staged to write to `path`?
+        """
+        return Path(path) in self._staged
+
+    @profiling.timed("esp.write_text")
+    def write_text(self, path, contents):
+        """
+        Stage writing `contents` to `path`, unless it already contains them.
+        """
+        path = Path(path)
+        data = contents.encode()
+        if is_unchanged_text(path, data):
+            self._skip(path, len(data))
+            return
+        tmp_path = self._get_tmp_path(path)
+        tmp_path.write_bytes(data)
+        with self._lock:
+            self._staged[path] = tmp_path
+
+    @profiling.timed("esp.copy_file")
+    def copy_file(self, source, path, digest=None):
+        """
+        Stage copying the file at `source` to `path`, unless it's already a
+        copy.
+
+        The copy is checked against `digest`, its expected sha256, or the
+        contents of `source` if not given, raising `ValueError` if it
+        doesn't match.
+
+        The copy keeps the modification time of `source` so it can be
+        recognised as unchanged next time.
+        """
+        path = Path(path)
+        if is_unchanged_copy(source, path):
+            self._skip(path, os.stat(str(source)).st_size)
+            return
+        tmp_path = self._get_tmp_path(path)
+        try:
+            copy_file(source, tmp_path)
+            with profiling.span("esp.verify"):
+                if digest is None:
+                    verified = _same_contents(source, tmp_path)
+                else:
+                    verified = file_digest(tmp_path) == digest
+            if not verified:
+                raise ValueError("Copy doesn't match source: {} -> {}".format(
+                    source, path))
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        source_stat = os.stat(str(source))
+        os.utime(
+            str(tmp_path),
+            ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        with self._lock:
+            self._staged[path] = tmp_path
+
+    @profiling.timed("esp.commit")
+    def commit(self):
+        """
+        Move every staged file into place.
+
+        The filesystem is synced before the files are renamed, so no file is
+        renamed into place before its contents are on disk, and again after
+        so the renames are.
+        """
+        if self.skipped:
+            DEV_LOGGER.info(
+                "Skipped %d unchanged files, saving %d bytes.",
+                self.skipped, self.bytes_saved)
+        if not self._staged:
+            return
+        DEV_LOGGER.info(
+            "Committing %d files to: %s", len(self._staged), self.path)
+        syncfs(self.path)
+        size = 0
+        for path, tmp_path in self._staged.items():
+            size += tmp_path.stat().st_size
+            os.replace(str(tmp_path), str(path))
+        self.written += len(self._staged)
+        profiling.count("esp.files_written", len(self._staged))
+        profiling.count("esp.bytes_written", size)
+        self._staged = {}
+        syncfs(self.path)
+
+    def abort(self):
+        """
+        Discard every staged file.
+        """
+        for tmp_path in self._staged.values():
+            if tmp_path.exists():
+                tmp_path.unlink()
+        self._staged = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    __repr__ = GetattrRepr(
+        path="path",
+        written="written",
+        skipped="skipped",
+        bytes_saved="bytes_saved",
+    )
+
+
+@contextmanager
+def staging(writer, path):
+    """
+    Use `writer` if there is one, otherwise a new `EspWriter` for `path` that's
+    committed on exit.
+    """
+    if writer is not None:
+        yield writer
+        return
+    with EspWriter(path) as writer:
+        yield writer
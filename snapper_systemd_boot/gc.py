@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Delete writable snapshots, images and UKIs no entry uses any more.
+
+Deleting subvolumes is slow, and the btrfs cleaner work that follows can stall
+the whole machine, so `update` and `remove` only remove entries and leave the
+rest to be collected later, from a timer, at idle I/O priority and a few
+deletions at a time.
+"""
+import logging
+import platform
+import time
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot import profiling
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 8
+DEFAULT_PAUSE = 1.0
+
+# From linux/ioprio.h.
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# Python doesn't wrap ioprio_set so it's called by number.
+SYS_IOPRIO_SET = {
+    "aarch64": 30,
+    "armv7l": 314,
+    "i686": 289,
+    "x86_64": 251,
+}
+
+
+def set_idle_io_priority():
+    """
+    Only do I/O when nothing else wants the disk.
+
+    Returns whether the priority was set.
+    """
+    import ctypes
+
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        DEV_LOGGER.warning(
+            "Don't know how to set I/O priority on %s.", platform.machine())
+        return False
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(
+            number,
+            IOPRIO_WHO_PROCESS,
+            0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        DEV_LOGGER.warning(
+            "Unable to set idle I/O priority: errno %d", ctypes.get_errno())
+        return False
+    return True
+
+
+class GarbageCollector:
+    """
+    Deletes at most `budget` orphaned snapshots, unused images and UKIs per
+    run, pausing `pause` seconds between snapshots so the btrfs cleaner keeps
+    up.
+
+    A `budget` of `None` deletes everything.
+    """
+    def __init__(
+            self,
+            manager,
+            budget=DEFAULT_BUDGET,
+            pause=DEFAULT_PAUSE,
+            sleep=time.sleep,
+            ):
+        self.manager = manager
+        self.budget = budget
+        self.pause = pause
+        self.sleep = sleep
+
+    def find_garbage(self):
+        """
+        Get the orphaned snapshots, and the unused images and UKIs, as lists
+        of paths.
+        """
+        return (
+            self.manager.find_orphan_snapshots(),
+            self.manager.image_store.get_unused_blob_paths() +
+            self.manager.find_unused_ukis(),
+        )
+
+    def collect(self):
+        """
+        Delete garbage, within budget.
+
+        Returns how many things were deleted and how many are left.
+        """
+        self.manager.reload()
+        snapshots, images = self.find_garbage()
+        garbage = [(True, p) for p in snapshots] + [(False, p) for p in images]
+        if self.budget is not None:
+            garbage = garbage[:self.budget]
+
+        deleted_snapshot = False
+        for is_snapshot, path in garbage:
+            if is_snapshot:
+                if deleted_snapshot and self.pause:
+                    self.sleep(self.pause)
+                DEV_LOGGER.info("Deleting orphaned snapshot: %s", path)
+                with profiling.span("gc.snapshot"):
+                    self.manager.subvolume_backend.delete(path)
+                profiling.count("gc.snapshots_deleted")
+                deleted_snapshot = True
+            else:
+                DEV_LOGGER.info("Deleting unused image: %s", path)
+                path.unlink()
+                profiling.count("gc.images_deleted")
+
+        deleted = len(garbage)
+        remaining = len(snapshots) + len(images) - deleted
+        if remaining:
+            DEV_LOGGER.info("Leaving %d for the next run.", remaining)
+        else:
+            self._remove_empty_dir()
+        return deleted, remaining
+
+    def _remove_empty_dir(self):
+        writable_snapshot_dir = self.manager.writable_snapshot_dir
+        if writable_snapshot_dir.is_dir() and not any(
+                writable_snapshot_dir.iterdir()):
+            writable_snapshot_dir.rmdir()
+
+    __repr__ = GetattrRepr(
+        budget="budget",
+        pause="pause",
+    )
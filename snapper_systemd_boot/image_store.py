@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed store for kernel and initramfs images copied to the boot
+partition.
+
+Most snapshots share the same kernel and initramfs so rather than copying the
+images once per snapshot each distinct image is stored once, named after a hash
+of its contents. An index records which entries use which images so images no
+longer used by any entry can be removed.
+"""
+from pathlib import Path
+import hashlib
+import json
+import logging
+import re
+import threading
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot import profiling
+from snapper_systemd_boot.esp import (
+    check_unchanged, file_digest, load_json, staging)
+from snapper_systemd_boot.pipeline import KeyedLock
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+# Names `ImageStore.get_blob_name` gives blobs, and not e.g. the hidden
+# `.<name>.tmp` files an interrupted `EspWriter` leaves behind.
+BLOB_NAME_PATTERN = re.compile(r"[^.].*-[0-9a-f]{64}(\.[^.]+)?")
+
+
+class ImageStore:
+    """
+    Stores each distinct image once, named by the hash of its contents.
+
+    The index is loaded lazily and is only written by `save`, which, as with
+    `Manifest.save`, refuses to overwrite an index another run saved since.
+
+    Methods that write take an optional `EspWriter` to stage writes to, if one
+    isn't given they're written straight away.
+
+    Images can be added from several threads at once, each distinct image is
+    still only copied once.
+    """
+    INDEX_NAME = "index.json"
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._index = None
+        self._digest = None
+        self._lock = threading.Lock()
+        self._blob_lock = KeyedLock()
+
+    def reload(self):
+        """
+        Forget the index, so it's loaded again from disk when next used.
+        """
+        with self._lock:
+            self._index = None
+            self._digest = None
+
+    @property
+    def index_path(self):
+        return self.directory / self.INDEX_NAME
+
+    @property
+    def index(self):
+        """
+        Index of which blobs each entry uses, and the digests of sources we've
+        already hashed.
+        """
+        with self._lock:
+            if self._index is None:
+                index = {"entries": {}, "sources": {}}
+                loaded, self._digest = load_json(self.index_path)
+                index.update(loaded or {})
+                self._index = index
+        return self._index
+
+    def get_digest(self, source):
+        """
+        Get the hash of the contents of `source`.
+
+        Hashing an initramfs isn't free, so digests are remembered in the index
+        against the source's size and mtime.
+        """
+        source = Path(source)
+        stat = source.stat()
+        key = [stat.st_size, stat.st_mtime_ns]
+
+        cached = self.index["sources"].get(str(source))
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+
+        with profiling.span("images.digest"):
+            digest = file_digest(source)
+
+        self.index["sources"][str(source)] = key + [digest]
+        return digest
+
+    def get_blob_name(self, source, digest=None):
+        """
+        Get the filename the contents of `source` are stored under, given
+        their sha256 `digest` if it's already known.
+
+        E.g. `initramfs-linux.img` becomes `initramfs-linux-<sha256>.img`.
+        """
+        source = Path(source)
+        if digest is None:
+            digest = self.get_digest(source)
+        return "{stem}-{digest}{suffix}".format(
+            stem=source.stem,
+            digest=digest,
+            suffix=source.suffix)
+
+    def get_blob_paths(self):
+        """
+        All blobs in the store.
+        """
+        if not self.directory.is_dir():
+            return
+        for p in self.directory.iterdir():
+            if BLOB_NAME_PATTERN.fullmatch(p.name):
+                yield p
+
+    def add(self, num, sources, writer=None):
+        """
+        Store images for snapshot `num`, copying only those not already
+        stored.
+
+        Returns the blob names of the images.
+        """
+        self.directory.mkdir(exist_ok=True)
+        names = []
+        with staging(writer, self.directory) as writer:
+            for source in sources:
+                name = self.get_blob_name(source)
+                blob_path = self.directory / name
+                with self._blob_lock(name):
+                    if blob_path.is_file() or writer.is_staged(blob_path):
+                        DEV_LOGGER.info("Reusing stored image: %s", blob_path)
+                    else:
+                        DEV_LOGGER.info(
+                            "Storing image: %s -> %s", source, blob_path)
+                        writer.copy_file(
+                            source, blob_path, digest=self.get_digest(source))
+                names.append(name)
+
+        self.index["entries"][str(num)] = names
+        return names
+
+    def has_images(self, num, names):
+        """
+        Check snapshot `num` references exactly `names` and they're stored.
+        """
+        return (
+            self.index["entries"].get(str(num)) == list(names) and
+            all((self.directory / name).is_file() for name in names)
+        )
+
+    def release(self, num):
+        """
+        Record that snapshot `num` no longer uses any images.
+        """
+        self.index["entries"].pop(str(num), None)
+
+    def get_referenced(self):
+        """
+        Names of blobs used by at least one entry.
+        """
+        return {
+            name
+            for names in self.index["entries"].values()
+            for name in names
+        }
+
+    def get_unused_blob_paths(self):
+        """
+        Paths of blobs no entry uses.
+        """
+        referenced = self.get_referenced()
+        return [p for p in self.get_blob_paths() if p.name not in referenced]
+
+    def save(self, writer=None):
+        """
+        Write the index to disk.
+
+        Digests of sources that no longer back a referenced blob are dropped
+        so the index doesn't grow forever.
+        """
+        if self._index is None:
+            return
+        referenced = self.get_referenced()
+        self._index["sources"] = {
+            source: cached
+            for source, cached in self._index["sources"].items()
+            if self.get_blob_name(source, cached[2]) in referenced
+        }
+        check_unchanged(self.index_path, self._digest)
+        contents = json.dumps(self._index, indent=2, sort_keys=True)
+        self.directory.mkdir(exist_ok=True)
+        with staging(writer, self.directory) as writer:
+            writer.write_text(self.index_path, contents)
+        self._digest = hashlib.sha256(contents.encode()).hexdigest()
+
+    __repr__ = GetattrRepr(
+        directory="directory",
+    )
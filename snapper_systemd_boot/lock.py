@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Stop runs racing each other.
+
+One pacman transaction, and the snapper hooks around it, can start several
+updates in quick succession. Rather than each waiting its turn to do the same
+full update, a run that finds another in progress marks the work "dirty" and
+returns, and the run in progress does one more pass once it's finished.
+"""
+from pathlib import Path
+import fcntl
+import logging
+import os
+
+from reprutils import GetattrRepr
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+
+class RunLock:
+    """
+    Exclusive lock, with a dirty flag to coalesce runs, kept in `directory`.
+    """
+    LOCK_NAME = "lock"
+    DIRTY_NAME = "dirty"
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    @property
+    def lock_path(self):
+        return self.directory / self.LOCK_NAME
+
+    @property
+    def dirty_path(self):
+        return self.directory / self.DIRTY_NAME
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return os.open(str(self.lock_path), os.O_RDWR | os.O_CREAT, 0o644)
+
+    @staticmethod
+    def _try_lock(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _mark_dirty(self):
+        self.dirty_path.touch()
+
+    def _clear_dirty(self):
+        """
+        Clear the dirty flag, returning whether it was set.
+        """
+        try:
+            self.dirty_path.unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def run(self, func, rerun=None, wait=False):
+        """
+        Call `func` holding the lock.
+
+        If another run holds the lock then, if `wait`, wait for it to finish.
+        Otherwise mark dirty and return `False` straight away, leaving the
+        other run to do one more pass.
+
+        Any dirty flag left from before is cleared on taking the lock, as this
+        run is already what it asked for. Once `func` returns, `rerun`, by
+        default `func` again, is called for as long as another run marked
+        dirty meanwhile. Returns `True`.
+        """
+        fd = self._open()
+        try:
+            if wait:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            elif not self._try_lock(fd):
+                self._mark_dirty()
+                # The holder may have released the lock since, before seeing
+                # the flag, in which case it's our turn.
+                if not self._try_lock(fd):
+                    DEV_LOGGER.info(
+                        "Another run is in progress, leaving it to run again.")
+                    return False
+
+            if rerun is None:
+                rerun = func
+            # This run does whatever anyone was waiting for.
+            self._clear_dirty()
+            func()
+            while self._clear_dirty():
+                DEV_LOGGER.info("Marked dirty while running, running again.")
+                rerun()
+        finally:
+            os.close(fd)
+
+        # Someone may have marked dirty after our last check, but before we
+        # released the lock.
+        if self.dirty_path.exists():
+            self.run(rerun)
+        return True
+
+    __repr__ = GetattrRepr(
+        directory="directory",
+    )
@@ -2,57 +2,43 @@
 """
 Main module for managing systemd-boot entries from snapper snapshots.
 """
+from functools import partial
 from pathlib import Path
 import logging
-import shutil
+import os
 
-from distutils.util import strtobool
-import pytest
-import sh
+from reprutils import GetattrRepr
 
-DEV_LOGGER = logging.getLogger(__name__)
-
-
-@pytest.fixture
-def inst(snapper, config):
-    return SnapperSystemDBootManager(snapper, config)
-
-
-@pytest.mark.real_config
-def test_get_root_config(inst):
-    """
-    Check we can access root snapper config.
-
-    I.e. use the real snapper dbus interface and try and locate the config used
-    to back up the root path `/`.
-    """
-    root_config = inst.get_root_config()
-    name, path, config = inst.snapper.snapper.GetConfig(root_config.name)
-
-    assert name == root_config.name
-    assert path == str(root_config.path) == "/"
+from snapper_systemd_boot import profiling
+from snapper_systemd_boot.btrfs import get_subvolume_backend
+from snapper_systemd_boot.config import BOOT_MODES, strtobool
+from snapper_systemd_boot.esp import EspWriter, staging
+from snapper_systemd_boot.image_store import ImageStore
+from snapper_systemd_boot.manifest import (
+    MANIFEST_NAME, Manifest, get_contents_digest)
+from snapper_systemd_boot.pipeline import Failure, KeyedLock, Pipeline, Stage
+from snapper_systemd_boot.retention import RetentionPolicy
+from snapper_systemd_boot.template import SNAPSHOT_FIELDS
+from snapper_systemd_boot.uki import (
+    OS_RELEASE,
+    UKI_BUILDERS,
+    UKI_DIR,
+    UkiCache,
+    get_uki_entry,
+    get_uki_name,
+)
 
+DEV_LOGGER = logging.getLogger(__name__)
 
-@pytest.mark.real_config
-@pytest.mark.dangerous
-def test_write_entries(inst):
-    """
-    Run entry generation and write to disk.
-
-    TODO: This is only barely a test. Actually assert on something!
-    """
-    inst.write_boot_entries()
+ENTRY_NAME = "{prefix}{num}.conf"
 
 
-@pytest.mark.real_config
-def test_generate_entries(inst):
+def get_entry_path(config, num):
     """
-    Test generation of entries.
-
-    TODO: This is only barely a test. Actually assert on something!
+    Path the entry for snapshot `num` is written to.
     """
-    for entry in inst.get_boot_entries():
-        print(entry)
+    name = ENTRY_NAME.format(prefix=config.entry_prefix, num=num)
+    return config.systemd_entries_path / name
 
 
 class BootEntry:
@@ -62,61 +48,38 @@ class BootEntry:
     Manges a single boot entry, generated from a single snapper snapshot.
     """
 
-    class EntryTemplateContext:
-        """
-        This class wraps the entry and snapshot to provide some additional
-        useful variables when processing the entry templates.
-        """
-        def __init__(self, entry, snapshot):
-            self.entry = entry
-            self.snapshot = snapshot
-
-        @property
-        def title_suffix(self):
-            """
-            A shortish string including the snapshot timestamp and description
-            to be used in titles for boot entries.
-            """
-            MAX_DESCRIPTION_LENGTH = 20
-            ELLIPSIS = "..."
-
-            # Frustratingly textwrap.shorten breaks only between wrods so nasty
-            # hack instead.
-            short_description = (
-                self.snapshot.description
-                if len(self.snapshot.description) < MAX_DESCRIPTION_LENGTH else
-                (
-                    self.snapshot.description[
-                        :MAX_DESCRIPTION_LENGTH - len(ELLIPSIS)] + ELLIPSIS)
-            )
-
-            snapped_images = (
-                "[snapped images]" if self.entry.copy_images else "")
-
-            return (
-                "{short_description} "
-                "({self.snapshot.iso_timestamp}){snapped_images}").format(
-                    self=self,
-                    snapped_images=snapped_images,
-                    short_description=short_description)
-
-        def __getattr__(self, name):
-            """
-            Forward getattr to inner snapshot and entry.
-
-            Bit hacky, but conveniant for writing templates.
-            """
-            if hasattr(self.snapshot, name):
-                return getattr(self.snapshot, name)
+    def __init__(self, snapshot, config, image_store=None, uki_cache=None):
+        self.snapshot = snapshot
+        self.config = config
+        if image_store is None:
+            image_store = ImageStore(config.images_snapshot_dir_full)
+        self.image_store = image_store
+        if uki_cache is None:
+            uki_cache = UkiCache(
+                config.uki_cache_dir, config.uki_cache_size_mb * 1024 ** 2)
+        self.uki_cache = uki_cache
 
-            if hasattr(self.entry, name):
-                return getattr(self.entry, name)
+        # Should we use a frozen copy of the kernel and initramfs image or not.
+        # Used by most other properties so only worked out once.
+        self.copy_images = strtobool(
+            self.snapshot.get_userdata("copy_images", "false")
+        )
+        self._contents = None
+        self._uki_key = None
 
-            raise AttributeError(name)
+    @property
+    def kernel_image_source(self):
+        """
+        The kernel image inside the snapshot.
+        """
+        return self.snapshot.mount_point / self.config.kernel_image_source
 
-    def __init__(self, snapshot, config):
-        self.snapshot = snapshot
-        self.config = config
+    @property
+    def initramfs_image_source(self):
+        """
+        The initramfs image inside the snapshot.
+        """
+        return self.snapshot.mount_point / self.config.initramfs_image_source
 
     @property
     def kernel_image_name(self):
@@ -127,8 +90,7 @@ class BootEntry:
         kernel and initramfs, rather than just using the latest.
         """
         if self.copy_images:
-            return "vmlinuz-linux-{snapshot.num}".format(
-                snapshot=self.snapshot)
+            return self.image_store.get_blob_name(self.kernel_image_source)
         else:
             return "vmlinuz-linux"
 
@@ -142,11 +104,40 @@ class BootEntry:
         kernel and initramfs, rather than just using the latest.
         """
         if self.copy_images:
-            return "initramfs-linux-{snapshot.num}.img".format(
-                snapshot=self.snapshot)
+            return self.image_store.get_blob_name(
+                self.initramfs_image_source)
         else:
             return "initramfs-linux.img"
 
+    @property
+    def stores_images(self):
+        """
+        Are frozen copies of the images kept in the image store?
+
+        UKIs include the images themselves so never need them.
+        """
+        return self.copy_images and self.config.output_mode != "uki"
+
+    @property
+    def kernel_image_file(self):
+        """
+        The kernel the entry boots, as a file on this machine.
+        """
+        if self.copy_images:
+            return self.kernel_image_source
+        return self.config.boot_path / self.kernel_image_path.relative_to("/")
+
+    @property
+    def initramfs_image_file(self):
+        """
+        The initramfs the entry boots, as a file on this machine.
+        """
+        if self.copy_images:
+            return self.initramfs_image_source
+        return (
+            self.config.boot_path /
+            self.initramfs_image_path.relative_to("/"))
+
     @property
     def image_dir(self):
         """
@@ -154,7 +145,8 @@ class BootEntry:
         find kernel and initramfs image.
 
         This differs depending on whether we going to use a frozen copy of the
-        kernel and initramfs, rather than just using the latest.
+        kernel and initramfs, rather than just using the latest. Frozen copies
+        are shared between every entry using the same images.
         """
         if self.copy_images:
             return Path("/") / self.config.images_snapshot_dir
@@ -178,46 +170,207 @@ class BootEntry:
         return self.image_dir / self.initramfs_image_name
 
     @property
-    def copy_images(self):
+    def subvol(self):
         """
-        Should we use a frozen copy of the kernel and initramfs image or not.
+        Which subvolume will be root for this boot entry.
+
+        For "overlay" entries that's the read only snapshot itself.
         """
-        return strtobool(
-            self.snapshot.userdata.get("copy_images", "false")
+        if self.boot_mode == "overlay":
+            return self.snapshot_subvol
+        return (
+            self.config.root_subvolume /
+            ".snapper_systemd_boot/{self.snapshot.num}".format(
+                self=self)
         )
 
     @property
-    def subvol(self):
+    def boot_mode(self):
         """
-        Which subvolume will be root for this boot entry.
+        How the snapshot is booted. See `BOOT_MODES`.
+
+        Set per snapshot with the `boot_mode` userdata key, defaulting to
+        config.
+        """
+        boot_mode = self.snapshot.get_userdata("boot_mode")
+        if boot_mode is None:
+            return self.config.boot_mode
+        if boot_mode not in BOOT_MODES:
+            DEV_LOGGER.warning(
+                "Ignoring unknown boot_mode %r for snapshot %d.",
+                boot_mode, self.snapshot.num)
+            return self.config.boot_mode
+        return boot_mode
+
+    @property
+    def needs_writable_snapshot(self):
+        """
+        Should the writable snapshot be created on update?
+        """
+        return self.boot_mode == "writable"
+
+    @property
+    def snapshot_subvol(self):
+        """
+        The read only snapper snapshot as a subvolume path.
         """
         return (
             self.config.root_subvolume /
-            ".snapper_systemd_boot/{self.snapshot.num}".format(
-                self=self)
+            self.snapshot.mount_point.relative_to("/"))
+
+    @property
+    def boot_options(self):
+        """
+        Kernel options telling the initramfs hook what to do, if anything.
+
+        For "on-demand" entries the hook creates `subvol` from
+        `snapshot_subvol`, if it doesn't exist, before root is mounted. For
+        "overlay" entries the hook mounts root read only under a tmpfs
+        overlay.
+        """
+        if self.boot_mode == "on-demand":
+            return (
+                "snapper_systemd_boot.source={self.snapshot_subvol} "
+                "snapper_systemd_boot.target={self.subvol}").format(self=self)
+        if self.boot_mode == "overlay":
+            return "snapper_systemd_boot.overlay=1"
+        return ""
+
+    @property
+    def title_suffix(self):
+        """
+        A shortish string including the snapshot timestamp and description
+        to be used in titles for boot entries.
+        """
+        MAX_DESCRIPTION_LENGTH = 20
+        ELLIPSIS = "..."
+
+        # Frustratingly textwrap.shorten breaks only between wrods so nasty
+        # hack instead.
+        short_description = (
+            self.snapshot.description
+            if len(self.snapshot.description) < MAX_DESCRIPTION_LENGTH else
+            (
+                self.snapshot.description[
+                    :MAX_DESCRIPTION_LENGTH - len(ELLIPSIS)] + ELLIPSIS)
         )
 
+        snapped_images = "[snapped images]" if self.copy_images else ""
+
+        return (
+            "{short_description} "
+            "({self.snapshot.iso_timestamp}){snapped_images}").format(
+                self=self,
+                snapped_images=snapped_images,
+                short_description=short_description)
+
+    def get_template_values(self, fields):
+        """
+        Get the value of each template field in `fields`.
+
+        See `snapper_systemd_boot.template` for which fields come from the
+        snapshot and which from the entry.
+        """
+        return {
+            name: getattr(
+                self.snapshot if name in SNAPSHOT_FIELDS else self, name)
+            for name in fields
+        }
+
     def get_contents(self):
         """
         Get the contents of the entry that will be written.
+
+        Only rendered once, as planning, writing and recording the entry all
+        need it. With `OUTPUT_MODE = uki` the entry boots its UKI, with the
+        rendered options, rather than the kernel and initramfs.
+        """
+        if self._contents is None:
+            with profiling.span("entry.render"):
+                contents = self.config.compiled_entry_template.render(self)
+            if self.config.output_mode == "uki":
+                contents = get_uki_entry(contents, self.uki_path)
+            self._contents = contents
+        return self._contents
+
+    @property
+    def uki_key(self):
+        """
+        Key of the UKI the entry boots, with `OUTPUT_MODE = uki`, shared by
+        every entry booting the same kernel and initramfs.
+        """
+        if self._uki_key is None:
+            self._uki_key = self.uki_cache.get_key(
+                self.config.uki_builder,
+                self.config.uki_stub,
+                self.kernel_image_file,
+                self.initramfs_image_file)
+        return self._uki_key
+
+    @property
+    def uki_path(self):
         """
-        ctx = self.EntryTemplateContext(entry=self, snapshot=self.snapshot)
-        return self.config.entry_template.format(entry=ctx)
+        The full path (relative to the boot partition) to the UKI the entry
+        boots.
+        """
+        return Path("/") / UKI_DIR / get_uki_name(self.uki_key)
+
+    @property
+    def uki_file(self):
+        """
+        The UKI the entry boots, as a file on this machine.
+        """
+        return self.config.boot_path / self.uki_path.relative_to("/")
 
     def get_entry_path(self):
         """
         Get the path the entry will be written too.
         """
-        name = "{config.entry_prefix}{snapshot.num}.conf".format(
-            config=self.config, snapshot=self.snapshot)
-        return self.config.systemd_entries_path / name
+        return get_entry_path(self.config, self.snapshot.num)
 
-    def write(self):
+    def write(self, writer=None):
         """
         Write the entry to disk.
+
+        If `writer` is given the entry is only staged, and written when the
+        writer is committed.
+        """
+        with staging(writer, self.config.boot_path) as writer:
+            writer.write_text(self.get_entry_path(), self.get_contents())
+
+
+class UpdatePlan:
+    """
+    Differences between the boot entries we want and those already on disk.
+
+    * `add` entries are missing, or incomplete, and will be written in full.
+    * `update` entries only need their entry file rewriting.
+    * `unchanged` entries are left alone.
+    * `remove` are the numbers of snapshots whose entries are no longer
+      wanted.
+    * `failed` is a `Failure` for each entry that couldn't be compared with
+      the one on disk, e.g. as its kernel is missing, which is left alone.
+    """
+    def __init__(self):
+        self.add = []
+        self.update = []
+        self.unchanged = []
+        self.remove = []
+        self.failed = []
+
+    def is_empty(self):
         """
-        with open(self.get_entry_path(), 'w') as output:
-            output.write(self.get_contents())
+        Does applying the plan change anything?
+        """
+        return not (self.add or self.update or self.remove)
+
+    __repr__ = GetattrRepr(
+        add="add",
+        update="update",
+        unchanged="unchanged",
+        remove="remove",
+        failed="failed",
+    )
 
 
 class SnapperSystemDBootManager:
@@ -228,9 +381,33 @@ class SnapperSystemDBootManager:
     TODO: Make the kernel and initramfs generation easier to safely test.
     """
 
-    def __init__(self, snapper, config):
+    # TODO: Make this configurable.
+    writable_snapshot_dir = Path("/.snapper_systemd_boot")
+
+    def __init__(self, snapper, config, subvolume_backend=None):
         self.snapper = snapper
         self.config = config
+        self.image_store = ImageStore(config.images_snapshot_dir_full)
+        if subvolume_backend is None:
+            subvolume_backend = get_subvolume_backend(config)
+        self.subvolume_backend = subvolume_backend
+        self.retention = RetentionPolicy.from_config(config)
+        self.manifest = Manifest(config.boot_path / MANIFEST_NAME)
+        self.uki_cache = UkiCache(
+            config.uki_cache_dir, config.uki_cache_size_mb * 1024 ** 2)
+        self._uki_lock = KeyedLock()
+
+    def reload(self):
+        """
+        Forget the manifest and indexes loaded, so each is loaded again when
+        next used.
+
+        A manager can outlive a run, e.g. in the daemon, while other runs
+        change what's on disk, so this is called at the start of each run.
+        """
+        self.manifest.reload()
+        self.image_store.reload()
+        self.uki_cache.reload()
 
     def get_root_config(self):
         """
@@ -243,99 +420,631 @@ class SnapperSystemDBootManager:
                 return config
         raise KeyError("Unable to find root config.")
 
-    def get_snapshots_iter(self):
+    def get_snapshots_iter(self, snapshot_filter=None):
         """
         Iterator to get the snapshot information for every snapper snapshot
         that we wish to generate boot entries for.
+
+        If given a `SnapshotFilter` only matching snapshots are included, and
+        only their mount points looked up.
         """
         config = self.get_root_config()
-        for snapshot in self.snapper.get_snapshots_iter(config.name):
-            if snapshot.description == "current":
-                continue
-            if "bootable" in snapshot.userdata:
-                is_bootable = strtobool(snapshot.userdata["bootable"].lower())
-                if not is_bootable:
-                    continue
+        snapshots = self.select_snapshots(config.name)
+        if snapshot_filter is not None:
+            snapshots = snapshot_filter.apply(snapshots)
+        return self.snapper.resolve_mount_points(config.name, snapshots)
 
-            yield snapshot
+    def select_snapshots(self, config_name):
+        """
+        Select the snapshots we wish to generate boot entries for, without
+        looking up their mount points.
+
+        Selection is done first so that, whatever the retention policy leaves
+        out, never costs a mount point lookup.
+        """
+        return self.retention.select(
+            snapshot
+            for snapshot in self.snapper.list_snapshots(config_name)
+            if self.is_wanted(snapshot)
+        )
 
-    def get_boot_entries(self):
+    def is_wanted(self, snapshot):
+        """
+        Should we generate a boot entry for snapshot?
+        """
+        if snapshot.description == "current":
+            return False
+        bootable = snapshot.get_userdata("bootable")
+        if bootable is not None:
+            return strtobool(bootable.lower())
+        return True
+
+    def get_boot_entries(self, snapshot_filter=None):
         """
         Get each BootEntry for each snapper snapshot we wish to generate boot
         entries for.
         """
-        for snapshot in self.get_snapshots_iter():
-            yield BootEntry(snapshot, self.config)
+        for snapshot in self.get_snapshots_iter(snapshot_filter):
+            yield BootEntry(
+                snapshot, self.config, self.image_store, self.uki_cache)
 
-    def write_boot_entries(self):
+    @profiling.timed("manager.write_boot_entries")
+    def write_boot_entries(self, entries=None):
         """
         Write boot entries, including required additional files and snapshots
         to disk.
 
-        TODO: Move more of the functionality up to BootEntry.write
+        Defaults to every entry from `get_boot_entries`. Writable snapshots
+        are only created for entries without one, replacing any stale one left
+        over for the same snapshot number.
+
+        Returns a `Failure` for each entry that couldn't be written, as with
+        `apply_plan`.
         """
-        DEV_LOGGER.info("Writing new entries...")
-        for entry in self.get_boot_entries():
-            DEV_LOGGER.info("Writing: %r", entry)
-            entry.write()
-
-            # TODO: Remove this hardcoded string
-            writable_snapshot_dir = Path("/.snapper_systemd_boot")
-            writable_snapshot_dir.mkdir(exist_ok=True)
-            writable_snapshot_path = (
-                writable_snapshot_dir / str(entry.snapshot.num))
-            sh.btrfs.subvolume.snapshot(
-                entry.snapshot.mount_point, writable_snapshot_path)
-
-            if entry.copy_images:
-                DEV_LOGGER.info("Copying images")
-
-                snapshot_dir = self.config.images_snapshot_dir_full
-                snapshot_dir.mkdir(exist_ok=True)
-
-                # Copy vmlinux
-                linux_src = (
-                    entry.snapshot.mount_point /
-                    self.config.kernel_image_source
-                )
-                linux_dst = snapshot_dir / entry.kernel_image_name
-                shutil.copyfile(linux_src, linux_dst)
-
-                # Copy initramfs
-                initramfs_src = (
-                    entry.snapshot.mount_point /
-                    self.config.initramfs_image_source
-                )
-                initramfs_dst = snapshot_dir / entry.initramfs_image_name
-                shutil.copyfile(initramfs_src, initramfs_dst)
+        self.reload()
+        if entries is None:
+            entries = self.get_boot_entries()
+        plan = UpdatePlan()
+        plan.add.extend(entries)
+
+        DEV_LOGGER.info("Writing %d new entries...", len(plan.add))
+        return self.apply_plan(plan)
+
+    def store_uki(self, entry, writer):
+        """
+        Stage copying the UKI an entry boots to the boot partition, building
+        it if it isn't cached, unless another entry already has.
+        """
+        path = entry.uki_file
+        with self._uki_lock(entry.uki_key):
+            if path.is_file() or writer.is_staged(path):
+                DEV_LOGGER.info("Reusing UKI: %s", path)
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            writer.copy_file(
+                self.build_uki(entry),
+                path,
+                digest=self.uki_cache.get_build_digest(entry.uki_key))
+
+    def build_uki(self, entry):
+        """
+        Build the UKI for an entry, unless it's already cached.
+
+        Returns the path of the cached UKI.
+        """
+        return self.uki_cache.get(entry.uki_key, partial(
+            UKI_BUILDERS[self.config.uki_builder],
+            stub=self.config.uki_stub,
+            linux=entry.kernel_image_file,
+            initrd=entry.initramfs_image_file,
+            os_release=OS_RELEASE))
+
+    def save(self, writer=None):
+        """
+        Save the image store, UKI cache and manifest.
+        """
+        self.image_store.save(writer)
+        self.uki_cache.save()
+        self.manifest.save(writer)
+
+    def create_writable_snapshot(self, entry):
+        """
+        Create the writable snapshot booted into for an entry, replacing any
+        stale one left over for the same snapshot number.
+        """
+        path = self.get_writable_snapshot_path(entry.snapshot.num)
+        if path.is_dir():
+            with profiling.span("subvolume.delete"):
+                self.subvolume_backend.delete(path)
+        with profiling.span("subvolume.snapshot"):
+            self.subvolume_backend.snapshot(entry.snapshot.mount_point, path)
+
+    def copy_images(self, entry, writer=None):
+        """
+        Copy the kernel and initramfs images from the snapshot to the boot
+        partition, unless identical images are already there.
+        """
+        DEV_LOGGER.info("Copying images")
+        self.image_store.add(
+            entry.snapshot.num,
+            [entry.kernel_image_source, entry.initramfs_image_source],
+            writer)
+
+    def get_writable_snapshot_path(self, num):
+        """
+        Path to the writable snapshot created for snapshot `num`.
+        """
+        return self.writable_snapshot_dir / str(num)
+
+    def remove_boot_entries(self, nums):
+        """
+        Remove the entry for each snapshot in `nums`.
+
+        Only the entry file is removed straight away. Its writable snapshot
+        and images are left for `gc` to delete later, as deleting subvolumes
+        is slow and stalls btrfs.
+
+        Missing files are ignored so this can be used to clean up partially
+        written entries.
+        """
+        nums = list(nums)
+        profiling.count("entries.removed", len(nums))
+        for num in nums:
+            DEV_LOGGER.info("Removing entry for snapshot: %d", num)
+            entry_path = self.get_entry_path(num)
+            if entry_path.exists():
+                entry_path.unlink()
+
+            self.image_store.release(num)
+            self.manifest.forget(num)
+
+    def remove_boot_entry(self, num):
+        """
+        Remove everything generated for snapshot `num`.
+        """
+        self.reload()
+        self.remove_boot_entries([num])
+        self.save()
+
+    def record_entry(self, entry):
+        """
+        Record an entry, and what it was generated with, in the manifest.
+        """
+        num = entry.snapshot.num
+        subvol = subvol_id = None
+        if entry.needs_writable_snapshot:
+            subvol = self.get_writable_snapshot_path(num)
+            if subvol.is_dir():
+                subvol_id = self.subvolume_backend.get_subvolume_id(subvol)
+        self.manifest.record(
+            num,
+            entry.get_entry_path(),
+            get_contents_digest(entry.get_contents()),
+            subvol=subvol,
+            subvol_id=subvol_id,
+            images=(
+                [entry.kernel_image_name, entry.initramfs_image_name]
+                if entry.stores_images else []),
+            uki=entry.uki_key if self.config.output_mode == "uki" else None,
+        )
+
+    def record_entries(self, entries):
+        """
+        Record entries in the manifest.
+
+        Returns the files previously recorded for the same snapshots at other
+        paths, e.g. before `ENTRY_PREFIX` was changed, to remove once the new
+        files are in place.
+        """
+        stale = []
+        for entry in entries:
+            record = self.manifest.get(entry.snapshot.num)
+            if record is not None and (
+                    record["entry"] != str(entry.get_entry_path())):
+                stale.append(Path(record["entry"]))
+            self.record_entry(entry)
+        return stale
+
+    def remove_files(self, paths):
+        """
+        Remove files, ignoring any already missing.
+        """
+        for p in paths:
+            if p.exists():
+                DEV_LOGGER.info("Removing: %s", p)
+                p.unlink()
+
+    def get_entry_path(self, num):
+        """
+        Path the entry for snapshot `num` is written to.
+        """
+        return get_entry_path(self.config, num)
 
     def get_existing_entries(self):
         """
         List boot entries that we have generated previously that exist on disk.
+
+        Taken from the manifest, unless there isn't one yet.
+        """
+        if self.manifest.is_found():
+            return self.manifest.get_entry_paths()
+        return self.scan_entries()
+
+    def scan_entries(self):
+        """
+        Find boot entries that look like we generated them on disk.
+        """
+        example = self.get_entry_path(0)
+        glob = "{config.entry_prefix}*{suffix}".format(
+            config=self.config, suffix=example.suffix)
+        return list(example.parent.glob(glob))
+
+    def get_existing_entry_nums(self):
+        """
+        Snapshot numbers of the boot entries that exist on disk.
+        """
+        prefix_len = len(self.config.entry_prefix)
+        for p in self.get_existing_entries():
+            try:
+                yield int(p.stem[prefix_len:])
+            except ValueError:
+                DEV_LOGGER.warning("Ignoring unexpected entry: %s", p)
+
+    def get_existing_writable_snapshot_nums(self):
+        """
+        Snapshot numbers of the writable snapshots that exist on disk.
+
+        Taken from the manifest, unless there isn't one yet. Snapshots made
+        at boot, for "on-demand" entries, aren't included.
+        """
+        if self.manifest.is_found():
+            yield from self.manifest.get_writable_snapshot_nums()
+            return
+        for p in self.scan_writable_snapshots():
+            try:
+                yield int(p.name)
+            except ValueError:
+                DEV_LOGGER.warning("Ignoring unexpected snapshot: %s", p)
+
+    def scan_writable_snapshots(self):
+        """
+        Find writable snapshots on disk.
+        """
+        if not self.writable_snapshot_dir.is_dir():
+            return []
+        return list(self.writable_snapshot_dir.iterdir())
+
+    def update(self):
+        """
+        Bring every boot entry up to date.
+
+        Entries are written as they're planned, so looking up mount points,
+        one DBUS call per snapshot not already cached, overlaps with writing.
+        Snapshots are still all listed, and selected by any retention policy,
+        before the first is planned.
+
+        Returns a `Failure` for each entry that couldn't be written.
+        """
+        self.reload()
+        existing = self.get_existing_nums()
+        plan = UpdatePlan()
+        wanted = set()
+
+        def plan_entries():
+            for entry in self.get_boot_entries():
+                wanted.add(entry.snapshot.num)
+                action = self._plan_entry(plan, entry, existing)
+                if action is plan.add or action is plan.update:
+                    yield entry, self.needs_writable_snapshot(
+                        entry, existing)
+            plan.remove.extend(sorted(set().union(*existing) - wanted))
+
+        return self.apply_plan(plan, plan_entries())
+
+    @profiling.timed("manager.plan_update")
+    def plan_update(self):
+        """
+        Compare the boot entries we want with those on disk.
+
+        Returns an `UpdatePlan` which can be passed to `apply_plan`.
+        """
+        self.reload()
+        existing = self.get_existing_nums()
+
+        plan = UpdatePlan()
+        wanted = set()
+        for entry in self.get_boot_entries():
+            wanted.add(entry.snapshot.num)
+            self._plan_entry(plan, entry, existing)
+
+        plan.remove.extend(sorted(set().union(*existing) - wanted))
+        return plan
+
+    @profiling.timed("manager.plan_snapshots")
+    def plan_snapshots(self, nums):
+        """
+        Compare the boot entries we want with those on disk, for only the
+        snapshots numbered `nums`.
+
+        Unlike `plan_update` only the given snapshots are fetched from
+        snapper. Unless there's a retention policy, as then a new snapshot can
+        push others out, in which case every snapshot is listed and entries
+        for any snapshot no longer retained are also removed.
+        """
+        self.reload()
+        config = self.get_root_config()
+        existing = self.get_existing_nums()
+        existing_all = set().union(*existing)
+
+        snapshots = []
+        if self.retention.is_active():
+            selected = {
+                snapshot.num: snapshot
+                for snapshot in self.select_snapshots(config.name)
+            }
+            snapshots = [
+                selected[num] for num in sorted(nums) if num in selected]
+            unwanted = existing_all - set(selected)
+        else:
+            unwanted = set()
+            for num in sorted(nums):
+                try:
+                    snapshot = self.snapper.get_snapshot(config.name, num)
+                except KeyError:
+                    snapshot = None
+
+                if snapshot is not None and self.is_wanted(snapshot):
+                    snapshots.append(snapshot)
+                elif num in existing_all:
+                    unwanted.add(num)
+
+        plan = UpdatePlan()
+        for snapshot in self.snapper.resolve_mount_points(
+                config.name, snapshots):
+            self._plan_entry(
+                plan,
+                BootEntry(
+                    snapshot, self.config, self.image_store, self.uki_cache),
+                existing)
+        plan.remove.extend(sorted(unwanted))
+        return plan
+
+    def sync_snapshots(self, nums):
+        """
+        Bring the boot entries for only the snapshots numbered `nums` up to
+        date.
+        """
+        return self.apply_plan(self.plan_snapshots(nums))
+
+    def get_existing_nums(self):
+        """
+        Snapshot numbers of the entries, and of the writable snapshots, that
+        exist on disk.
+        """
+        return (
+            set(self.get_existing_entry_nums()),
+            set(self.get_existing_writable_snapshot_nums()),
+        )
+
+    def _plan_entry(self, plan, entry, existing):
+        """
+        Add an entry to the list in `plan` it belongs in, returning the list.
+
+        An entry that can't be compared, e.g. as its kernel is missing, is
+        added to `plan.failed` rather than stopping the rest being planned.
+        """
+        existing_entries, _ = existing
+        try:
+            if entry.snapshot.num not in existing_entries:
+                action = plan.add
+            elif (
+                    self.needs_writable_snapshot(entry, existing) or
+                    not self.images_exist(entry) or
+                    not self.is_entry_current(entry)):
+                action = plan.update
+            else:
+                action = plan.unchanged
+        except Exception as error:
+            DEV_LOGGER.error("plan failed for %r: %s", entry, error)
+            plan.failed.append(Failure(entry, "plan", error))
+            return plan.failed
+        action.append(entry)
+        return action
+
+    def needs_writable_snapshot(self, entry, existing):
+        """
+        Does the writable snapshot an entry boots into need creating?
+
+        Only if it doesn't exist, an existing one is never replaced as it may
+        hold changes made while booted into it.
+        """
+        _, existing_snapshots = existing
+        return (
+            entry.needs_writable_snapshot and
+            entry.snapshot.num not in existing_snapshots)
+
+    def is_entry_current(self, entry):
+        """
+        Does the entry on disk have the contents we want?
+
+        Compared with the digest in the manifest, if there is one, rather
+        than reading the entry. With `OUTPUT_MODE = uki` the entry names its
+        UKI, so a new build means new contents.
+        """
+        contents = entry.get_contents()
+        if self.manifest.is_found():
+            record = self.manifest.get(entry.snapshot.num)
+            return (
+                record is not None and
+                record["entry"] == str(entry.get_entry_path()) and
+                record["contents"] == get_contents_digest(contents))
+        return entry.get_entry_path().read_text() == contents
+
+    def images_exist(self, entry):
+        """
+        Check the frozen images, or the UKI, an entry needs, if any, exist.
+        """
+        if self.config.output_mode == "uki":
+            return entry.uki_file.is_file()
+        if not entry.stores_images:
+            return True
+        return self.image_store.has_images(
+            entry.snapshot.num,
+            [entry.kernel_image_name, entry.initramfs_image_name])
+
+    @profiling.timed("manager.apply_plan")
+    def apply_plan(self, plan, planned=None):
+        """
+        Make the changes described by an `UpdatePlan`.
+
+        Entries are written by a pipeline, with the writable snapshots, images
+        and entry files each a stage with its own workers, so one entry's
+        snapshot is created while another's images are copied. Every file on
+        the boot partition is then moved into place together.
+
+        `planned`, if given, yields each `(entry, create_snapshot)` to write
+        as it's added to `plan`, so writing can start before planning
+        finishes, with `create_snapshot` from `needs_writable_snapshot`.
+        `plan` must be complete once it's exhausted.
+
+        Returns a `Failure` for each entry that couldn't be planned, from
+        `plan.failed`, or written. They're left as they were, and the rest of
+        the plan still applied.
         """
-        glob = "{config.entry_prefix}*.conf".format(config=self.config)
-        return self.config.systemd_entries_path.glob(glob)
+        if planned is None:
+            existing = self.get_existing_nums()
+            planned = [
+                (entry, self.needs_writable_snapshot(entry, existing))
+                for entry in plan.add + plan.update
+            ]
+
+        self.writable_snapshot_dir.mkdir(exist_ok=True)
+        with EspWriter(self.config.boot_path) as writer:
+            pipeline = Pipeline(
+                [
+                    Stage(
+                        "subvolumes",
+                        self._write_subvolumes,
+                        self.subvolume_backend.workers),
+                    Stage(
+                        "images",
+                        partial(self._write_images, writer),
+                        self.config.image_workers),
+                    Stage("entries", partial(self._write_entry, writer)),
+                ],
+                queue_size=self.config.pipeline_queue_size)
+            done, failures = pipeline.run(planned)
+
+            DEV_LOGGER.info("Applied plan: %r", plan)
+            profiling.count("entries.added", len(plan.add))
+            profiling.count("entries.updated", len(plan.update))
+            profiling.count("entries.unchanged", len(plan.unchanged))
+            profiling.count(
+                "entries.failed", len(plan.failed) + len(failures))
+
+            if self.subvolume_backend.commit and any(
+                    create_snapshot for _, create_snapshot in done):
+                with profiling.span("subvolume.sync"):
+                    self.subvolume_backend.sync(self.writable_snapshot_dir)
+
+            self.remove_boot_entries(plan.remove)
+
+            recorded = [entry for entry, _ in done]
+            if not self.manifest.is_found():
+                # Adopt entries generated before there was a manifest.
+                recorded += plan.unchanged
+            stale = self.record_entries(recorded)
+
+            self.save(writer)
+        self.remove_files(stale)
+
+        failures = plan.failed + [
+            failure._replace(item=failure.item[0]) for failure in failures]
+        if failures:
+            DEV_LOGGER.error("Failed to write %d entries.", len(failures))
+        return failures
 
+    def _write_subvolumes(self, item):
+        entry, create_snapshot = item
+        if create_snapshot:
+            self.create_writable_snapshot(entry)
+        return item
+
+    def _write_images(self, writer, item):
+        entry, _ = item
+        if not self.images_exist(entry):
+            if self.config.output_mode == "uki":
+                self.store_uki(entry, writer)
+            else:
+                self.copy_images(entry, writer)
+        return item
+
+    def _write_entry(self, writer, item):
+        entry, _ = item
+        DEV_LOGGER.info("Writing: %r", entry)
+        entry.write(writer)
+        if not entry.stores_images:
+            self.image_store.release(entry.snapshot.num)
+        return item
+
+    @profiling.timed("manager.remove_boot_configs")
     def remove_boot_configs(self):
         """
-        Remove any generated boot entries, including required additional files
-        and snapshots from disk.
+        Remove any generated boot entries.
+
+        Only what the manifest records is removed, unless there's no manifest
+        in which case anything that looks like ours is. As with
+        `remove_boot_entries` the writable snapshots and images are left for
+        `gc`.
 
         TODO: Move more of the functionality up to a BootEntry.remove?
         """
-        for p in self.get_existing_entries():
-            DEV_LOGGER.info("Removing: %s", p)
-            p.unlink()
-
-        writable_snapshot_dir = Path("/.snapper_systemd_boot")
-        if writable_snapshot_dir.is_dir():
-            for p in writable_snapshot_dir.iterdir():
-                DEV_LOGGER.info("Remove writable snapshot: %s")
-                assert p.is_dir()
-                sh.btrfs.subvolume.delete(p)
-            writable_snapshot_dir.rmdir()
-
-        if self.config.images_snapshot_dir_full.is_dir():
-            DEV_LOGGER.info(
-                "Removing directory: %s", self.config.images_snapshot_dir_full)
-            shutil.rmtree(self.config.images_snapshot_dir_full)
+        self.reload()
+        if self.manifest.is_found():
+            nums = self.manifest.get_nums()
+            entry_paths = self.manifest.get_entry_paths()
+        else:
+            nums = set(self.get_existing_entry_nums())
+            entry_paths = self.scan_entries()
+
+        self.remove_files(entry_paths)
+        profiling.count("entries.removed", len(nums))
+
+        for num in nums:
+            self.image_store.release(num)
+        self.manifest.clear()
+
+        self.save()
+
+    def find_orphan_snapshots(self):
+        """
+        Find writable snapshots no entry uses any more.
+
+        Without a manifest there's no telling what's in use, so nothing is
+        an orphan.
+        """
+        if not self.manifest.is_found():
+            DEV_LOGGER.warning("No manifest, run update before gc.")
+            return []
+        nums = {str(num) for num in self.manifest.get_nums()}
+        return [
+            p for p in self.scan_writable_snapshots() if p.name not in nums]
+
+    def find_unused_ukis(self):
+        """
+        Find UKIs on the boot partition no entry boots any more.
+
+        As with `find_orphan_snapshots`, without a manifest none are.
+        """
+        uki_dir = self.config.boot_path / UKI_DIR
+        if not self.manifest.is_found() or not uki_dir.is_dir():
+            return []
+        names = {get_uki_name(key) for key in self.manifest.get_ukis()}
+        return [
+            p for p in uki_dir.iterdir()
+            if p.name not in names and not p.name.startswith(".")]
+
+    def get_status(self):
+        """
+        Get how many writable snapshots there are, and how full the boot
+        partition is, for monitoring.
+        """
+        usage = os.statvfs(str(self.config.boot_path))
+        return {
+            "writable_snapshots": len(self.scan_writable_snapshots()),
+            "esp_free_bytes": usage.f_bavail * usage.f_frsize,
+            "esp_size_bytes": usage.f_blocks * usage.f_frsize,
+        }
+
+    def check(self):
+        """
+        Compare the manifest with what's actually on disk.
+
+        Yields a description of each difference.
+        """
+        self.reload()
+        return self.manifest.check(
+            self.scan_entries(),
+            self.config.images_snapshot_dir_full,
+            self.config.boot_path / UKI_DIR,
+            self.subvolume_backend.get_subvolume_id)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Record of everything generated.
+
+Finding what we generated used to mean globbing the boot partition, slow on
+vfat, and walking the writable snapshot directory, and still didn't tell us
+which snapshot, subvolume or images each entry came with. The manifest, kept
+on the boot partition next to the entries, records all of it, so checking
+what exists is a lookup, and it can be compared with the disk to find drift.
+"""
+from pathlib import Path
+import hashlib
+import json
+import logging
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot.esp import (
+    check_unchanged, file_digest, load_json, staging)
+from snapper_systemd_boot.uki import get_uki_name
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = "snapper_systemd_boot.json"
+
+
+def get_contents_digest(contents):
+    """
+    Get the sha256 hex digest of entry `contents`.
+    """
+    return hashlib.sha256(contents.encode()).hexdigest()
+
+
+class Manifest:
+    """
+    Records, per snapshot number, the entry written, its contents digest, the
+    writable snapshot created and its subvolume id, the images used and, for
+    UKIs, the key of the build in the UKI cache.
+
+    Loaded lazily, and only written by `save`, which refuses to overwrite a
+    manifest another run saved since this one was loaded. Call `reload` at
+    the start of each run to see what other runs did.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.reload()
+
+    def reload(self):
+        """
+        Forget what's loaded, so it's loaded again from disk when next used.
+        """
+        self._records = None
+        self._found = False
+        self._digest = None
+
+    @property
+    def records(self):
+        if self._records is None:
+            manifest, self._digest = load_json(self.path)
+            self._found = manifest is not None
+            self._records = {} if manifest is None else manifest["entries"]
+        return self._records
+
+    def is_found(self):
+        """
+        Was there a manifest to load?
+
+        If not we've either generated nothing or were last run before there
+        was one, so what's on disk has to be scanned instead.
+        """
+        self.records
+        return self._found
+
+    def get(self, num):
+        return self.records.get(str(num))
+
+    def get_nums(self):
+        return {int(num) for num in self.records}
+
+    def get_entry_paths(self):
+        return [Path(record["entry"]) for record in self.records.values()]
+
+    def get_ukis(self):
+        """
+        Keys of the UKIs entries boot.
+        """
+        return {
+            record["uki"]
+            for record in self.records.values()
+            if record.get("uki") is not None
+        }
+
+    def get_writable_snapshot_nums(self):
+        return {
+            int(num)
+            for num, record in self.records.items()
+            if record["subvol"] is not None
+        }
+
+    def record(
+            self,
+            num,
+            entry_path,
+            digest,
+            subvol=None,
+            subvol_id=None,
+            images=(),
+            uki=None,
+            ):
+        """
+        Record what was generated for snapshot `num`.
+
+        `digest` is the sha256 of the file written to `entry_path`.
+        """
+        self.records[str(num)] = {
+            "entry": str(entry_path),
+            "contents": digest,
+            "subvol": None if subvol is None else str(subvol),
+            "subvol_id": subvol_id,
+            "images": list(images),
+            "uki": uki,
+        }
+
+    def forget(self, num):
+        self.records.pop(str(num), None)
+
+    def save(self, writer=None):
+        """
+        Write the manifest to disk.
+        """
+        if self._records is None:
+            return
+        check_unchanged(self.path, self._digest)
+        contents = json.dumps(
+            {"entries": self._records}, indent=2, sort_keys=True)
+        with staging(writer, self.path.parent) as writer:
+            writer.write_text(self.path, contents)
+        self._found = True
+        self._digest = get_contents_digest(contents)
+
+    def clear(self):
+        """
+        Forget every entry.
+        """
+        self.records.clear()
+
+    def check(
+            self, existing_entry_paths, image_dir, uki_dir, get_subvolume_id):
+        """
+        Compare the manifest with what's on disk.
+
+        `existing_entry_paths` are the entries found by scanning. Yields a
+        description of each difference.
+
+        Snapshots, images and UKIs nothing uses aren't reported, they're left
+        for `gc` to delete.
+        """
+        recorded_entries = set()
+        for num, record in sorted(
+                self.records.items(), key=lambda item: int(item[0])):
+            entry_path = Path(record["entry"])
+            recorded_entries.add(entry_path)
+            if not entry_path.is_file():
+                yield "missing entry: {}".format(entry_path)
+            elif file_digest(entry_path) != record["contents"]:
+                yield "modified entry: {}".format(entry_path)
+
+            if record["subvol"] is not None:
+                subvol = Path(record["subvol"])
+                if not subvol.is_dir():
+                    yield "missing snapshot: {}".format(subvol)
+                elif record["subvol_id"] is not None and (
+                        get_subvolume_id(subvol) != record["subvol_id"]):
+                    yield "replaced snapshot: {}".format(subvol)
+
+            for name in record["images"]:
+                if not (image_dir / name).is_file():
+                    yield "missing image: {}".format(image_dir / name)
+
+            if record.get("uki") is not None:
+                uki_path = uki_dir / get_uki_name(record["uki"])
+                if not uki_path.is_file():
+                    yield "missing UKI: {}".format(uki_path)
+
+        for entry_path in sorted(set(existing_entry_paths) - recorded_entries):
+            yield "untracked entry: {}".format(entry_path)
+
+    __repr__ = GetattrRepr(
+        path="path",
+    )
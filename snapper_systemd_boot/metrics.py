@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Export metrics for Prometheus.
+
+After each run the profiler's phases and counters, and how full the boot
+partition is, are written to a file for node_exporter's textfile collector, so
+slow or failing runs and a filling boot partition can be alerted on.
+"""
+from pathlib import Path
+import logging
+import os
+import time
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot import profiling
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+PREFIX = "snapper_systemd_boot_"
+
+# Counters always exported, as zero if nothing was counted, so alerts on them
+# don't go missing.
+DEFAULT_COUNTERS = (
+    "entries.added",
+    "entries.updated",
+    "entries.unchanged",
+    "entries.removed",
+    "entries.failed",
+    "esp.bytes_written",
+    "esp.files_written",
+)
+
+LAST_SUCCESS = PREFIX + "last_success_timestamp_seconds"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def format_family(name, help_text, samples):
+    """
+    Format a gauge `name` in the text exposition format.
+
+    `samples` is a list of `(labels, value)` where `labels` is a dict.
+    """
+    lines = [
+        "# HELP {}{} {}".format(PREFIX, name, help_text),
+        "# TYPE {}{} gauge".format(PREFIX, name),
+    ]
+    for labels, value in samples:
+        label_text = ",".join(
+            '{}="{}"'.format(key, value.replace("\\", "\\\\").replace(
+                '"', '\\"'))
+            for key, value in sorted(labels.items()))
+        lines.append("{}{}{} {}".format(
+            PREFIX,
+            name,
+            "{{{}}}".format(label_text) if label_text else "",
+            format_value(value)))
+    return lines
+
+
+def read_last_success(path):
+    """
+    Get the last success timestamp from a previous metrics file, if any.
+    """
+    try:
+        with open(str(path), "r") as metrics_file:
+            for line in metrics_file:
+                name, _, value = line.partition(" ")
+                if name == LAST_SUCCESS:
+                    return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class MetricsExporter:
+    """
+    Writes metrics for each run to the textfile `path`.
+
+    The profiler is enabled, and reset at the start of each run, so only that
+    run is reported.
+    """
+    def __init__(self, path, manager, profiler=profiling.PROFILER):
+        self.path = Path(path)
+        self.manager = manager
+        self.profiler = profiler
+
+    def run(self, func):
+        """
+        Call `func` as a run, writing metrics once it's done whether it
+        succeeded or not.
+
+        A run succeeds if it doesn't raise and no entry failed. If `func`
+        returns `False`, as `RunLock.run` does when it leaves the work to a
+        run in progress, nothing ran and the last run's metrics are kept.
+        """
+        self.profiler.reset()
+        self.profiler.enabled = True
+        success = False
+        result = None
+        try:
+            with self.profiler.span("run"):
+                result = func()
+            success = not self.profiler.counters["entries.failed"]
+            return result
+        finally:
+            if result is not False:
+                try:
+                    self.write(success)
+                except OSError:
+                    DEV_LOGGER.exception(
+                        "Unable to write metrics to: %s", self.path)
+
+    def get_lines(self, success, now):
+        report = self.profiler.get_report()
+        spans = report["spans"]
+        counters = dict.fromkeys(DEFAULT_COUNTERS, 0)
+        counters.update(report["counters"])
+        status = self.manager.get_status()
+
+        last_success = now if success else read_last_success(self.path)
+
+        lines = []
+        lines += format_family(
+            "run_duration_seconds",
+            "How long the last run took.",
+            [({}, spans["run"]["total"] if "run" in spans else 0.0)])
+        lines += format_family(
+            "phase_seconds",
+            "Time spent in each phase during the last run.",
+            [({"phase": name}, stats["total"])
+             for name, stats in spans.items()])
+        lines += format_family(
+            "phase_calls",
+            "Times each phase ran during the last run.",
+            [({"phase": name}, stats["count"])
+             for name, stats in spans.items()])
+        for name, value in sorted(counters.items()):
+            lines += format_family(
+                name.replace(".", "_"),
+                "Counted {} during the last run.".format(name),
+                [({}, value)])
+        lines += format_family(
+            "writable_snapshots",
+            "Writable snapshots on disk.",
+            [({}, status["writable_snapshots"])])
+        lines += format_family(
+            "esp_free_bytes",
+            "Bytes free on the boot partition.",
+            [({}, status["esp_free_bytes"])])
+        lines += format_family(
+            "esp_size_bytes",
+            "Size of the boot partition in bytes.",
+            [({}, status["esp_size_bytes"])])
+        lines += format_family(
+            "last_run_success",
+            "Whether the last run succeeded.",
+            [({}, int(success))])
+        lines += format_family(
+            "last_run_timestamp_seconds",
+            "When the last run finished.",
+            [({}, now)])
+        if last_success is not None:
+            lines += format_family(
+                "last_success_timestamp_seconds",
+                "When a run last succeeded.",
+                [({}, last_success)])
+        return lines
+
+    def write(self, success):
+        """
+        Write metrics for the run just finished.
+
+        Written under a temporary name and renamed into place, so the
+        collector never reads a partial file.
+        """
+        lines = self.get_lines(success, time.time())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(".{}.tmp".format(self.path.name))
+        tmp_path.write_text("\n".join(lines) + "\n")
+        os.replace(str(tmp_path), str(self.path))
+
+    __repr__ = GetattrRepr(
+        path="path",
+    )
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Run work through stages concurrently.
+
+An update talks to snapper over DBUS, creates subvolumes with btrfs and copies
+images to the boot partition. Done one entry at a time each waits on the
+others, so instead each is a stage with its own worker threads, connected by
+bounded queues, and an update takes about as long as its slowest stage.
+"""
+from collections import namedtuple
+import logging
+import threading
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot import profiling
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 16
+
+# Something that failed in a stage, and why.
+Failure = namedtuple("Failure", ["item", "stage", "error"])
+
+# Tells a worker there's nothing more to do.
+_DONE = object()
+
+
+class Stage:
+    """
+    A step in a `Pipeline`, calling `func` with each item, using `workers`
+    threads.
+
+    `func` returns the item to pass on to the next stage.
+    """
+    def __init__(self, name, func, workers=1):
+        assert workers > 0
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+    __repr__ = GetattrRepr(
+        name="name",
+        workers="workers",
+    )
+
+
+class Pipeline:
+    """
+    Runs items through each stage in turn, with at most `queue_size` items
+    waiting for each stage.
+
+    An item that raises an exception in a stage is recorded as a `Failure`
+    and goes no further, without stopping the others.
+    """
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = list(stages)
+        self.queue_size = queue_size
+
+    def _work(self, stage, input_queue, output_queue, done, failures):
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                return
+            try:
+                with profiling.span("pipeline." + stage.name):
+                    item = stage.func(item)
+            except Exception as error:
+                DEV_LOGGER.error(
+                    "%s failed for %r: %s", stage.name, item, error)
+                failures.append(Failure(item, stage.name, error))
+                continue
+            if output_queue is None:
+                done.append(item)
+            else:
+                output_queue.put(item)
+
+    def run(self, items):
+        """
+        Run every one of `items` through the pipeline.
+
+        `items` is iterated in the calling thread, so can be produced as it
+        goes, and is held up when the first stage falls behind.
+
+        Returns the items that made it through every stage, in the order they
+        did, and a `Failure` for each that didn't.
+        """
+        import queue
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        done = []
+        failures = []
+        workers = []
+        for index, stage in enumerate(self.stages):
+            output_queue = (
+                queues[index + 1] if index + 1 < len(queues) else None)
+            threads = [
+                threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[index], output_queue, done, failures),
+                    name="pipeline-{}-{}".format(stage.name, number),
+                    daemon=True)
+                for number in range(stage.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # Each stage is only told to finish once the stage before it has,
+            # so nothing is left in a queue.
+            for input_queue, threads in zip(queues, workers):
+                for _ in threads:
+                    input_queue.put(_DONE)
+                for thread in threads:
+                    thread.join()
+
+        return done, failures
+
+    __repr__ = GetattrRepr(
+        stages="stages",
+        queue_size="queue_size",
+    )
+
+
+class KeyedLock:
+    """
+    A lock for each key, so work on the same key, e.g. storing the same image,
+    is never done by two workers at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __call__(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Time where updates spend their time.
+
+Code is instrumented with named spans, e.g. one per `GetMountPoint` call or
+`btrfs` snapshot, and counters. Nothing is recorded unless profiling is
+enabled, with `--profile`, so a long running daemon doesn't collect timings
+forever.
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import json
+import math
+import threading
+import time
+
+from reprutils import GetattrRepr
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest rank percentile of already sorted values.
+    """
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class Profiler:
+    """
+    Collects how long each span took and counts of things done.
+
+    Safe to use from the threads used to create snapshots.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.spans = defaultdict(list)
+        self.counters = Counter()
+
+    @contextmanager
+    def _span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.spans[name].append(elapsed)
+
+    def span(self, name):
+        """
+        Context manager timing the code within as span `name`.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name)
+
+    def count(self, name, value=1):
+        """
+        Add `value` to counter `name`.
+        """
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def get_report(self):
+        """
+        Summarise every span, and every counter, as a JSON friendly dict.
+
+        Times are in seconds.
+        """
+        with self._lock:
+            spans = {name: sorted(times) for name, times in self.spans.items()}
+            counters = dict(self.counters)
+        return {
+            "spans": {
+                name: {
+                    "count": len(times),
+                    "total": sum(times),
+                    "p50": percentile(times, 50),
+                    "p99": percentile(times, 99),
+                }
+                for name, times in sorted(spans.items())
+            },
+            "counters": dict(sorted(counters.items())),
+        }
+
+    def format_report(self):
+        """
+        Format the report as a table, slowest phases first.
+        """
+        report = self.get_report()
+        lines = ["{:<36} {:>7} {:>10} {:>10} {:>10}".format(
+            "phase", "count", "total ms", "p50 ms", "p99 ms")]
+        for name, stats in sorted(
+                report["spans"].items(),
+                key=lambda item: item[1]["total"],
+                reverse=True):
+            lines.append("{:<36} {:>7} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name,
+                stats["count"],
+                stats["total"] * 1000,
+                stats["p50"] * 1000,
+                stats["p99"] * 1000))
+        for name, value in report["counters"].items():
+            lines.append("{:<36} {:>7}".format(name, value))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        """
+        Write the report to `path` as JSON, to compare with other hosts.
+        """
+        with open(str(path), "w") as output:
+            json.dump(self.get_report(), output, indent=4)
+            output.write("\n")
+
+    __repr__ = GetattrRepr(
+        enabled="enabled",
+    )
+
+
+class _NullSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+PROFILER = Profiler()
+
+span = PROFILER.span
+count = PROFILER.count
+
+
+def timed(name):
+    """
+    Decorate a function to time each call as span `name`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
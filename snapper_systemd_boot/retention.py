@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Choose which snapshots get boot entries.
+
+With hourly timelines there can be hundreds of snapshots, far more than
+anyone wants in a boot menu. A retention policy picks a bounded subset before
+any expensive work, like looking up mount points or creating writable
+snapshots, is done.
+"""
+from datetime import datetime, timedelta
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot.config import strtobool
+
+
+def is_pinned(snapshot):
+    """
+    Was the snapshot explicitly marked `bootable = true`?
+    """
+    return strtobool(snapshot.get_userdata("bootable", "false"))
+
+
+class RetentionPolicy:
+    """
+    Selects snapshots to generate entries for.
+
+    * `types` if given, only snapshots of these `SnapshotType` are kept.
+    * `daily_after_days` if given, only the newest snapshot each day is kept
+      for snapshots older than this many days.
+    * `newest` if given, at most this many of the remaining snapshots, newest
+      first, are kept.
+
+    Snapshots explicitly marked `bootable = true` are always kept.
+    """
+    def __init__(self, newest=None, types=None, daily_after_days=None):
+        self.newest = newest
+        self.types = None if types is None else frozenset(types)
+        self.daily_after_days = daily_after_days
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            newest=config.retention_newest,
+            types=config.retention_types,
+            daily_after_days=config.retention_daily_after_days,
+        )
+
+    def is_active(self):
+        """
+        Would this policy ever leave out a snapshot?
+        """
+        return not (
+            self.newest is None and
+            self.types is None and
+            self.daily_after_days is None
+        )
+
+    def select(self, snapshots, now=None):
+        """
+        Select the snapshots to keep, returned in order of number.
+
+        Without a policy `snapshots` is returned as it is, so it can still be
+        streamed. Otherwise every snapshot has to be seen before any is
+        selected.
+        """
+        if not self.is_active():
+            return snapshots
+
+        if now is None:
+            now = datetime.now()
+        daily_before = (
+            None if self.daily_after_days is None else
+            now - timedelta(days=self.daily_after_days)
+        )
+
+        pinned = []
+        candidates = []
+        days_seen = set()
+        for snapshot in sorted(
+                snapshots,
+                key=lambda s: (s.timestamp, s.num),
+                reverse=True):
+            if is_pinned(snapshot):
+                pinned.append(snapshot)
+                continue
+            if self.types is not None and snapshot.type not in self.types:
+                continue
+            if daily_before is not None and snapshot.timestamp < daily_before:
+                day = snapshot.timestamp.date()
+                if day in days_seen:
+                    continue
+                days_seen.add(day)
+            candidates.append(snapshot)
+
+        if self.newest is not None:
+            candidates = candidates[:self.newest]
+
+        return sorted(pinned + candidates, key=lambda s: s.num)
+
+    __repr__ = GetattrRepr(
+        newest="newest",
+        types="types",
+        daily_after_days="daily_after_days",
+    )
+
+
+class SnapshotFilter:
+    """
+    Narrows down snapshots asked about on the command line.
+
+    * `since` if given, only snapshots created at or after this `datetime`.
+    * `types` if given, only snapshots of these `SnapshotType`.
+    * `nums` if given, only snapshots with these numbers.
+    * `limit` if given, at most this many, newest first.
+
+    Unlike `RetentionPolicy` nothing is kept regardless.
+    """
+    def __init__(self, since=None, types=None, nums=None, limit=None):
+        self.since = since
+        self.types = None if types is None else frozenset(types)
+        self.nums = None if nums is None else frozenset(nums)
+        self.limit = limit
+
+    def is_match(self, snapshot):
+        return (
+            (self.since is None or snapshot.timestamp >= self.since) and
+            (self.types is None or snapshot.type in self.types) and
+            (self.nums is None or snapshot.num in self.nums)
+        )
+
+    def apply(self, snapshots):
+        """
+        Filter snapshots, returned in order of number.
+        """
+        snapshots = [s for s in snapshots if self.is_match(s)]
+        if self.limit is not None:
+            snapshots.sort(key=lambda s: (s.timestamp, s.num), reverse=True)
+            snapshots = snapshots[:self.limit]
+        return sorted(snapshots, key=lambda s: s.num)
+
+    __repr__ = GetattrRepr(
+        since="since",
+        types="types",
+        nums="nums",
+        limit="limit",
+    )
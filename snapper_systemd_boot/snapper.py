@@ -5,25 +5,26 @@ Wrap Snapper DBUS client.
 In a few places I convert dbus types to native. I know this isn't strictly
 necessary, as the dbus ones subclass the native, but it was irritating when
 dumping repr to console, and I really didn't need the dbus metadata.
+
+`dbus` is only imported once we connect, so the rest of this module can be
+used without it.
 """
 from datetime import datetime
 from enum import Enum
+from functools import partial
 from pathlib import Path
 import logging
 
 from reprutils import GetattrRepr
-import pytest
 
-import dbus
+from snapper_systemd_boot import profiling
 
 DEV_LOGGER = logging.getLogger(__name__)
 
-
-@pytest.mark.real_config
-def test_get_snapshots(snapper):
-    """Test we can access snapshots via dbus."""
-    snapshot = next(snapper.get_snapshots_iter("root"))
-    assert snapshot.description == "current"
+BUS_NAME = "org.opensuse.Snapper"
+OBJECT_PATH = "/org/opensuse/Snapper"
+INTERFACE = "org.opensuse.Snapper"
+SNAPSHOT_NOT_FOUND = "error.snapshot_not_found"
 
 
 class SnapshotType(Enum):
@@ -37,33 +38,74 @@ class Snapper:
     Wrap Snapper DBUS client.
     """
     def __init__(self, bus):
+        import dbus
         self.snapper = dbus.Interface(
-            bus.get_object(
-                'org.opensuse.Snapper',
-                '/org/opensuse/Snapper'),
-            dbus_interface='org.opensuse.Snapper'
+            bus.get_object(BUS_NAME, OBJECT_PATH),
+            dbus_interface=INTERFACE
         )
 
     def get_configs_iter(self):
         """
         Get all snapper configs wrapped in helper class.
         """
-        configs = self.snapper.ListConfigs()
+        with profiling.span("snapper.ListConfigs"):
+            configs = self.snapper.ListConfigs()
         for config in configs:
             yield SnapperConfig(*config)
 
+    def list_snapshots(self, config_name):
+        """
+        Get all existing snapshots for config without their mount points.
+
+        A snapshot's mount point is looked up if it's used before being
+        resolved.
+        """
+        with profiling.span("snapper.ListSnapshots"):
+            snapshots = self.snapper.ListSnapshots(config_name)
+        resolver = partial(self._get_mount_point, config_name)
+        for snapshot in snapshots:
+            yield Snapshot(*snapshot, resolver=resolver)
+
+    def _get_mount_point(self, config_name, snapshot):
+        with profiling.span("snapper.GetMountPoint"):
+            mount_point = self.snapper.GetMountPoint(
+                config_name, snapshot.num)
+        return Path(mount_point)
+
+    def get_snapshot(self, config_name, num):
+        """
+        Get a single snapshot, without its mount point.
+
+        Raises `KeyError` if there's no such snapshot.
+        """
+        import dbus.exceptions
+        try:
+            with profiling.span("snapper.GetSnapshot"):
+                snapshot = self.snapper.GetSnapshot(config_name, num)
+        except dbus.exceptions.DBusException as error:
+            if error.get_dbus_name() == SNAPSHOT_NOT_FOUND:
+                raise KeyError(num) from error
+            raise
+        return Snapshot(*snapshot)
+
+    def resolve_mount_points(self, config_name, snapshots):
+        """
+        Discover the mountpoint on filesystem for each snapshot.
+
+        Each snapshot is yielded once its mountpoint is set.
+        """
+        for snapshot in snapshots:
+            snapshot.mount_point = self._get_mount_point(config_name, snapshot)
+            yield snapshot
+
     def get_snapshots_iter(self, config_name):
         """
         Get all existing snapshots for config.
 
         Also discover the mountpoint for each snapshot on filesystem.
         """
-        for snapshot in self.snapper.ListSnapshots(config_name):
-            snapshot = Snapshot(*snapshot)
-            snapshot.mount_point = Path(
-                self.snapper.GetMountPoint(
-                    config_name, snapshot.num))
-            yield snapshot
+        return self.resolve_mount_points(
+            config_name, self.list_snapshots(config_name))
 
 
 class SnapperConfig:
@@ -82,7 +124,22 @@ class SnapperConfig:
 class Snapshot:
     """
     Wrap individual snapper snapshot.
+
+    There can be thousands of snapshots, most of which are thrown away, so the
+    raw values from DBUS are kept and each field only converted when first
+    used.
+
+    `mount_point` can be given up front, set later, or looked up on first use
+    by calling `resolver` with the snapshot.
     """
+    __slots__ = (
+        "_raw",
+        "_timestamp",
+        "_userdata",
+        "_mount_point",
+        "_resolver",
+    )
+
     def __init__(
             self,
             num,
@@ -94,19 +151,97 @@ class Snapshot:
             cleanup,
             userdata,
             mount_point=None,
+            resolver=None,
             ):
-        self.type = SnapshotType(type_raw)
-        self.num = int(num)
-        self.pre_num = int(pre_num)
-        self.timestamp = datetime.fromtimestamp(timestamp)
-        self.uid = int(uid)
-        self.description = str(description)
-        self.cleanup = str(cleanup)
-        self.userdata = {
-            str(key): str(value)
-            for key, value in userdata.items()
-        }
-        self.mount_point = mount_point
+        self._raw = (
+            num, type_raw, pre_num, timestamp, uid, description, cleanup,
+            userdata)
+        self._timestamp = None
+        self._userdata = None
+        self._mount_point = mount_point
+        self._resolver = resolver
+
+    @property
+    def num(self):
+        return int(self._raw[0])
+
+    @property
+    def type(self):
+        return SnapshotType(self._raw[1])
+
+    @property
+    def pre_num(self):
+        return int(self._raw[2])
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None:
+            self._timestamp = datetime.fromtimestamp(self._raw[3])
+        return self._timestamp
+
+    @property
+    def uid(self):
+        return int(self._raw[4])
+
+    @property
+    def description(self):
+        return str(self._raw[5])
+
+    @property
+    def cleanup(self):
+        return str(self._raw[6])
+
+    @property
+    def userdata(self):
+        if self._userdata is None:
+            self._userdata = {
+                str(key): str(value)
+                for key, value in self._raw[7].items()
+            }
+        return self._userdata
+
+    def get_userdata(self, key, default=None):
+        """
+        Get a single userdata value without converting the rest.
+        """
+        if self._userdata is not None:
+            return self._userdata.get(key, default)
+        value = self._raw[7].get(key)
+        return default if value is None else str(value)
+
+    @property
+    def mount_point(self):
+        if self._mount_point is None and self._resolver is not None:
+            self._mount_point = self._resolver(self)
+        return self._mount_point
+
+    @mount_point.setter
+    def mount_point(self, mount_point):
+        self._mount_point = mount_point
+
+    @property
+    def has_mount_point(self):
+        """
+        Is the mount point already known, without looking it up?
+        """
+        return self._mount_point is not None
+
+    def to_raw(self):
+        """
+        Convert back to the values snapper returns over DBUS.
+
+        The inverse of constructing a `Snapshot`, leaving out the mount point.
+        """
+        return [
+            self.num,
+            int(self._raw[1]),
+            self.pre_num,
+            int(self._raw[3]),
+            self.uid,
+            self.description,
+            self.cleanup,
+            self.userdata,
+        ]
 
     @property
     def iso_timestamp(self):
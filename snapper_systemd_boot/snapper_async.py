@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio Snapper DBUS client.
+
+`Snapper` makes one blocking `GetMountPoint` call per snapshot, one after
+another. With hundreds of snapshots the round trips add up, so this client
+keeps many calls in flight at once.
+
+It presents the same blocking interface as `Snapper` and returns the same
+`Snapshot` and `SnapperConfig` objects, so either can be used by
+`SnapperSystemDBootManager`.
+
+Requires the optional `dbus-next` package.
+"""
+from pathlib import Path
+import asyncio
+import logging
+
+from snapper_systemd_boot import profiling
+from snapper_systemd_boot.snapper import (
+    BUS_NAME,
+    INTERFACE,
+    OBJECT_PATH,
+    SNAPSHOT_NOT_FOUND,
+    SnapperConfig,
+    Snapshot,
+)
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 16
+
+# Only the parts of the snapper interface we use. Saves a round trip
+# introspecting the service.
+INTROSPECTION = """
+<node>
+  <interface name="{interface}">
+    <method name="ListConfigs">
+      <arg name="configs" type="a(ssa{{ss}})" direction="out"/>
+    </method>
+    <method name="ListSnapshots">
+      <arg name="config_name" type="s" direction="in"/>
+      <arg name="snapshots" type="a(uquxussa{{ss}})" direction="out"/>
+    </method>
+    <method name="GetSnapshot">
+      <arg name="config_name" type="s" direction="in"/>
+      <arg name="number" type="u" direction="in"/>
+      <arg name="snapshot" type="(uquxussa{{ss}})" direction="out"/>
+    </method>
+    <method name="GetMountPoint">
+      <arg name="config_name" type="s" direction="in"/>
+      <arg name="number" type="u" direction="in"/>
+      <arg name="path" type="s" direction="out"/>
+    </method>
+  </interface>
+</node>
+""".format(interface=INTERFACE)
+
+
+class AsyncSnapper:
+    """
+    Wrap Snapper DBUS client using asyncio.
+
+    `concurrency` limits how many `GetMountPoint` calls are in flight at once.
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+        self._interface = None
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+    async def _get_interface(self):
+        """
+        Connect to the system bus on first use.
+        """
+        if self._interface is None:
+            from dbus_next.aio import MessageBus
+            from dbus_next import BusType
+
+            bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+            proxy = bus.get_proxy_object(BUS_NAME, OBJECT_PATH, INTROSPECTION)
+            self._interface = proxy.get_interface(INTERFACE)
+        return self._interface
+
+    async def _list_configs(self):
+        interface = await self._get_interface()
+        with profiling.span("snapper.ListConfigs"):
+            return await interface.call_list_configs()
+
+    async def _list_snapshots(self, config_name):
+        interface = await self._get_interface()
+        with profiling.span("snapper.ListSnapshots"):
+            return await interface.call_list_snapshots(config_name)
+
+    async def _get_snapshot(self, config_name, num):
+        from dbus_next import DBusError
+
+        interface = await self._get_interface()
+        try:
+            with profiling.span("snapper.GetSnapshot"):
+                return await interface.call_get_snapshot(config_name, num)
+        except DBusError as error:
+            if error.type == SNAPSHOT_NOT_FOUND:
+                raise KeyError(num) from error
+            raise
+
+    async def _resolve_mount_points(self, config_name, snapshots):
+        interface = await self._get_interface()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def resolve(snapshot):
+            async with semaphore:
+                with profiling.span("snapper.GetMountPoint"):
+                    mount_point = await interface.call_get_mount_point(
+                        config_name, snapshot.num)
+                snapshot.mount_point = Path(mount_point)
+
+        await asyncio.gather(*map(resolve, snapshots))
+
+    def get_configs_iter(self):
+        """
+        Get all snapper configs wrapped in helper class.
+        """
+        for config in self._run(self._list_configs()):
+            yield SnapperConfig(*config)
+
+    def list_snapshots(self, config_name):
+        """
+        Get all existing snapshots for config without their mount points.
+        """
+        for snapshot in self._run(self._list_snapshots(config_name)):
+            yield Snapshot(*snapshot)
+
+    def get_snapshot(self, config_name, num):
+        """
+        Get a single snapshot, without its mount point.
+
+        Raises `KeyError` if there's no such snapshot.
+        """
+        return Snapshot(*self._run(self._get_snapshot(config_name, num)))
+
+    def resolve_mount_points(self, config_name, snapshots):
+        """
+        Discover the mountpoint on filesystem for each snapshot.
+
+        Unlike `Snapper` every mount point is resolved before any snapshot is
+        yielded.
+        """
+        snapshots = list(snapshots)
+        DEV_LOGGER.info(
+            "Resolving %d mount points, %d at a time.",
+            len(snapshots), self.concurrency)
+        self._run(self._resolve_mount_points(config_name, snapshots))
+        return iter(snapshots)
+
+    def get_snapshots_iter(self, config_name):
+        """
+        Get all existing snapshots for config.
+
+        Also discover the mountpoint for each snapshot on filesystem.
+        """
+        return self.resolve_mount_points(
+            config_name, self.list_snapshots(config_name))
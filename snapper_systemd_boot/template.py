@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled boot entry templates.
+
+Entry templates use `str.format` syntax, with every field an attribute of
+`entry`, e.g. `{entry.title_suffix}`. The template is parsed once, when config
+is loaded, so unknown fields are reported straight away and rendering only
+has to look up the fields the template actually uses.
+"""
+import re
+import string
+
+from reprutils import GetattrRepr
+
+# Fields taken from the snapshot.
+SNAPSHOT_FIELDS = frozenset([
+    "cleanup",
+    "description",
+    "iso_timestamp",
+    "mount_point",
+    "num",
+    "pre_num",
+    "timestamp",
+    "type",
+    "uid",
+    "userdata",
+])
+
+# Fields taken from the `BootEntry`.
+ENTRY_FIELDS = frozenset([
+    "boot_mode",
+    "boot_options",
+    "copy_images",
+    "image_dir",
+    "initramfs_image_name",
+    "initramfs_image_path",
+    "kernel_image_name",
+    "kernel_image_path",
+    "snapshot_subvol",
+    "subvol",
+    "title_suffix",
+])
+
+FIELDS = SNAPSHOT_FIELDS | ENTRY_FIELDS
+
+FIELD_RE = re.compile(r"^entry\.(?P<name>\w+)(?P<rest>(\.\w+|\[[^\]]+\])*)$")
+
+CONVERSIONS = {
+    None: lambda value: value,
+    "s": str,
+    "r": repr,
+    "a": ascii,
+}
+
+_FORMATTER = string.Formatter()
+
+
+class EntryTemplate:
+    """
+    An entry template parsed ahead of time.
+
+    Raises `ValueError` if the template uses unknown fields.
+    """
+    def __init__(self, template):
+        self.template = template
+        self.fields = set()
+        self._parts = []
+
+        for literal, field_name, format_spec, conversion in (
+                _FORMATTER.parse(template)):
+            if field_name is None:
+                self._parts.append((literal, None, None, None, None))
+                continue
+
+            match = FIELD_RE.match(field_name)
+            if match is None or match.group("name") not in FIELDS:
+                raise ValueError(
+                    "Unknown field in entry template: {{{}}}".format(
+                        field_name))
+            if "{" in format_spec:
+                raise ValueError(
+                    "Nested fields aren't supported in entry template: "
+                    "{{{}:{}}}".format(field_name, format_spec))
+
+            name = match.group("name")
+            self.fields.add(name)
+            self._parts.append((
+                literal,
+                name,
+                match.group("rest"),
+                CONVERSIONS[conversion],
+                format_spec,
+            ))
+
+    def render(self, entry):
+        """
+        Render the template for a `BootEntry`.
+        """
+        values = entry.get_template_values(self.fields)
+        output = []
+        for literal, name, rest, convert, format_spec in self._parts:
+            output.append(literal)
+            if name is None:
+                continue
+            value = values[name]
+            if rest:
+                value, _ = _FORMATTER.get_field(
+                    "value" + rest, (), {"value": value})
+            output.append(format(convert(value), format_spec))
+        return "".join(output)
+
+    def __str__(self):
+        return self.template
+
+    __repr__ = GetattrRepr(
+        "template",
+    )
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Build Unified Kernel Images (UKIs).
+
+A UKI bundles the kernel and initramfs into one EFI binary. Most snapshots
+boot the same kernel and initramfs, only their command lines differ, so rather
+than a UKI per snapshot, each with its command line built in, one UKI is built
+for each distinct kernel and initramfs and booted by a Type #1 entry per
+snapshot, whose `options` give the command line.
+
+No command line is built in, as with Secure Boot systemd-stub ignores the one
+passed by the boot loader if there is, and the UKIs are kept out of
+`EFI/Linux` so systemd-boot doesn't also list each by itself, without a
+snapshot's options.
+
+Building one means copying a kernel and initramfs into a new binary, so builds
+are cached, outside the boot partition, by a hash of everything that goes into
+them. The cache is bounded in size, evicting whichever builds were least
+recently used.
+"""
+from pathlib import Path
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from reprutils import GetattrRepr
+
+from snapper_systemd_boot import profiling
+from snapper_systemd_boot.esp import check_unchanged, file_digest, load_json
+from snapper_systemd_boot.pipeline import KeyedLock
+
+DEV_LOGGER = logging.getLogger(__name__)
+
+# Where UKIs are kept on the boot partition.
+UKI_DIR = Path("EFI/snapper_systemd_boot")
+
+# os-release built into every UKI. Entries are titled by their entry file.
+OS_RELEASE = 'PRETTY_NAME="Snapper snapshot"\nID=snapper_systemd_boot\n'
+
+# Keys of a Type #1 entry that say what to boot.
+BOOT_KEYS = frozenset(["linux", "initrd", "efi", "uki"])
+
+
+def get_uki_name(key):
+    """
+    Get the filename of the UKI built under `key`.
+    """
+    return "{}.efi".format(key)
+
+
+def get_uki_entry(contents, uki_path):
+    """
+    Turn the contents of a Type #1 entry booting a kernel and initramfs into
+    one booting the UKI at `uki_path`, keeping its title, options and the
+    rest.
+    """
+    lines = []
+    for line in contents.splitlines():
+        fields = line.split(None, 1)
+        if fields and fields[0] in BOOT_KEYS:
+            continue
+        lines.append(line)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    lines.append("efi {}".format(uki_path))
+    return "\n".join(lines) + "\n"
+
+
+def build_ukify(output, stub, linux, initrd, os_release):
+    """
+    Build a UKI with systemd's `ukify`.
+    """
+    import subprocess
+
+    subprocess.run(
+        [
+            "ukify", "build",
+            "--stub", str(stub),
+            "--linux", str(linux),
+            "--initrd", str(initrd),
+            "--os-release", os_release,
+            "--output", str(output),
+        ],
+        check=True)
+
+
+def _objdump(*args):
+    import subprocess
+
+    return subprocess.run(
+        ["objdump"] + list(args),
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True).stdout
+
+
+def get_stub_layout(stub):
+    """
+    Get the end of the last section in `stub`, and its section alignment.
+    """
+    alignment = 0x1000
+    for line in _objdump("-p", str(stub)).splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == "SectionAlignment":
+            alignment = int(fields[1], 16)
+
+    end = 0
+    for line in _objdump("-h", str(stub)).splitlines():
+        fields = line.split()
+        if len(fields) == 7 and fields[0].isdigit():
+            end = max(end, int(fields[3], 16) + int(fields[2], 16))
+    return end, alignment
+
+
+def build_objcopy(output, stub, linux, initrd, os_release):
+    """
+    Build a UKI by adding sections to the systemd-boot stub with `objcopy`,
+    for systems without `ukify`.
+
+    Each section is placed after the last, aligned as the stub requires, with
+    the kernel last as it's decompressed in place.
+    """
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory(dir=str(Path(output).parent)) as tmp:
+        os_release_path = Path(tmp) / "os-release"
+        os_release_path.write_text(os_release)
+
+        offset, alignment = get_stub_layout(stub)
+        args = ["objcopy"]
+        for name, path in [
+                (".osrel", os_release_path),
+                (".initrd", Path(initrd)),
+                (".linux", Path(linux)),
+                ]:
+            offset += -offset % alignment
+            args += [
+                "--add-section", "{}={}".format(name, path),
+                "--change-section-vma", "{}={:#x}".format(name, offset),
+            ]
+            offset += path.stat().st_size
+        args += [str(stub), str(output)]
+        subprocess.run(args, check=True)
+
+
+UKI_BUILDERS = {
+    "ukify": build_ukify,
+    "objcopy": build_objcopy,
+}
+
+
+class UkiCache:
+    """
+    Cache of built UKIs, named by the hash of their inputs.
+
+    Holds at most `max_size` bytes of builds, evicting the least recently used
+    first, though never builds used by this run. The index, recording
+    each build's digest, size and when it was last used, is loaded lazily and
+    only written by `save`, which, as with `Manifest.save`, refuses to
+    overwrite an index another run saved since.
+
+    Builds can be made from several threads at once, each distinct UKI is
+    still only built once.
+    """
+    INDEX_NAME = "index.json"
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self._index = None
+        self._digest = None
+        self._lock = threading.Lock()
+        self._key_lock = KeyedLock()
+        self._used = set()
+
+    def reload(self):
+        """
+        Forget the index, so it's loaded again from disk when next used.
+        """
+        with self._lock:
+            self._index = None
+            self._digest = None
+            self._used = set()
+
+    @property
+    def index_path(self):
+        return self.directory / self.INDEX_NAME
+
+    @property
+    def index(self):
+        """
+        Index of the builds in the cache, and the digests of sources we've
+        already hashed.
+        """
+        with self._lock:
+            if self._index is None:
+                index = {"builds": {}, "sources": {}}
+                loaded, self._digest = load_json(self.index_path)
+                index.update(loaded or {})
+                self._index = index
+        return self._index
+
+    def get_digest(self, source):
+        """
+        Get the hash of the contents of `source`.
+
+        Remembered against the source's size and mtime, as with
+        `ImageStore.get_digest`.
+        """
+        source = Path(source)
+        stat = source.stat()
+        key = [stat.st_size, stat.st_mtime_ns]
+
+        cached = self.index["sources"].get(str(source))
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+
+        with profiling.span("uki.digest"):
+            digest = file_digest(source)
+
+        self.index["sources"][str(source)] = key + [digest]
+        return digest
+
+    def get_key(self, builder, stub, linux, initrd, os_release=OS_RELEASE):
+        """
+        Get the key a UKI built from these inputs is cached under.
+
+        Files are included by the hash of their contents, so a key only
+        changes when what would be built does.
+        """
+        inputs = [
+            builder,
+            self.get_digest(stub),
+            self.get_digest(linux),
+            self.get_digest(initrd),
+            os_release,
+        ]
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+    def get_path(self, key):
+        return self.directory / "{}.efi".format(key)
+
+    def get_build_digest(self, key):
+        """
+        Get the sha256 of the UKI cached under `key`.
+        """
+        return self.index["builds"][key]["digest"]
+
+    def get(self, key, build):
+        """
+        Get the path of the UKI cached under `key`, calling `build` with a
+        path to build it to if it isn't cached.
+        """
+        path = self.get_path(key)
+        builds = self.index["builds"]
+        with self._key_lock(key):
+            if key in builds and path.is_file():
+                DEV_LOGGER.info("Reusing built UKI: %s", path)
+                profiling.count("uki.cache_hits")
+            else:
+                DEV_LOGGER.info("Building UKI: %s", path)
+                profiling.count("uki.cache_misses")
+                self.directory.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(".{}.tmp".format(path.name))
+                try:
+                    with profiling.span("uki.build"):
+                        build(tmp_path)
+                except BaseException:
+                    if tmp_path.exists():
+                        tmp_path.unlink()
+                    raise
+                os.replace(str(tmp_path), str(path))
+                with self._lock:
+                    builds[key] = {
+                        "digest": file_digest(path),
+                        "size": path.stat().st_size,
+                    }
+        with self._lock:
+            builds[key]["used"] = time.time()
+            self._used.add(key)
+            self._evict()
+        return path
+
+    def _evict(self):
+        """
+        Delete the least recently used builds, other than those used by this
+        run, until the cache fits in `max_size`.
+
+        Call holding the lock.
+        """
+        builds = self._index["builds"]
+        size = sum(build["size"] for build in builds.values())
+        for key in sorted(builds, key=lambda key: builds[key]["used"]):
+            if size <= self.max_size:
+                break
+            if key in self._used:
+                continue
+            DEV_LOGGER.info("Evicting UKI: %s", self.get_path(key))
+            size -= builds.pop(key)["size"]
+            path = self.get_path(key)
+            if path.exists():
+                path.unlink()
+            profiling.count("uki.evicted")
+
+    def save(self):
+        """
+        Write the index to disk.
+
+        Digests of sources that no longer exist, e.g. in deleted snapshots,
+        are dropped so the index doesn't grow forever.
+        """
+        if self._index is None:
+            return
+        self._index["sources"] = {
+            source: cached
+            for source, cached in self._index["sources"].items()
+            if Path(source).exists()
+        }
+        check_unchanged(self.index_path, self._digest)
+        contents = json.dumps(self._index, indent=2, sort_keys=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_name(
+            ".{}.tmp".format(self.INDEX_NAME))
+        tmp_path.write_text(contents)
+        os.replace(str(tmp_path), str(self.index_path))
+        self._digest = hashlib.sha256(contents.encode()).hexdigest()
+
+    __repr__ = GetattrRepr(
+        directory="directory",
+        max_size="max_size",
+    )
@@ -0,0 +1,202 @@
+"""
+Fixtures shared by the tests.
+"""
+from collections import Counter
+from pathlib import Path
+from textwrap import dedent
+
+import pytest
+
+from snapper_systemd_boot.btrfs import (
+    DirectorySubvolumeBackend, SubvolumeBackend)
+from snapper_systemd_boot.config import SnapperSystemDBootConfig
+from snapper_systemd_boot.manager import SnapperSystemDBootManager
+from snapper_systemd_boot.snapper import Snapshot, SnapperConfig
+from snapper_systemd_boot import context
+
+
+class FakeSnapper:
+    """
+    Stand in for `Snapper` serving canned snapshots without DBUS.
+
+    Counts the DBUS calls the real thing would have made.
+    """
+    def __init__(self, snapshots, path="/"):
+        self.snapshots = snapshots
+        self.path = path
+        self.calls = Counter()
+
+    def get_configs_iter(self):
+        self.calls["ListConfigs"] += 1
+        yield SnapperConfig("root", self.path, {})
+
+    def list_snapshots(self, config_name):
+        assert config_name == "root"
+        self.calls["ListSnapshots"] += 1
+        for snapshot in self.snapshots:
+            yield Snapshot(*snapshot.to_raw())
+
+    def get_snapshot(self, config_name, num):
+        self.calls["GetSnapshot"] += 1
+        for snapshot in self.snapshots:
+            if snapshot.num == num:
+                return Snapshot(*snapshot.to_raw())
+        raise KeyError(num)
+
+    def resolve_mount_points(self, config_name, snapshots):
+        mount_points = {s.num: s.mount_point for s in self.snapshots}
+        for snapshot in snapshots:
+            self.calls["GetMountPoint"] += 1
+            snapshot.mount_point = mount_points[snapshot.num]
+            yield snapshot
+
+    def get_snapshots_iter(self, config_name):
+        return self.resolve_mount_points(
+            config_name, self.list_snapshots(config_name))
+
+
+def make_snapshots(snapshots_dir, count, userdata=None):
+    """
+    Make `count` synthetic snapshots after a "current" one, mounted under
+    `snapshots_dir`.
+
+    `userdata` if given is called with each snapshot number to get its
+    userdata.
+    """
+    snapshots = []
+    for num in range(count + 1):
+        snapshots.append(Snapshot(
+            num, 0, 0, 1500000000 + num, 0,
+            "current" if num == 0 else "snapshot {}".format(num), "",
+            {} if userdata is None or num == 0 else userdata(num),
+            mount_point=Path(snapshots_dir) / str(num)))
+    return snapshots
+
+
+class FakeSubvolumeBackend(SubvolumeBackend):
+    """
+    Stand in for btrfs that only makes empty directories.
+
+    Counts the subvolumes created and deleted, and syncs.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = Counter()
+
+    def snapshot(self, source, destination):
+        self.calls["snapshot"] += 1
+        Path(destination).mkdir()
+
+    def delete(self, path):
+        self.calls["delete"] += 1
+        Path(path).rmdir()
+
+    def sync(self, path):
+        self.calls["sync"] += 1
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-slow", action="store_true", help="Run tests marked slow.")
+    parser.addoption(
+        "--run-benchmarks", action="store_true",
+        help="Run tests marked benchmark, timed against this machine.")
+    parser.addoption(
+        "--update-benchmarks", action="store_true",
+        help="Store benchmark timings as the new baseline.")
+
+
+def pytest_collection_modifyitems(config, items):
+    skips = {}
+    if not config.getoption("--run-slow"):
+        skips["slow"] = pytest.mark.skip(reason="Needs --run-slow")
+    if not (
+            config.getoption("--run-benchmarks") or
+            config.getoption("--update-benchmarks")):
+        skips["benchmark"] = pytest.mark.skip(reason="Needs --run-benchmarks")
+    for item in items:
+        for keyword, skip in skips.items():
+            if keyword in item.keywords:
+                item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def snapper():
+    return context.get_snapper()
+
+
+@pytest.fixture
+def config(tmpdir):
+    """
+    Config with sensible values and mock files to represent the real thing.
+
+    As with most of this app, currently this is all heavily based on my
+    particular setup.
+    """
+    fake_root = Path(tmpdir.mkdir("fake_root"))
+    boot_path = fake_root / "boot"
+    boot_path.mkdir()
+
+    systemd_entries_path = boot_path / "loader/entries"
+    systemd_entries_path.mkdir(parents=True)
+
+    image_source_dir = fake_root / ".bootbackup"
+    image_source_dir.mkdir()
+
+    kernel_image_source = image_source_dir / "vmlinuz-linux"
+    kernel_image_source.touch()
+
+    initramfs_image_source = image_source_dir / "initramfs-linux.img"
+    initramfs_image_source.touch()
+
+    entry_template = dedent("""
+        title Arch Linux (Snapshot {entry.iso_timestamp} [{entry.num}])
+        linux /vmlinuz-linux
+        initrd /initramfs-linux.img
+        options \
+            cryptdevice=UUID=d79c85d5-0ed6-4b92-b3dd-e7b6fc7dee9f:aeryn-root-crypt\
+            root=/dev/mapper/aeryn-root-crypt quiet rw\
+            rootflags=subvol={entry.subvol}
+    """)
+
+    yield SnapperSystemDBootConfig(
+        systemd_entries_path=systemd_entries_path,
+        entry_prefix="arch-auto-snapshot-",
+        entry_template=entry_template,
+        kernel_image_source=kernel_image_source.relative_to(fake_root),
+        initramfs_image_source=initramfs_image_source.relative_to(fake_root),
+        images_snapshot_dir="snapper",
+        boot_path=boot_path,
+        root_subvolume="@",
+    )
+
+    for f in systemd_entries_path.iterdir():
+        print(f)
+        print(f.open("r").read())
+
+
+@pytest.fixture
+def fake_snapper(tmpdir):
+    """
+    Fake snapper with a "current" snapshot and three older ones.
+    """
+    snapshots_dir = Path(tmpdir.mkdir("snapshots"))
+    snapshots = []
+    for num, description in enumerate(["current", "one", "two", "three"]):
+        mount_point = snapshots_dir / str(num)
+        mount_point.mkdir()
+        snapshots.append(Snapshot(
+            num, 0, 0, 1500000000 + num, 0, description, "", {},
+            mount_point=mount_point))
+    return FakeSnapper(snapshots)
+
+
+@pytest.fixture
+def fake_inst(fake_snapper, config, tmpdir):
+    """
+    Manager using fake snapper, with writable snapshots as plain directories.
+    """
+    inst = SnapperSystemDBootManager(
+        fake_snapper, config, DirectorySubvolumeBackend())
+    inst.writable_snapshot_dir = Path(tmpdir.mkdir("writable"))
+    return inst
@@ -0,0 +1,126 @@
+"""
+Benchmarks against fake snapper and btrfs.
+
+Each manager operation is timed at several numbers of snapshots and compared
+with `benchmark_baseline.json`. A test fails if it's more than `TOLERANCE`
+times slower than its baseline, plus `SLACK` seconds to absorb noise in quick
+operations.
+
+Timings depend on the machine, so these only run with `--run-benchmarks`.
+After an intentional change in speed, or on a new machine, store new timings
+with `--update-benchmarks`. The 10,000 snapshot runs also need `--run-slow`.
+
+Run with `-s` to see the timings.
+"""
+from pathlib import Path
+import json
+import time
+
+import pytest
+
+from snapper_systemd_boot.manager import SnapperSystemDBootManager
+
+from tests.conftest import FakeSnapper, FakeSubvolumeBackend, make_snapshots
+
+BASELINE_PATH = Path(__file__).with_name("benchmark_baseline.json")
+
+TOLERANCE = 3.0
+SLACK = 0.05
+
+# Best of `RUNS`.
+RUNS = 3
+
+OPERATIONS = [
+    "get_snapshots_iter",
+    "get_boot_entries",
+    "write_boot_entries",
+    "remove_boot_configs",
+]
+
+SCALES = [
+    10,
+    100,
+    1000,
+    pytest.param(10000, marks=pytest.mark.slow),
+]
+
+
+@pytest.fixture(scope="session")
+def baseline(request):
+    """
+    Baseline timings, keyed by `<operation>[<count>]`.
+
+    With `--update-benchmarks` timings are recorded as they're taken and
+    written back at the end of the session.
+    """
+    baseline = {}
+    if BASELINE_PATH.exists():
+        baseline = json.loads(BASELINE_PATH.read_text())
+
+    results = {}
+    yield baseline, results
+
+    if request.config.getoption("--update-benchmarks") and results:
+        baseline.update(
+            (key, round(elapsed, 4)) for key, elapsed in results.items())
+        BASELINE_PATH.write_text(
+            json.dumps(baseline, indent=4, sort_keys=True) + "\n")
+
+
+def userdata(num):
+    """
+    Mix in snapshots excluded from boot.
+    """
+    return {"bootable": "false"} if num % 10 == 0 else {"important": "yes"}
+
+
+def run_operations(config, tmpdir, count):
+    """
+    Run every operation once, returning how long each took.
+    """
+    snapper = FakeSnapper(
+        make_snapshots(tmpdir.join("snapshots"), count, userdata))
+    inst = SnapperSystemDBootManager(snapper, config, FakeSubvolumeBackend())
+    inst.writable_snapshot_dir = Path(str(tmpdir.join("writable")))
+
+    timings = {}
+
+    def timed(name, func):
+        start = time.perf_counter()
+        result = func()
+        timings[name] = time.perf_counter() - start
+        return result
+
+    timed("get_snapshots_iter", lambda: list(inst.get_snapshots_iter()))
+    entries = timed("get_boot_entries", lambda: list(inst.get_boot_entries()))
+    timed("write_boot_entries", lambda: inst.write_boot_entries(entries))
+    assert len(list(inst.get_existing_entries())) == len(entries)
+    timed("remove_boot_configs", inst.remove_boot_configs)
+    assert list(inst.get_existing_entries()) == []
+    return timings
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("count", SCALES)
+def test_benchmark(count, config, tmpdir, baseline, request):
+    """
+    Operations haven't got slower than the baseline.
+    """
+    baseline, results = baseline
+    runs = [run_operations(config, tmpdir, count) for _ in range(RUNS)]
+
+    failures = []
+    for operation in OPERATIONS:
+        key = "{}[{}]".format(operation, count)
+        elapsed = min(run[operation] for run in runs)
+        results[key] = elapsed
+
+        expected = baseline.get(key)
+        print("{}: {:.4f}s (baseline {})".format(key, elapsed, expected))
+        if expected is None or request.config.getoption("--update-benchmarks"):
+            continue
+        if elapsed > expected * TOLERANCE + SLACK:
+            failures.append("{} took {:.4f}s, baseline {:.4f}s".format(
+                key, elapsed, expected))
+
+    assert failures == []
@@ -0,0 +1,45 @@
+"""
+Tests for snapper_systemd_boot.btrfs
+"""
+from pathlib import Path
+
+from snapper_systemd_boot.btrfs import (
+    BTRFS_IOC_INO_LOOKUP,
+    BTRFS_IOC_SNAP_CREATE_V2,
+    BTRFS_IOC_SNAP_DESTROY,
+    BTRFS_IOC_SYNC,
+    INO_LOOKUP_ARGS,
+    VOL_ARGS,
+    VOL_ARGS_V2,
+    DirectorySubvolumeBackend,
+)
+
+
+def test_directory_backend(tmpdir):
+    """
+    The directory backend copies and removes directories like btrfs would
+    snapshot and delete subvolumes.
+    """
+    backend = DirectorySubvolumeBackend()
+    source = Path(tmpdir.mkdir("source"))
+    (source / "etc").mkdir()
+    (source / "etc/hostname").write_text("aeryn")
+    destination = Path(str(tmpdir)) / "1"
+
+    backend.snapshot(source, destination)
+    assert (destination / "etc/hostname").read_text() == "aeryn"
+    assert backend.get_subvolume_id(destination) is not None
+
+    backend.delete(destination)
+    assert not destination.exists()
+
+
+def test_ioctl_numbers():
+    """
+    Check against the values from linux/btrfs.h on x86_64.
+    """
+    assert VOL_ARGS.size == VOL_ARGS_V2.size == INO_LOOKUP_ARGS.size == 4096
+    assert BTRFS_IOC_SYNC == 0x9408
+    assert BTRFS_IOC_SNAP_DESTROY == 0x5000940f
+    assert BTRFS_IOC_SNAP_CREATE_V2 == 0x50009417
+    assert BTRFS_IOC_INO_LOOKUP == 0xd0009412
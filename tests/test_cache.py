@@ -0,0 +1,94 @@
+"""
+Tests for snapper_systemd_boot.cache
+"""
+from pathlib import Path
+
+import pytest
+
+from snapper_systemd_boot.cache import CachingSnapper
+
+from tests.conftest import make_snapshots
+
+
+@pytest.fixture
+def cached_snapper(fake_snapper, tmpdir):
+    """
+    Point the fake snapper at a temporary subvolume and wrap it in the cache.
+    """
+    subvolume = Path(tmpdir.mkdir("subvolume"))
+    for snapshot in fake_snapper.snapshots:
+        (subvolume / ".snapshots" / str(snapshot.num)).mkdir(parents=True)
+    fake_snapper.path = str(subvolume)
+    snapper_configs_dir = Path(tmpdir.mkdir("configs"))
+
+    def make(refresh=False):
+        return CachingSnapper(
+            lambda: fake_snapper,
+            Path(str(tmpdir)) / "cache",
+            refresh=refresh,
+            snapper_configs_dir=snapper_configs_dir,
+        )
+    return make
+
+
+def test_cache(cached_snapper, fake_snapper):
+    """
+    Only ask snapper again when snapshots change or we're told to.
+    """
+    def get_nums(snapper):
+        return [s.num for s in snapper.get_snapshots_iter("root")]
+
+    def get_calls():
+        calls = dict(fake_snapper.calls)
+        fake_snapper.calls.clear()
+        return calls
+
+    assert get_nums(cached_snapper()) == [0, 1, 2, 3]
+    assert get_calls() == {
+        "ListConfigs": 1, "ListSnapshots": 1, "GetMountPoint": 4}
+
+    snapshots = list(cached_snapper().get_snapshots_iter("root"))
+    assert [s.num for s in snapshots] == [0, 1, 2, 3]
+    assert snapshots[1].mount_point == fake_snapper.snapshots[1].mount_point
+    assert get_calls() == {}
+
+    # Deleting a snapshot changes the snapshots directory.
+    deleted = fake_snapper.snapshots.pop()
+    (Path(fake_snapper.path) / ".snapshots" / str(deleted.num)).rmdir()
+    assert get_nums(cached_snapper()) == [0, 1, 2]
+    assert get_calls() == {"ListSnapshots": 1}
+
+    assert get_nums(cached_snapper(refresh=True)) == [0, 1, 2]
+    assert get_calls() == {
+        "ListConfigs": 1, "ListSnapshots": 1, "GetMountPoint": 3}
+
+
+def test_stream_mount_points(cached_snapper, fake_snapper, tmpdir):
+    """
+    Snapshots with cached mount points are yielded before the rest are
+    looked up, keeping the order they're given in.
+    """
+    list(cached_snapper().get_snapshots_iter("root"))
+    fake_snapper.snapshots.append(make_snapshots(tmpdir, 4)[4])
+    (Path(fake_snapper.path) / ".snapshots" / "4").mkdir()
+    fake_snapper.calls.clear()
+
+    snapshots = cached_snapper().get_snapshots_iter("root")
+    assert [next(snapshots).num for _ in range(4)] == [0, 1, 2, 3]
+    assert fake_snapper.calls["GetMountPoint"] == 0
+    assert [s.num for s in snapshots] == [4]
+    assert fake_snapper.calls["GetMountPoint"] == 1
+
+    fake_snapper.calls.clear()
+    assert len(list(cached_snapper().get_snapshots_iter("root"))) == 5
+    assert fake_snapper.calls["GetMountPoint"] == 0
+
+    snapshots = list(cached_snapper().list_snapshots("root"))
+    snapshots[1].mount_point = None
+    snapshots[3].mount_point = None
+    fake_snapper.calls.clear()
+    resolved = cached_snapper().resolve_mount_points("root", snapshots)
+    assert next(resolved).num == 0
+    assert fake_snapper.calls["GetMountPoint"] == 0
+    assert [s.num for s in resolved] == [1, 2, 3, 4]
+    assert fake_snapper.calls["GetMountPoint"] == 2
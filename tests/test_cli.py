@@ -0,0 +1,75 @@
+"""
+Tests for snapper_systemd_boot.cli
+"""
+from datetime import datetime
+import json
+
+import pytest
+
+from snapper_systemd_boot import cli, context
+from snapper_systemd_boot.lock import RunLock
+
+from tests.conftest import make_snapshots
+
+
+def test_list_snapshots_jsonl(fake_inst, fake_snapper, monkeypatch):
+    """
+    Snapshots are filtered before their mount points are looked up, and
+    written one JSON object per line.
+    """
+    monkeypatch.setattr(context, "get_manager", lambda: fake_inst)
+    fake_snapper.calls.clear()
+
+    lines = list(cli.list_snapshots(output_format="jsonl", limit=2))
+
+    records = [json.loads(line) for line in lines]
+    assert [r["num"] for r in records] == [2, 3]
+    assert records[0]["type"] == "single"
+    assert records[0]["mount_point"].endswith("/2")
+    assert fake_snapper.calls["GetMountPoint"] == 2
+
+
+def test_list_entries_jsonl(fake_inst, monkeypatch):
+    monkeypatch.setattr(context, "get_manager", lambda: fake_inst)
+
+    records = [
+        json.loads(line)
+        for line in cli.list_entries(output_format="jsonl", num=[1])]
+
+    assert [r["num"] for r in records] == [1]
+    assert "subvol=@/.snapper_systemd_boot/1" in records[0]["contents"]
+
+
+def test_parse_since():
+    assert cli.parse_since("2017-07-14") == datetime(2017, 7, 14)
+    assert cli.parse_since("2017-07-14T02:40:01") == datetime(
+        2017, 7, 14, 2, 40, 1)
+    assert cli.parse_since("2017-07-14 02:40") == datetime(
+        2017, 7, 14, 2, 40)
+    with pytest.raises(ValueError):
+        cli.parse_since("yesterday")
+
+
+def test_add_drop(fake_inst, fake_snapper, monkeypatch, tmpdir):
+    """
+    A single snapshot's entry is added and dropped without listing every
+    snapshot.
+    """
+    monkeypatch.setattr(context, "get_manager", lambda: fake_inst)
+    monkeypatch.setattr(
+        context, "get_lock", lambda: RunLock(tmpdir.join("lock")))
+    fake_inst.update()
+    fake_snapper.snapshots.extend(make_snapshots(tmpdir, 4)[4:])
+    tmpdir.mkdir("4")
+    fake_snapper.calls.clear()
+
+    cli.add(num=4)
+    assert fake_snapper.calls == {
+        "ListConfigs": 1, "GetSnapshot": 1, "GetMountPoint": 1}
+    assert fake_inst.get_writable_snapshot_path(4).is_dir()
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2, 3, 4]
+
+    fake_snapper.calls.clear()
+    cli.drop(num=2)
+    assert fake_snapper.calls == {}
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 3, 4]
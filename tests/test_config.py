@@ -0,0 +1,24 @@
+"""
+Tests for snapper_systemd_boot.config
+"""
+import pytest
+
+from snapper_systemd_boot.config import SnapperSystemDBootConfig
+
+
+@pytest.mark.real_config
+def test_load_example_config():
+    """
+    Test loading the example config.
+
+    TODO: Add some assertions.
+    TODO: While loading the example config is a useful validation that the
+          makes sense, the validation following the load checks real file
+          locations hence the `real_config` test marker.
+          I could make the example config less "real" and use temporary
+          directories that could be pregenerated but that makes the example
+          less useful.
+    """
+    config = SnapperSystemDBootConfig.from_filename(
+        "snapper_systemd_boot.conf.example")
+    print(config)
@@ -0,0 +1,85 @@
+"""
+Tests for snapper_systemd_boot.daemon
+"""
+import time
+
+from snapper_systemd_boot.daemon import SnapperSignalDaemon
+
+
+class FakeTimer:
+    """
+    Timer that only fires when told to.
+    """
+    def __init__(self):
+        self.pending = {}
+        self._next_handle = 0
+
+    def add(self, delay, callback):
+        self._next_handle += 1
+        self.pending[self._next_handle] = (delay, callback)
+        return self._next_handle
+
+    def remove(self, handle):
+        del self.pending[handle]
+
+    def fire(self):
+        (handle, (delay, callback)), = self.pending.items()
+        del self.pending[handle]
+        callback()
+
+
+class FakeManager:
+    def __init__(self):
+        self.synced = []
+        self.reloads = 0
+
+    def reload(self):
+        self.reloads += 1
+
+    def get_root_config(self):
+        class Config:
+            name = "root"
+        return Config
+
+    def sync_snapshots(self, nums):
+        self.synced.append(nums)
+
+
+def test_batch_signals():
+    """
+    Bursts of signals are handled together, ignoring other configs.
+    """
+    timer = FakeTimer()
+    manager = FakeManager()
+    daemon = SnapperSignalDaemon(manager, timer=timer)
+
+    daemon.on_snapshot_created("root", 10)
+    daemon.on_snapshot_modified("root", 3)
+    daemon.on_snapshots_deleted("root", [1, 2, 10])
+    daemon.on_snapshot_created("home", 11)
+
+    assert len(timer.pending) == 1
+    assert manager.synced == []
+
+    timer.fire()
+    assert manager.synced == [{1, 2, 3, 10}]
+    assert manager.reloads == 1
+    assert not timer.pending
+
+
+def test_max_delay(monkeypatch):
+    """
+    A steady trickle of signals can't put off syncing forever.
+    """
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    timer = FakeTimer()
+    daemon = SnapperSignalDaemon(
+        FakeManager(), delay=2.0, max_delay=5.0, timer=timer)
+
+    daemon.on_snapshot_created("root", 1)
+    now[0] = 4.0
+    daemon.on_snapshot_created("root", 2)
+
+    (delay, callback), = timer.pending.values()
+    assert delay == 1.0
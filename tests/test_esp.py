@@ -0,0 +1,146 @@
+"""
+Tests for snapper_systemd_boot.esp
+"""
+from pathlib import Path
+import errno
+import os
+
+import pytest
+
+from snapper_systemd_boot import esp
+from snapper_systemd_boot.esp import EspWriter
+
+
+@pytest.fixture
+def syncs(monkeypatch):
+    """
+    Record calls to syncfs.
+    """
+    syncs = []
+    monkeypatch.setattr(esp, "syncfs", syncs.append)
+    return syncs
+
+
+def test_commit(tmpdir, syncs):
+    """
+    Files only appear once committed, with one sync either side of the
+    renames.
+    """
+    boot = Path(str(tmpdir))
+    source = boot / "source"
+    source.write_text("kernel")
+    (boot / "entry.conf").write_text("old")
+
+    with EspWriter(boot) as writer:
+        writer.write_text(boot / "entry.conf", "new")
+        writer.copy_file(source, boot / "vmlinuz")
+        assert (boot / "entry.conf").read_text() == "old"
+        assert not (boot / "vmlinuz").exists()
+        assert writer.is_staged(boot / "vmlinuz")
+
+    assert (boot / "entry.conf").read_text() == "new"
+    assert (boot / "vmlinuz").read_text() == "kernel"
+    assert sorted(p.name for p in boot.iterdir()) == [
+        "entry.conf", "source", "vmlinuz"]
+    assert syncs == [boot, boot]
+
+
+def test_abort(tmpdir, syncs):
+    """
+    Nothing is written if anything goes wrong.
+    """
+    boot = Path(str(tmpdir))
+
+    with pytest.raises(RuntimeError):
+        with EspWriter(boot) as writer:
+            writer.write_text(boot / "entry.conf", "new")
+            raise RuntimeError()
+
+    assert list(boot.iterdir()) == []
+    assert syncs == []
+
+
+def test_syncfs(tmpdir):
+    """
+    Syncing a real filesystem doesn't fail.
+    """
+    esp.syncfs(str(tmpdir))
+
+
+def test_skip_unchanged(tmpdir, syncs):
+    """
+    Files already on the ESP with the same contents aren't written again.
+    """
+    boot = Path(str(tmpdir))
+    source = boot / "source"
+    source.write_text("kernel")
+
+    with EspWriter(boot) as writer:
+        writer.write_text(boot / "entry.conf", "entry")
+        writer.copy_file(source, boot / "vmlinuz")
+    assert writer.written == 2
+
+    # Same size, different time, same contents.
+    os.utime(str(boot / "vmlinuz"), (0, 0))
+
+    with EspWriter(boot) as writer:
+        writer.write_text(boot / "entry.conf", "entry")
+        writer.copy_file(source, boot / "vmlinuz")
+        writer.write_text(boot / "other.conf", "other")
+    assert (writer.written, writer.skipped) == (1, 2)
+    assert writer.bytes_saved == len("entry") + len("kernel")
+
+    # Same size, different time, different contents.
+    source.write_text("KERNEL")
+    with EspWriter(boot) as writer:
+        writer.copy_file(source, boot / "vmlinuz")
+    assert (writer.written, writer.skipped) == (1, 0)
+    assert (boot / "vmlinuz").read_text() == "KERNEL"
+
+
+def test_copy_file_partial(tmpdir, monkeypatch):
+    """
+    Partial copies are retried, and unsupported methods fallen back from.
+    """
+    source = Path(str(tmpdir.join("source")))
+    source.write_bytes(b"0123456789" * 10)
+    calls = []
+
+    def copy_file_range(source_fd, destination_fd, count):
+        calls.append("copy_file_range")
+        raise OSError(errno.EXDEV, "Cross device")
+
+    real_sendfile = os.sendfile
+
+    def sendfile(destination_fd, source_fd, offset, count):
+        calls.append("sendfile")
+        return real_sendfile(destination_fd, source_fd, offset, min(count, 7))
+
+    monkeypatch.setattr(os, "copy_file_range", copy_file_range, raising=False)
+    monkeypatch.setattr(os, "sendfile", sendfile)
+
+    destination = Path(str(tmpdir.join("destination")))
+    assert esp.copy_file(source, destination) == 100
+    assert destination.read_bytes() == source.read_bytes()
+    assert calls[0] == "copy_file_range"
+    assert calls.count("sendfile") == 15
+
+
+def test_copy_file_verify(tmpdir, syncs):
+    """
+    Copies not matching the expected digest are never committed.
+    """
+    boot = Path(str(tmpdir))
+    source = boot / "source"
+    source.write_text("kernel")
+
+    with pytest.raises(ValueError):
+        with EspWriter(boot) as writer:
+            writer.copy_file(source, boot / "vmlinuz", digest="0" * 64)
+
+    assert sorted(p.name for p in boot.iterdir()) == ["source"]
+
+    with EspWriter(boot) as writer:
+        writer.copy_file(
+            source, boot / "vmlinuz", digest=esp.file_digest(source))
+    assert (boot / "vmlinuz").read_text() == "kernel"
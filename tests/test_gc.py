@@ -0,0 +1,58 @@
+"""
+Tests for snapper_systemd_boot.gc
+"""
+from pathlib import Path
+
+from snapper_systemd_boot.gc import GarbageCollector
+
+
+def test_removed_entries_left_for_gc(fake_inst, fake_snapper):
+    """
+    Removing entries leaves their snapshots for gc, which deletes them within
+    budget, pausing between each.
+    """
+    fake_inst.update()
+    fake_snapper.snapshots = fake_snapper.snapshots[:1]
+    fake_inst.update()
+
+    assert list(fake_inst.get_existing_entries()) == []
+    assert sorted(p.name for p in fake_inst.find_orphan_snapshots()) == [
+        "1", "2", "3"]
+
+    pauses = []
+    collector = GarbageCollector(
+        fake_inst, budget=2, pause=0.5, sleep=pauses.append)
+    assert collector.collect() == (2, 1)
+    assert pauses == [0.5]
+    assert len(fake_inst.find_orphan_snapshots()) == 1
+
+    assert collector.collect() == (1, 0)
+    assert not fake_inst.writable_snapshot_dir.exists()
+
+
+def test_unused_images(fake_inst, tmpdir):
+    """
+    Images no entry uses are deleted, but only once released.
+    """
+    fake_inst.update()
+    source = Path(str(tmpdir.join("vmlinuz-linux")))
+    source.write_text("kernel")
+    fake_inst.image_store.add(1, [source])
+    fake_inst.image_store.save()
+
+    collector = GarbageCollector(fake_inst, budget=None)
+    assert collector.collect() == (0, 0)
+
+    fake_inst.remove_boot_entry(1)
+    assert len(fake_inst.image_store.get_unused_blob_paths()) == 1
+    assert collector.collect() == (2, 0)
+    assert fake_inst.image_store.get_unused_blob_paths() == []
+
+
+def test_no_manifest(fake_inst):
+    """
+    Without a manifest nothing is known to be unused, so nothing is deleted.
+    """
+    fake_inst.get_writable_snapshot_path(1).mkdir()
+    assert GarbageCollector(fake_inst).collect() == (0, 0)
+    assert fake_inst.get_writable_snapshot_path(1).is_dir()
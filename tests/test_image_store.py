@@ -0,0 +1,62 @@
+"""
+Tests for snapper_systemd_boot.image_store
+"""
+from pathlib import Path
+
+import pytest
+
+from snapper_systemd_boot.image_store import ImageStore
+
+
+@pytest.fixture
+def store(tmpdir):
+    return ImageStore(Path(tmpdir.mkdir("boot")) / "snapper")
+
+
+@pytest.fixture
+def sources(tmpdir):
+    """
+    Kernel images in two snapshots with the same contents and one different.
+    """
+    sources = []
+    for num, contents in enumerate([b"kernel", b"kernel", b"new kernel"]):
+        source = Path(tmpdir.mkdir(str(num))) / "vmlinuz-linux"
+        source.write_bytes(contents)
+        sources.append(source)
+    return sources
+
+
+def test_deduplicate(store, sources):
+    """
+    Identical images are only stored once.
+    """
+    names = [store.add(num, [source])[0] for num, source in enumerate(sources)]
+
+    assert names[0] == names[1] != names[2]
+    assert names[0].startswith("vmlinuz-linux-")
+    assert sorted(store.get_blob_paths()) == sorted(
+        store.directory / name for name in set(names))
+
+
+def test_unused_blobs(store, sources):
+    """
+    Images are only unused, and left for gc, once no entry uses them.
+
+    Files that aren't blobs, e.g. left by an interrupted write, are ignored.
+    """
+    for num, source in enumerate(sources):
+        store.add(num, [source])
+    store.save()
+    (store.directory / ".{}.tmp".format(
+        store.get_blob_name(sources[2]))).write_bytes(b"partial")
+
+    store.release(0)
+    store.release(2)
+    store.save()
+
+    assert [p.name for p in store.get_unused_blob_paths()] == [
+        store.get_blob_name(sources[2])]
+
+    reloaded = ImageStore(store.directory)
+    assert reloaded.has_images(1, [store.get_blob_name(sources[1])])
+    assert not reloaded.has_images(0, [store.get_blob_name(sources[0])])
@@ -0,0 +1,55 @@
+"""
+Tests for snapper_systemd_boot.lock
+"""
+from snapper_systemd_boot.lock import RunLock
+
+
+def test_coalesce(tmpdir):
+    """
+    Runs started while another is in progress cost one more pass between
+    them.
+    """
+    lock = RunLock(str(tmpdir.join("lock")))
+    calls = []
+
+    def update():
+        calls.append("update")
+        if len(calls) == 1:
+            assert [lock.run(update) for _ in range(3)] == [False] * 3
+
+    assert lock.run(update)
+    assert calls == ["update", "update"]
+    assert not lock.dirty_path.exists()
+
+
+def test_wait_then_rerun(tmpdir):
+    """
+    Updates requested during a different run are done after it.
+    """
+    lock = RunLock(str(tmpdir.join("lock")))
+    calls = []
+
+    def update():
+        calls.append("update")
+
+    def remove():
+        calls.append("remove")
+        assert not lock.run(update)
+
+    assert lock.run(remove, rerun=update, wait=True)
+    assert calls == ["remove", "update"]
+
+
+def test_stale_dirty(tmpdir):
+    """
+    A dirty flag left from before the lock was taken doesn't cost a rerun.
+    """
+    lock = RunLock(str(tmpdir.join("lock")))
+    lock.directory.mkdir()
+    lock.dirty_path.touch()
+    calls = []
+
+    assert lock.run(
+        lambda: calls.append("add"), rerun=lambda: calls.append("update"))
+    assert calls == ["add"]
+    assert not lock.dirty_path.exists()
@@ -0,0 +1,286 @@
+"""
+Tests for snapper_systemd_boot.manager
+"""
+import pytest
+
+from snapper_systemd_boot.manager import SnapperSystemDBootManager
+from snapper_systemd_boot.retention import RetentionPolicy
+from snapper_systemd_boot.snapper import Snapshot
+
+from tests.conftest import FakeSubvolumeBackend
+
+
+@pytest.fixture
+def inst(snapper, config):
+    return SnapperSystemDBootManager(snapper, config)
+
+
+@pytest.mark.real_config
+def test_get_root_config(inst):
+    """
+    Check we can access root snapper config.
+
+    I.e. use the real snapper dbus interface and try and locate the config used
+    to back up the root path `/`.
+    """
+    root_config = inst.get_root_config()
+    name, path, config = inst.snapper.snapper.GetConfig(root_config.name)
+
+    assert name == root_config.name
+    assert path == str(root_config.path) == "/"
+
+
+@pytest.mark.real_config
+@pytest.mark.dangerous
+def test_write_entries(inst):
+    """
+    Run entry generation and write to disk.
+
+    TODO: This is only barely a test. Actually assert on something!
+    """
+    inst.write_boot_entries()
+
+
+def test_apply_plan(fake_inst, fake_snapper):
+    """
+    Apply plans creating every entry, then removing one.
+    """
+    fake_inst.apply_plan(fake_inst.plan_update())
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2, 3]
+    assert sorted(fake_inst.get_existing_writable_snapshot_nums()) == [1, 2, 3]
+    assert fake_inst.plan_update().is_empty()
+
+    fake_snapper.snapshots.pop()
+    plan = fake_inst.plan_update()
+    assert plan.remove == [3]
+    assert len(plan.unchanged) == 2
+
+    fake_inst.apply_plan(plan)
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2]
+    assert sorted(fake_inst.get_existing_writable_snapshot_nums()) == [1, 2]
+
+
+def test_plan_update(fake_inst):
+    """
+    Check the update plan only touches entries that differ from disk.
+    """
+    entries = {e.snapshot.num: e for e in fake_inst.get_boot_entries()}
+
+    # Up to date.
+    entries[1].write()
+    fake_inst.get_writable_snapshot_path(1).mkdir()
+
+    # Stale entry contents.
+    entries[2].get_entry_path().write_text("stale")
+    fake_inst.get_writable_snapshot_path(2).mkdir()
+
+    # Snapshot that no longer exists.
+    fake_inst.get_entry_path(99).write_text("old")
+
+    plan = fake_inst.plan_update()
+
+    assert [e.snapshot.num for e in plan.unchanged] == [1]
+    assert [e.snapshot.num for e in plan.update] == [2]
+    assert [e.snapshot.num for e in plan.add] == [3]
+    assert plan.remove == [99]
+
+
+def test_plan_snapshots(fake_inst, fake_snapper):
+    """
+    Check planning a few snapshots only looks at those snapshots.
+    """
+    entries = {e.snapshot.num: e for e in fake_inst.get_boot_entries()}
+    for num in (1, 2):
+        entries[num].write()
+        fake_inst.get_writable_snapshot_path(num).mkdir()
+    fake_inst.get_entry_path(99).write_text("old")
+    fake_snapper.calls.clear()
+
+    plan = fake_inst.plan_snapshots({0, 2, 3, 99})
+
+    assert [e.snapshot.num for e in plan.unchanged] == [2]
+    assert [e.snapshot.num for e in plan.add] == [3]
+    assert plan.remove == [99]
+    assert fake_snapper.calls["GetSnapshot"] == 4
+    assert fake_snapper.calls["ListSnapshots"] == 0
+
+
+def test_retention(fake_inst, fake_snapper):
+    """
+    Snapshots left out by the retention policy never have their mount points
+    looked up, and their entries are removed.
+    """
+    fake_inst.apply_plan(fake_inst.plan_update())
+    fake_inst.retention = RetentionPolicy(newest=1)
+    fake_snapper.calls.clear()
+
+    plan = fake_inst.plan_update()
+    assert [e.snapshot.num for e in plan.unchanged] == [3]
+    assert plan.remove == [1, 2]
+    assert fake_snapper.calls["GetMountPoint"] == 1
+
+    plan = fake_inst.plan_snapshots({1, 3})
+    assert [e.snapshot.num for e in plan.unchanged] == [3]
+    assert plan.remove == [1, 2]
+
+
+@pytest.mark.real_config
+def test_generate_entries(inst):
+    """
+    Test generation of entries.
+
+    TODO: This is only barely a test. Actually assert on something!
+    """
+    for entry in inst.get_boot_entries():
+        print(entry)
+
+
+def test_on_demand(fake_inst):
+    """
+    On demand entries leave creating the writable snapshot to boot.
+    """
+    fake_inst.config.boot_mode = "on-demand"
+    entry = next(fake_inst.get_boot_entries())
+    assert entry.boot_options == (
+        "snapper_systemd_boot.source=@{} "
+        "snapper_systemd_boot.target=@/.snapper_systemd_boot/1".format(
+            entry.snapshot.mount_point))
+
+    fake_inst.apply_plan(fake_inst.plan_update())
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2, 3]
+    assert list(fake_inst.get_existing_writable_snapshot_nums()) == []
+    assert fake_inst.plan_update().is_empty()
+
+
+def test_overlay_userdata(fake_inst, fake_snapper):
+    """
+    Snapshots can choose to boot under an overlay, without a writable
+    snapshot.
+    """
+    fake_snapper.snapshots[2].userdata["boot_mode"] = "overlay"
+    fake_snapper.snapshots[3].userdata["boot_mode"] = "bogus"
+
+    entries = {e.snapshot.num: e for e in fake_inst.get_boot_entries()}
+    assert entries[2].boot_mode == "overlay"
+    assert entries[2].subvol == entries[2].snapshot_subvol
+    assert entries[2].boot_options == "snapper_systemd_boot.overlay=1"
+    assert entries[3].boot_mode == "writable"
+
+    fake_inst.apply_plan(fake_inst.plan_update())
+    assert sorted(fake_inst.get_existing_writable_snapshot_nums()) == [1, 3]
+    assert fake_inst.plan_update().is_empty()
+
+
+def test_failed_entry(fake_inst, monkeypatch):
+    """
+    An entry that fails is reported without stopping the rest, and tried
+    again next update.
+    """
+    snapshot = fake_inst.subvolume_backend.snapshot
+
+    def failing_snapshot(source, destination):
+        if destination.name == "2":
+            raise OSError("No space left on device")
+        snapshot(source, destination)
+
+    monkeypatch.setattr(
+        fake_inst.subvolume_backend, "snapshot", failing_snapshot)
+    failures = fake_inst.update()
+
+    assert [(f.item.snapshot.num, f.stage) for f in failures] == [
+        (2, "subvolumes")]
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 3]
+
+    monkeypatch.setattr(fake_inst.subvolume_backend, "snapshot", snapshot)
+    assert fake_inst.update() == []
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2, 3]
+
+
+def test_missing_images_keep_snapshot(fake_inst, fake_snapper, config):
+    """
+    Missing images are copied again without replacing the writable snapshot,
+    which may hold changes made while booted into it.
+    """
+    for snapshot in fake_snapper.snapshots:
+        for source in (
+                config.kernel_image_source, config.initramfs_image_source):
+            path = snapshot.mount_point / source
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("{} {}".format(source, snapshot.num))
+    fake_snapper.snapshots[1].userdata["copy_images"] = "true"
+    fake_inst.update()
+
+    changed = fake_inst.get_writable_snapshot_path(1) / "changed"
+    changed.write_text("changed while booted")
+    blobs = list(fake_inst.image_store.get_blob_paths())
+    assert len(blobs) == 2
+    blobs[0].unlink()
+    fake_snapper.snapshots[2].userdata["copy_images"] = "true"
+
+    plan = fake_inst.plan_update()
+    assert plan.add == []
+    assert sorted(e.snapshot.num for e in plan.update) == [1, 2]
+    fake_inst.update()
+
+    assert changed.read_text() == "changed while booted"
+    assert blobs[0].is_file()
+    assert len(list(fake_inst.image_store.get_blob_paths())) == 4
+    assert fake_inst.plan_update().is_empty()
+
+
+def test_plan_failure(fake_inst, fake_snapper, config):
+    """
+    An entry whose kernel has gone is reported and left alone, while the
+    rest are still added and updated.
+    """
+    def write_images(snapshot, content):
+        for source in (
+                config.kernel_image_source, config.initramfs_image_source):
+            path = snapshot.mount_point / source
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("{} {}".format(source, content))
+
+    for snapshot in fake_snapper.snapshots:
+        write_images(snapshot, snapshot.num)
+        snapshot.userdata["copy_images"] = "true"
+    fake_inst.update()
+
+    (fake_snapper.snapshots[2].mount_point /
+     config.kernel_image_source).unlink()
+    write_images(fake_snapper.snapshots[3], "changed")
+    new = Snapshot(
+        4, 0, 0, 1500000004, 0, "four", "", {"copy_images": "true"},
+        mount_point=fake_snapper.snapshots[3].mount_point.parent / "4")
+    new.mount_point.mkdir()
+    write_images(new, 4)
+    fake_snapper.snapshots.append(new)
+
+    plan = fake_inst.plan_update()
+    assert [f.item.snapshot.num for f in plan.failed] == [2]
+    assert [e.snapshot.num for e in plan.add] == [4]
+    assert [e.snapshot.num for e in plan.update] == [3]
+
+    failures = fake_inst.update()
+    assert [(f.item.snapshot.num, f.stage) for f in failures] == [(2, "plan")]
+    assert isinstance(failures[0].error, FileNotFoundError)
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2, 3, 4]
+    plan = fake_inst.plan_update()
+    assert plan.add == plan.update == plan.remove == []
+    assert [f.item.snapshot.num for f in plan.failed] == [2]
+
+
+def test_subvolume_commit(fake_inst, fake_snapper):
+    """
+    Snapshots are created by several workers, and btrfs synced once after
+    they're all created, not at all when none are.
+    """
+    backend = FakeSubvolumeBackend(workers=4, commit=True)
+    fake_inst.subvolume_backend = backend
+
+    assert fake_inst.update() == []
+    assert backend.calls == {"snapshot": 3, "sync": 1}
+
+    fake_snapper.snapshots[2].userdata["boot_mode"] = "overlay"
+    assert [e.snapshot.num for e in fake_inst.plan_update().update] == [2]
+    assert fake_inst.update() == []
+    assert backend.calls == {"snapshot": 3, "sync": 1}
@@ -0,0 +1,80 @@
+"""
+Tests for snapper_systemd_boot.manifest
+"""
+import shutil
+
+import pytest
+
+from snapper_systemd_boot.btrfs import DirectorySubvolumeBackend
+from snapper_systemd_boot.gc import GarbageCollector
+from snapper_systemd_boot.manager import SnapperSystemDBootManager
+
+
+def test_manifest_lookups(fake_inst, monkeypatch):
+    """
+    Once there's a manifest, what exists is looked up rather than scanned.
+    """
+    assert not fake_inst.manifest.is_found()
+    fake_inst.update()
+    assert fake_inst.manifest.is_found()
+
+    def scan():
+        raise AssertionError("Scanned disk.")
+
+    monkeypatch.setattr(fake_inst, "scan_entries", scan)
+    monkeypatch.setattr(fake_inst, "scan_writable_snapshots", scan)
+
+    record = fake_inst.manifest.get(2)
+    assert record["entry"] == str(fake_inst.get_entry_path(2))
+    assert record["subvol"] == str(fake_inst.get_writable_snapshot_path(2))
+    assert record["subvol_id"] is not None
+    assert sorted(fake_inst.get_existing_entry_nums()) == [1, 2, 3]
+    assert fake_inst.plan_update().is_empty()
+
+    fake_inst.remove_boot_configs()
+    assert list(fake_inst.get_existing_entries()) == []
+
+
+def test_check(fake_inst):
+    """
+    Differences between the manifest and disk are reported.
+    """
+    fake_inst.update()
+    assert list(fake_inst.check()) == []
+
+    fake_inst.get_entry_path(1).unlink()
+    fake_inst.get_entry_path(2).write_text("edited")
+    fake_inst.get_entry_path(99).write_text("stray")
+    shutil.rmtree(str(fake_inst.get_writable_snapshot_path(3)))
+
+    assert list(fake_inst.check()) == [
+        "missing entry: {}".format(fake_inst.get_entry_path(1)),
+        "modified entry: {}".format(fake_inst.get_entry_path(2)),
+        "missing snapshot: {}".format(
+            fake_inst.get_writable_snapshot_path(3)),
+        "untracked entry: {}".format(fake_inst.get_entry_path(99)),
+    ]
+
+
+def test_two_managers(fake_inst, fake_snapper, config):
+    """
+    A manager sees what another did since its last run, and never saves over
+    it.
+    """
+    other = SnapperSystemDBootManager(
+        fake_snapper, config, DirectorySubvolumeBackend())
+    other.writable_snapshot_dir = fake_inst.writable_snapshot_dir
+
+    fake_inst.sync_snapshots([1, 2])
+    other.sync_snapshots([3])
+    fake_inst.sync_snapshots([1])
+    assert fake_inst.manifest.get_nums() == {1, 2, 3}
+    assert list(fake_inst.check()) == []
+    assert GarbageCollector(fake_inst).find_garbage() == ([], [])
+
+    fake_inst.manifest.record(1, fake_inst.get_entry_path(1), "")
+    other.remove_boot_entry(3)
+    with pytest.raises(RuntimeError):
+        fake_inst.manifest.save()
+    fake_inst.reload()
+    assert fake_inst.manifest.get_nums() == {1, 2}
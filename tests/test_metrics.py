@@ -0,0 +1,82 @@
+"""
+Tests for snapper_systemd_boot.metrics
+"""
+from functools import partial
+from pathlib import Path
+import fcntl
+import os
+
+import pytest
+
+from snapper_systemd_boot import profiling
+from snapper_systemd_boot.lock import RunLock
+from snapper_systemd_boot.metrics import MetricsExporter, read_last_success
+
+
+def read_metrics(path):
+    return dict(
+        line.rsplit(" ", 1)
+        for line in path.read_text().splitlines()
+        if not line.startswith("#"))
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    monkeypatch.setattr(profiling.PROFILER, "enabled", False)
+    yield profiling.PROFILER
+    profiling.PROFILER.reset()
+
+
+def test_metrics(fake_inst, profiler, tmpdir):
+    """
+    Each run's counts, phases and disk usage are written, and a failed run
+    keeps the last success.
+    """
+    path = Path(str(tmpdir)) / "metrics" / "snapper_systemd_boot.prom"
+    exporter = MetricsExporter(path, fake_inst, profiler=profiler)
+
+    exporter.run(fake_inst.update)
+    metrics = read_metrics(path)
+    assert metrics["snapper_systemd_boot_entries_added"] == "3"
+    assert metrics["snapper_systemd_boot_entries_failed"] == "0"
+    assert metrics["snapper_systemd_boot_writable_snapshots"] == "3"
+    assert metrics["snapper_systemd_boot_last_run_success"] == "1"
+    assert int(metrics["snapper_systemd_boot_esp_free_bytes"]) > 0
+    assert int(metrics["snapper_systemd_boot_esp_bytes_written"]) > 0
+    assert 'snapper_systemd_boot_phase_seconds{phase="run"}' in metrics
+    last_success = read_last_success(path)
+    assert last_success is not None
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        exporter.run(fail)
+    metrics = read_metrics(path)
+    assert metrics["snapper_systemd_boot_entries_added"] == "0"
+    assert metrics["snapper_systemd_boot_last_run_success"] == "0"
+    assert read_last_success(path) == last_success
+    assert [p.name for p in path.parent.iterdir()] == [
+        "snapper_systemd_boot.prom"]
+
+
+def test_coalesced_run(fake_inst, profiler, tmpdir):
+    """
+    A run left to one in progress doesn't overwrite the metrics of the last
+    run that did the work.
+    """
+    path = Path(str(tmpdir)) / "snapper_systemd_boot.prom"
+    exporter = MetricsExporter(path, fake_inst, profiler=profiler)
+    lock = RunLock(str(tmpdir.join("lock")))
+    assert exporter.run(partial(lock.run, fake_inst.update))
+    before = path.read_text()
+
+    # Held by another process.
+    fd = os.open(str(lock.lock_path), os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        assert exporter.run(partial(lock.run, fake_inst.update)) is False
+    finally:
+        os.close(fd)
+    assert path.read_text() == before
+    assert read_metrics(path)["snapper_systemd_boot_entries_added"] == "3"
@@ -0,0 +1,66 @@
+"""
+Tests for snapper_systemd_boot.pipeline
+"""
+import threading
+
+from snapper_systemd_boot.pipeline import Pipeline, Stage
+
+
+def test_pipeline():
+    """
+    Every item goes through every stage, with more items than fit in the
+    queues.
+    """
+    seen = []
+
+    pipeline = Pipeline(
+        [
+            Stage("double", lambda item: item * 2, workers=3),
+            Stage("record", lambda item: seen.append(item) or item),
+        ],
+        queue_size=1)
+    done, failures = pipeline.run(iter(range(10)))
+
+    assert sorted(done) == sorted(seen) == [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
+    assert failures == []
+
+
+def test_failures():
+    """
+    A failure is recorded against the stage and item, without stopping the
+    other items.
+    """
+    def fail_odd(item):
+        if item % 2:
+            raise ValueError(item)
+        return item
+
+    done, failures = Pipeline([Stage("fail_odd", fail_odd, workers=2)]).run(
+        range(6))
+
+    assert sorted(done) == [0, 2, 4]
+    assert sorted(f.item for f in failures) == [1, 3, 5]
+    assert {f.stage for f in failures} == {"fail_odd"}
+    assert all(isinstance(f.error, ValueError) for f in failures)
+
+
+def test_stages_overlap():
+    """
+    A later stage works on one item while an earlier stage is still busy with
+    the next.
+    """
+    second_started = threading.Event()
+
+    def first(item):
+        if item == 1:
+            assert second_started.wait(5)
+        return item
+
+    def second(item):
+        second_started.set()
+        return item
+
+    done, failures = Pipeline(
+        [Stage("first", first), Stage("second", second)]).run([0, 1])
+    assert done == [0, 1]
+    assert failures == []
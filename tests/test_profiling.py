@@ -0,0 +1,56 @@
+"""
+Tests for snapper_systemd_boot.profiling
+"""
+import json
+
+import pytest
+
+from snapper_systemd_boot import profiling
+from snapper_systemd_boot.profiling import Profiler, percentile
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    """
+    Enable the global profiler for the test, starting empty.
+    """
+    profiler = profiling.PROFILER
+    monkeypatch.setattr(profiler, "enabled", True)
+    profiler.reset()
+    yield profiler
+    profiler.reset()
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3], 99) == 3
+
+
+def test_disabled():
+    """
+    Nothing is recorded unless enabled.
+    """
+    inst = Profiler()
+    with inst.span("phase"):
+        inst.count("things")
+    assert inst.get_report() == {"spans": {}, "counters": {}}
+
+
+def test_manager_phases(profiler, fake_inst, tmpdir):
+    """
+    Applying a plan records the phases and counts of entries.
+    """
+    fake_inst.apply_plan(fake_inst.plan_update())
+
+    report = profiler.get_report()
+    assert report["spans"]["manager.plan_update"]["count"] == 1
+    assert report["spans"]["subvolume.snapshot"]["count"] == 3
+    assert report["spans"]["entry.render"]["count"] == 3
+    assert report["counters"]["entries.added"] == 3
+
+    path = tmpdir.join("profile.json")
+    profiler.write_json(str(path))
+    assert json.loads(path.read())["counters"]["entries.added"] == 3
+    assert "manager.apply_plan" in profiler.format_report()
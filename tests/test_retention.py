@@ -0,0 +1,97 @@
+"""
+Tests for snapper_systemd_boot.retention
+"""
+from datetime import datetime
+
+from snapper_systemd_boot.retention import RetentionPolicy, SnapshotFilter
+from snapper_systemd_boot.snapper import Snapshot, SnapshotType
+
+NOW = datetime(2020, 1, 31, 12)
+
+
+def make_snapshot(num, day, hour=0, type_raw=0, userdata=None):
+    timestamp = datetime(2020, 1, day, hour).timestamp()
+    return Snapshot(
+        num, type_raw, 0, timestamp, 0, "", "", userdata or {})
+
+
+def select(policy, snapshots):
+    return [s.num for s in policy.select(snapshots, now=NOW)]
+
+
+def test_inactive():
+    """
+    With nothing set every snapshot is kept.
+    """
+    snapshots = [make_snapshot(num, 1) for num in range(1, 4)]
+    assert not RetentionPolicy().is_active()
+    assert select(RetentionPolicy(), snapshots) == [1, 2, 3]
+
+
+def test_newest_and_types():
+    """
+    Keep the newest N of the given types.
+    """
+    snapshots = [
+        make_snapshot(1, 1, type_raw=SnapshotType.PRE.value),
+        make_snapshot(2, 2, type_raw=SnapshotType.POST.value),
+        make_snapshot(3, 3),
+        make_snapshot(4, 4),
+        make_snapshot(5, 5, type_raw=SnapshotType.PRE.value),
+    ]
+    assert select(RetentionPolicy(newest=2), snapshots) == [4, 5]
+    assert select(
+        RetentionPolicy(
+            newest=2, types=[SnapshotType.SINGLE, SnapshotType.POST]),
+        snapshots) == [3, 4]
+
+
+def test_daily_after_days():
+    """
+    Older snapshots are thinned to one per day, the newest.
+    """
+    snapshots = [
+        make_snapshot(1, 1, 1),
+        make_snapshot(2, 1, 2),
+        make_snapshot(3, 2, 1),
+        make_snapshot(4, 30, 1),
+        make_snapshot(5, 30, 2),
+    ]
+    policy = RetentionPolicy(daily_after_days=7)
+    assert select(policy, snapshots) == [2, 3, 4, 5]
+
+
+def test_pinned():
+    """
+    Snapshots marked bootable are always kept and don't count towards newest.
+    """
+    snapshots = [
+        make_snapshot(1, 1, userdata={"bootable": "true"}),
+        make_snapshot(2, 2, type_raw=SnapshotType.PRE.value),
+        make_snapshot(3, 3),
+    ]
+    policy = RetentionPolicy(newest=1, types=[SnapshotType.POST])
+    assert select(policy, snapshots) == [1]
+    assert select(RetentionPolicy(newest=1), snapshots) == [1, 3]
+
+
+def test_snapshot_filter():
+    """
+    Filters combine, with limit taking the newest.
+    """
+    snapshots = [
+        make_snapshot(1, 1),
+        make_snapshot(2, 2, type_raw=SnapshotType.PRE.value),
+        make_snapshot(3, 3),
+        make_snapshot(4, 4),
+    ]
+    since = datetime(2020, 1, 2)
+    assert [s.num for s in SnapshotFilter(since=since).apply(snapshots)] == [
+        2, 3, 4]
+    assert [
+        s.num for s in SnapshotFilter(
+            types=[SnapshotType.SINGLE], limit=2).apply(snapshots)
+    ] == [3, 4]
+    assert [
+        s.num for s in SnapshotFilter(nums=[1, 2, 9]).apply(snapshots)
+    ] == [1, 2]
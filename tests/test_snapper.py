@@ -0,0 +1,41 @@
+"""
+Tests for snapper_systemd_boot.snapper
+"""
+from pathlib import Path
+
+import pytest
+
+from snapper_systemd_boot.snapper import Snapshot, SnapshotType
+
+
+@pytest.mark.real_config
+def test_get_snapshots(snapper):
+    """Test we can access snapshots via dbus."""
+    snapshot = next(snapper.get_snapshots_iter("root"))
+    assert snapshot.description == "current"
+
+
+def test_lazy_snapshot():
+    """
+    Fields are converted, and the mount point looked up, only when used.
+    """
+    resolved = []
+
+    def resolver(snapshot):
+        resolved.append(snapshot.num)
+        return Path("/.snapshots/{}/snapshot".format(snapshot.num))
+
+    raw = [7, 2, 6, 1500000000, 0, "post", "number", {"important": "yes"}]
+    snapshot = Snapshot(*raw, resolver=resolver)
+
+    assert not hasattr(snapshot, "__dict__")
+    assert snapshot.get_userdata("important") == "yes"
+    assert snapshot.get_userdata("bootable", "true") == "true"
+    assert snapshot.type == SnapshotType.POST
+    assert resolved == []
+    assert not snapshot.has_mount_point
+
+    assert snapshot.mount_point == Path("/.snapshots/7/snapshot")
+    assert snapshot.mount_point == Path("/.snapshots/7/snapshot")
+    assert resolved == [7]
+    assert snapshot.to_raw() == raw
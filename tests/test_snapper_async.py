@@ -0,0 +1,49 @@
+"""
+Tests for snapper_systemd_boot.snapper_async
+"""
+from pathlib import Path
+import asyncio
+
+from snapper_systemd_boot.snapper_async import AsyncSnapper
+
+
+class FakeInterface:
+    """
+    Stands in for the snapper DBUS interface, recording how many
+    `GetMountPoint` calls are in flight.
+    """
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def call_list_configs(self):
+        return [["root", "/", {}]]
+
+    async def call_list_snapshots(self, config_name):
+        return [
+            [num, 0, 0, 1500000000, 0, str(num), "", {}]
+            for num in range(50)
+        ]
+
+    async def call_get_mount_point(self, config_name, num):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        return "/.snapshots/{}/snapshot".format(num)
+
+
+def test_concurrent_mount_points():
+    """
+    Mount points are resolved concurrently, within the limit.
+    """
+    interface = FakeInterface()
+    snapper = AsyncSnapper(concurrency=4)
+    snapper._interface = interface
+
+    config, = snapper.get_configs_iter()
+    snapshots = list(snapper.get_snapshots_iter(config.name))
+
+    assert [s.num for s in snapshots] == list(range(50))
+    assert snapshots[3].mount_point == Path("/.snapshots/3/snapshot")
+    assert interface.max_in_flight == 4
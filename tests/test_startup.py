@@ -0,0 +1,92 @@
+"""
+Startup time budget for the CLI.
+
+Pacman hooks run the CLI on every kernel update so commands that don't talk to
+snapper or btrfs shouldn't pay to import them, or pytest.
+
+The time budgets depend on the machine, so are only checked with
+`--run-benchmarks`. Run with `-s` to see the timings.
+"""
+from textwrap import dedent
+import subprocess
+import sys
+import time
+
+import pytest
+
+# Best of `RUNS` cold starts, in seconds.
+BUDGETS = {
+    "--help": 0.5,
+    "list-generated": 0.5,
+}
+RUNS = 3
+
+HEAVY_MODULES = [
+    "asyncio",
+    "concurrent.futures.thread",
+    "dbus",
+    "dbus_next",
+    "distutils",
+    "gi",
+    "pytest",
+    "sh",
+]
+
+
+@pytest.fixture
+def config_path(tmpdir):
+    boot_path = tmpdir.mkdir("boot")
+    entries_path = boot_path.mkdir("loader").mkdir("entries")
+    entries_path.join("arch-auto-snapshot-1.conf").write("")
+    config_path = tmpdir.join("snapper_systemd_boot.conf")
+    config_path.write(dedent("""\
+        [DEFAULT]
+        KERNEL_IMAGE_SOURCE = .bootbackup/pre/vmlinuz-linux
+        INITRAMFS_IMAGE_SOURCE = .bootbackup/pre/initramfs-linux.img
+        IMAGES_SNAPSHOT_DIR = snapper
+        BOOT_PATH = {boot_path}
+        SYSTEMD_ENTRIES_PATH = {entries_path}
+        ROOT_SUBVOLUME = @
+        ENTRY_PREFIX = arch-auto-snapshot-
+        CACHE_DIR = {cache_dir}
+        ENTRY_TEMPLATE = title {{entry.title_suffix}}
+        """).format(
+            boot_path=boot_path,
+            entries_path=entries_path,
+            cache_dir=tmpdir.join("cache")))
+    return str(config_path)
+
+
+def run_cli(*args):
+    start = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, "-m", "snapper_systemd_boot.cli"] + list(args))
+    return time.perf_counter() - start, output
+
+
+def test_no_heavy_imports():
+    """
+    Importing the CLI doesn't import anything heavy.
+    """
+    output = subprocess.check_output([
+        sys.executable,
+        "-c",
+        "import sys; import snapper_systemd_boot.cli; "
+        "print(' '.join(sys.modules))",
+    ])
+    imported = set(output.decode().split())
+    assert [m for m in HEAVY_MODULES if m in imported] == []
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("command", sorted(BUDGETS))
+def test_startup_budget(command, config_path):
+    """
+    Commands that don't need snapper start within budget.
+    """
+    args = ["--config", config_path, command]
+    elapsed, output = min(run_cli(*args) for _ in range(RUNS))
+    print("{}: {:.3f}s".format(command, elapsed))
+
+    assert output
+    assert elapsed < BUDGETS[command]
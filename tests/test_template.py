@@ -0,0 +1,68 @@
+"""
+Tests for snapper_systemd_boot.template
+"""
+import pytest
+
+from snapper_systemd_boot.manager import BootEntry
+from snapper_systemd_boot.template import FIELDS, EntryTemplate
+
+
+class FakeEntry:
+    """
+    Entry recording which fields were asked for.
+    """
+    def __init__(self, **values):
+        self.values = values
+        self.requested = None
+
+    def get_template_values(self, fields):
+        self.requested = set(fields)
+        return {name: self.values[name] for name in fields}
+
+
+def test_render():
+    """
+    Rendering matches `str.format`, only looking up fields that are used.
+    """
+    template = (
+        "title {entry.title_suffix!r}\n"
+        "options rootflags=subvol={entry.subvol} num={entry.num:04}\n"
+        "# {entry.userdata[copy_images]} {{literal}}\n"
+    )
+    entry = FakeEntry(
+        title_suffix="hello",
+        subvol="@/.snapper_systemd_boot/7",
+        num=7,
+        userdata={"copy_images": "true"},
+        description="unused",
+    )
+
+    rendered = EntryTemplate(template).render(entry)
+
+    assert rendered == (
+        "title 'hello'\n"
+        "options rootflags=subvol=@/.snapper_systemd_boot/7 num=0007\n"
+        "# true {literal}\n"
+    )
+    assert entry.requested == {"title_suffix", "subvol", "num", "userdata"}
+
+
+@pytest.mark.parametrize("template", [
+    "title {entry.nonsense}",
+    "title {snapshot.num}",
+    "title {entry}",
+])
+def test_unknown_field(template):
+    """
+    Unknown fields are rejected when the template is compiled.
+    """
+    with pytest.raises(ValueError):
+        EntryTemplate(template)
+
+
+def test_entry_fields(fake_snapper, config):
+    """
+    Every field is available from `BootEntry`.
+    """
+    entry = BootEntry(fake_snapper.snapshots[1], config)
+    assert set(entry.get_template_values(FIELDS)) == FIELDS
@@ -0,0 +1,147 @@
+"""
+Tests for snapper_systemd_boot.uki
+"""
+from pathlib import Path
+
+import pytest
+
+from snapper_systemd_boot import uki
+from snapper_systemd_boot.gc import GarbageCollector
+from snapper_systemd_boot.uki import UkiCache, get_uki_entry
+
+
+@pytest.fixture
+def builds():
+    return []
+
+
+@pytest.fixture
+def fake_builder(monkeypatch, builds):
+    """
+    Replace `ukify` with a builder that concatenates its inputs.
+    """
+    def build(output, stub, linux, initrd, os_release):
+        builds.append(Path(linux).read_bytes())
+        Path(output).write_bytes(
+            Path(stub).read_bytes() + Path(linux).read_bytes() +
+            Path(initrd).read_bytes())
+
+    monkeypatch.setitem(uki.UKI_BUILDERS, "ukify", build)
+
+
+@pytest.fixture
+def uki_inst(fake_inst, fake_builder, tmpdir):
+    """
+    Manager building UKIs from a fake stub and the current kernel.
+    """
+    config = fake_inst.config
+    config.output_mode = "uki"
+    config.uki_stub = Path(str(tmpdir.join("linuxx64.efi.stub")))
+    config.uki_stub.write_bytes(b"stub")
+    (config.boot_path / "vmlinuz-linux").write_bytes(b"kernel")
+    (config.boot_path / "initramfs-linux.img").write_bytes(b"initramfs")
+    fake_inst.uki_cache = UkiCache(tmpdir.join("uki"), 1024 ** 2)
+    return fake_inst
+
+
+def test_cache_lru(tmpdir):
+    """
+    Builds are reused, and the least recently used evicted once the cache is
+    too big, though never builds the same run still needs.
+    """
+    built = []
+
+    def build(contents):
+        def build_to(path):
+            built.append(contents)
+            path.write_bytes(contents)
+        return build_to
+
+    cache = UkiCache(tmpdir.join("uki"), 10)
+    cache.get("a", build(b"aaaa"))
+    cache.get("b", build(b"bbbb"))
+    cache.get("a", build(b"aaaa"))
+    cache.get("c", build(b"cccc"))
+    assert built == [b"aaaa", b"bbbb", b"cccc"]
+    assert sorted(cache.index["builds"]) == ["a", "b", "c"]
+    cache.save()
+
+    cache = UkiCache(tmpdir.join("uki"), 10)
+    cache.get("a", build(b"aaaa"))
+    cache.get("d", build(b"dddd"))
+    assert sorted(cache.index["builds"]) == ["a", "d"]
+    assert not cache.get_path("b").exists()
+    assert not cache.get_path("c").exists()
+    assert cache.get_path("a").read_bytes() == b"aaaa"
+
+
+def test_uki_entry():
+    """
+    Entries boot the UKI instead of a kernel and initramfs, keeping the rest.
+    """
+    assert get_uki_entry(
+        "title Arch\n"
+        "linux /vmlinuz-linux\n"
+        "\tinitrd /initramfs-linux.img\n"
+        "options rootflags=subvol=@/.snapper_systemd_boot/1\n"
+        "\n",
+        "/EFI/snapper_systemd_boot/key.efi") == (
+            "title Arch\n"
+            "options rootflags=subvol=@/.snapper_systemd_boot/1\n"
+            "efi /EFI/snapper_systemd_boot/key.efi\n")
+
+
+def test_uki_output_mode(uki_inst, builds):
+    """
+    Entries booting the same kernel and initramfs share one UKI, passing
+    their own options, and it's only built again for a new kernel.
+    """
+    uki_inst.update()
+
+    uki_dir = uki_inst.config.boot_path / uki.UKI_DIR
+    assert builds == [b"kernel"]
+    uki_path, = uki_dir.iterdir()
+    assert uki_path.read_bytes() == b"stubkernelinitramfs"
+    entries = {e.snapshot.num: e for e in uki_inst.get_boot_entries()}
+    assert len({e.uki_key for e in entries.values()}) == 1
+    for num, entry in entries.items():
+        contents = entry.get_entry_path().read_text()
+        assert "efi /{}/{}\n".format(uki.UKI_DIR, uki_path.name) in contents
+        assert "rootflags=subvol=@/.snapper_systemd_boot/{}".format(
+            num) in contents
+        assert "linux " not in contents
+    assert list(uki_inst.check()) == []
+
+    assert uki_inst.plan_update().is_empty()
+    uki_inst.update()
+    assert len(builds) == 1
+
+    # A new kernel means a new build, and the old one is left for gc.
+    (uki_inst.config.boot_path / "vmlinuz-linux").write_bytes(b"new kernel")
+    assert len(uki_inst.plan_update().update) == 3
+    uki_inst.update()
+    assert builds == [b"kernel", b"new kernel"]
+    assert len(list(uki_dir.iterdir())) == 2
+    assert GarbageCollector(uki_inst).collect() == (1, 0)
+    assert not uki_path.exists()
+    assert list(uki_inst.check()) == []
+
+
+def test_switch_output_mode(uki_inst):
+    """
+    Changing output mode rewrites the entries, leaving UKIs for gc.
+    """
+    uki_inst.update()
+    uki_inst.config.output_mode = "entry"
+    uki_inst.update()
+
+    assert sorted(p.name for p in uki_inst.scan_entries()) == [
+        "arch-auto-snapshot-1.conf",
+        "arch-auto-snapshot-2.conf",
+        "arch-auto-snapshot-3.conf",
+    ]
+    assert all(
+        "linux /vmlinuz-linux" in p.read_text()
+        for p in uki_inst.scan_entries())
+    uki_path, = (uki_inst.config.boot_path / uki.UKI_DIR).iterdir()
+    assert GarbageCollector(uki_inst).find_garbage() == ([], [uki_path])